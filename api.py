@@ -1,5 +1,6 @@
 import json
 import uuid
+import sqlite3
 import subprocess
 import os
 import time
@@ -8,9 +9,9 @@ import secrets
 import random
 from datetime import datetime
 from typing import List, Optional, Dict
-from functools import lru_cache
-from fastapi import FastAPI, HTTPException, Header, Depends, Request
+from fastapi import FastAPI, HTTPException, Header, Depends, Request, Query, Response
 from starlette.requests import Request
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import psutil
 from slowapi import Limiter, _rate_limit_exceeded_handler
@@ -43,12 +44,16 @@ def load_env_file():
 load_env_file()
 
 # Импорт модулей для мониторинга
-from port_manager import port_manager, assign_port_for_key, release_port_for_key, get_port_for_key, get_all_port_assignments, reset_all_ports
-from xray_config_manager import xray_config_manager, add_key_to_xray_config, remove_key_from_xray_config, update_xray_config_for_keys, get_xray_config_status, validate_xray_config_sync, fix_reality_keys_in_xray_config, sync_short_ids_from_db
+from port_manager import port_manager, assign_port_for_key, create_key_with_port, release_port_for_key, get_port_for_key, get_all_port_assignments, reset_all_ports
+from xray_config_manager import xray_config_manager, add_key_to_xray_config, remove_key_from_xray_config, get_xray_config_status, validate_xray_config_sync, sync_short_ids_from_db
+from xray_reconciler import reconcile_xray_inbounds, hot_apply_xray_config, xray_reconciler
+from xray_config_model import get_config_model
 from traffic_history_manager import traffic_history
-from storage.sqlite_storage import storage
+from storage.sqlite_storage import storage, DB_BACKUP_DIR
+from storage.async_storage import async_storage
+from storage.maintenance import StorageMaintenance
 try:
-    from xray_stats_reader import get_xray_user_traffic, get_all_xray_users_traffic
+    from xray_stats_reader import xray_stats_reader, get_xray_user_traffic, get_all_xray_users_traffic
     XRAY_STATS_AVAILABLE = True
 except ImportError:
     XRAY_STATS_AVAILABLE = False
@@ -56,6 +61,12 @@ except ImportError:
 
 app = FastAPI(title="VPN Key Management API", version="2.3.6")
 
+
+@app.on_event("shutdown")
+def shutdown_storage_executors():
+    """Останавливаем writer/reader пулы асинхронного хранилища"""
+    async_storage.shutdown(wait=True)
+
 # Настройка rate limiting с расширенными правилами
 # Белый список IP для исключения из rate limiting (бот)
 BOT_WHITELIST_IPS = ["77.246.105.29"]
@@ -84,6 +95,13 @@ _config_cache = {}
 _config_cache_time = {}
 CACHE_TTL = 60
 
+# Пагинация GET /api/keys
+KEYS_PAGE_DEFAULT_LIMIT = 100
+KEYS_PAGE_MAX_LIMIT = 1000
+
+# Попытки подобрать свободный short_id при создании ключа
+SHORT_ID_ATTEMPTS = 10
+
 # Пути к файлам
 CONFIG_FILE = "/root/vpn-server/config/config.json"
 
@@ -107,6 +125,10 @@ class CreateKeyRequest(BaseModel):
 class DeleteKeyRequest(BaseModel):
     key_id: str
 
+class PortPoolsRequest(BaseModel):
+    ranges: List[List[int]]
+    exclude: List[int] = []
+
 # Функция для проверки API ключа
 async def verify_api_key(x_api_key: str = Header(None)):
     if x_api_key != API_KEY:
@@ -116,29 +138,41 @@ async def verify_api_key(x_api_key: str = Header(None)):
         )
     return x_api_key
 
-# Загрузка конфигурации Xray с кэшированием
-@lru_cache(maxsize=1)
-def load_config_cached():
-    """Загрузка конфигурации с LRU кэшем"""
-    with open(CONFIG_FILE, 'r') as f:
-        return json.load(f)
-
+# Загрузка конфигурации Xray из общей с xray_config_manager модели в памяти
+# (файл перечитывается только при изменении извне)
 def load_config():
-    """Загрузка конфигурации (с автоматической инвалидацией кэша)"""
-    return load_config_cached()
+    """Загрузка конфигурации"""
+    config = get_config_model(CONFIG_FILE).load()
+    if config is None:
+        raise FileNotFoundError(CONFIG_FILE)
+    return config
 
-# Сохранение конфигурации Xray
+# Сохранение конфигурации Xray (атомарная запись)
 def save_config(config):
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=2)
-    # Инвалидируем кэш при сохранении
-    load_config_cached.cache_clear()
+    get_config_model(CONFIG_FILE).save(config)
 
 # Загрузка ключей
 def load_keys():
     """Чтение всех ключей из хранилища"""
     return storage.get_all_keys()
 
+# Выбор short_id для нового ключа
+def pick_short_id(exclude=()):
+    """
+    Свободный short_id (8 hex символов): в общем режиме - запасной shortId общего
+    inbound (ключ добавляется через adu), иначе случайный, не занятый в БД.
+    exclude - уже отвергнутые при вставке shortIds.
+    """
+    if port_manager.shared_mode:
+        short_id = xray_config_manager.take_spare_short_id(exclude)
+        if short_id:
+            return short_id
+    for _ in range(SHORT_ID_ATTEMPTS):
+        short_id = secrets.token_hex(4)  # 4 байта = 8 hex символов
+        if short_id not in exclude and not storage.get_key_by_short_id(short_id):
+            return short_id
+    raise HTTPException(status_code=500, detail="Failed to generate unique short_id")
+
 # Перезапуск Xray сервиса с проверкой
 def check_xray_process():
     """Проверка наличия процесса Xray"""
@@ -179,6 +213,7 @@ def restart_xray():
             time.sleep(3)
             if check_xray_process():
                 logger.info("Xray restarted via systemctl")
+                xray_reconciler.record_running_config()
                 return True
         except Exception as e:
             logger.warning(f"systemctl restart failed: {e}")
@@ -195,6 +230,8 @@ def restart_xray():
         
         if check_xray_process():
             logger.info("Xray started directly")
+            # ExecStartPost не выполняется - запоминаем конфигурацию запуска здесь
+            xray_reconciler.record_running_config()
             return True
         else:
             logger.error("Xray restart failed")
@@ -203,6 +240,27 @@ def restart_xray():
         logger.error(f"Error restarting Xray: {e}")
         return False
 
+# Проверка publicKey в inbound'е нового ключа (выполняется в пуле потоков)
+def ensure_public_key_in_config(key_uuid):
+    config = xray_config_manager._load_config()
+    if not config:
+        return
+    public_key = xray_config_manager._load_reality_keys().get('public_key')
+    if not public_key:
+        return
+    for inbound in config.get('inbounds', []):
+        clients = inbound.get('settings', {}).get('clients', [])
+        for client in clients:
+            if client.get('id') == key_uuid:
+                reality_settings = inbound.get('streamSettings', {}).get('realitySettings', {})
+                if not reality_settings.get('publicKey'):
+                    # Исправляем отсутствие publicKey
+                    reality_settings['publicKey'] = public_key
+                    xray_config_manager._save_config(config)
+                    xray_config_manager._apply_inbound_via_api(inbound)
+                    logger.warning(f"Fixed missing publicKey for key {key_uuid} after creation")
+                return
+
 # Проверка конфигурации Xray
 def verify_xray_config():
     try:
@@ -231,59 +289,42 @@ def verify_xray_config():
         print(f"Error verifying Xray config: {e}")
         return False
 
-# Принудительная синхронизация конфигурации Xray
-def force_sync_xray_config():
-    try:
-        keys = load_keys()
-        config = load_config()
-        
-        # Обновляем конфигурацию на основе SQLite
-        # Используем update_xray_config_for_keys для правильной синхронизации
-        if not update_xray_config_for_keys(keys):
-            print("Warning: Failed to update Xray config for keys")
-            return False
-        
-        # Синхронизируем short_id из БД в конфигурацию
-        sync_result = sync_short_ids_from_db()
-        if sync_result.get("success"):
-            fixed_count = sync_result.get("fixed_count", 0)
-            if fixed_count > 0:
-                print(f"Synced {fixed_count} short_id(s) from database to Xray config")
-        else:
-            print(f"Warning: Failed to sync short_ids: {sync_result.get('error')}")
-        
-        print("Xray configuration force-synchronized with SQLite")
-        return True
-    except Exception as e:
-        print(f"Error force-syncing Xray config: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+# Синхронизация конфигурации Xray без перезапуска (перезапуск - только при изменении глобальных секций)
+def hot_sync_xray_config():
+    keys = load_keys()
+    result = hot_apply_xray_config(keys, restart=restart_xray)
+    if result["path"] == "failed":
+        print(f"Error syncing Xray config: {result['reconcile'].get('errors')}")
+    elif result["global_changed"] and result["path"] != "restart":
+        print("Error syncing Xray config: failed to restart Xray after global config change")
+    else:
+        print(f"Xray configuration synchronized with SQLite ({result['path']})")
+    return result
 
 # Проверка и обновление настроек Reality
 def verify_reality_settings():
+    """Настройки Reality (в т.ч. maxTimeDiff) приводятся к эталонным через hot-apply, затем проверяются"""
     try:
-        config = load_config()
-        reality_settings = config["inbounds"][0]["streamSettings"]["realitySettings"]
-        
-        # Проверяем maxTimeDiff
-        if reality_settings.get("maxTimeDiff", 0) == 0:
-            reality_settings["maxTimeDiff"] = 600
-            print("Updated maxTimeDiff to 600 seconds")
+        result = hot_sync_xray_config()
+        if result["path"] == "failed":
+            return None
         
-        # Проверяем наличие всех необходимых полей
-        required_fields = ["dest", "serverNames", "privateKey", "shortIds"]
-        for field in required_fields:
-            if field not in reality_settings:
-                print(f"Missing required Reality field: {field}")
-                return False
+        # Проверяем наличие всех необходимых полей во всех Reality inbound'ах
+        required_fields = ["dest", "serverNames", "privateKey", "shortIds", "maxTimeDiff"]
+        for inbound in load_config().get("inbounds", []):
+            reality_settings = inbound.get("streamSettings", {}).get("realitySettings")
+            if reality_settings is None:
+                continue
+            for field in required_fields:
+                if not reality_settings.get(field):
+                    print(f"Missing required Reality field in {inbound.get('tag')}: {field}")
+                    return None
         
-        save_config(config)
         print("Reality settings verified and updated")
-        return True
+        return result
     except Exception as e:
         print(f"Error verifying Reality settings: {e}")
-        return False
+        return None
 
 @app.get("/")
 async def root():
@@ -299,13 +340,15 @@ async def health_check():
     try:
         # Проверка статуса сервисов
         # Xray проверяем через процесс, так как systemd unit может не работать
-        xray_status = "running" if check_xray_process() else "stopped"
-        api_status = "running" if subprocess.run(['/usr/bin/systemctl', 'is-active', 'vpn-api'], 
-                                               capture_output=True, text=True).returncode == 0 else "stopped"
-        nginx_status = "running" if subprocess.run(['/usr/bin/systemctl', 'is-active', 'nginx'], 
-                                                 capture_output=True, text=True).returncode == 0 else "stopped"
+        # (обход процессов и systemctl - в пуле потоков, не в event loop)
+        xray_status = "running" if await run_in_threadpool(check_xray_process) else "stopped"
+        api_status = "running" if (await run_in_threadpool(subprocess.run, ['/usr/bin/systemctl', 'is-active', 'vpn-api'],
+                                                           capture_output=True, text=True)).returncode == 0 else "stopped"
+        nginx_status = "running" if (await run_in_threadpool(subprocess.run, ['/usr/bin/systemctl', 'is-active', 'nginx'],
+                                                             capture_output=True, text=True)).returncode == 0 else "stopped"
         
-        # Получение системных ресурсов
+        # Получение системных ресурсов (cpu_percent с interval=1 спит секунду - в пуле потоков)
+        cpu_percent = await run_in_threadpool(psutil.cpu_percent, interval=1)
         memory = psutil.virtual_memory()
         disk = psutil.disk_usage('/')
         
@@ -323,7 +366,7 @@ async def health_check():
                 "memory_available_mb": round(memory.available / 1024 / 1024, 2),
                 "disk_usage_percent": disk.percent,
                 "disk_free_gb": round(disk.free / 1024 / 1024 / 1024, 2),
-                "cpu_usage_percent": psutil.cpu_percent(interval=1)
+                "cpu_usage_percent": cpu_percent
             },
             "uptime_seconds": int(time.time() - psutil.boot_time())
         }
@@ -339,16 +382,16 @@ async def health_check():
 async def create_key(request: Request, key_request: CreateKeyRequest, api_key: str = Depends(verify_api_key)):
     """Создать новый VPN ключ с индивидуальным портом"""
     key_uuid = None
-    assigned_port = None
     key_stored = False
     
     try:
-        # Проверяем лимит ключей (максимум 100)
-        if storage.count_keys() >= 100:
-            raise HTTPException(status_code=400, detail="Maximum number of keys (100) reached")
+        # Проверяем лимит ключей (ёмкость пулов портов или лимит клиентов общего inbound)
+        capacity = await async_storage.run(lambda: port_manager.max_ports)
+        if await async_storage.count_keys() >= capacity:
+            raise HTTPException(status_code=400, detail=f"Maximum number of keys ({capacity}) reached")
         
         # КРИТИЧЕСКАЯ ПРОВЕРКА: Убеждаемся, что Reality ключи доступны
-        reality_keys = xray_config_manager._load_reality_keys()
+        reality_keys = await run_in_threadpool(xray_config_manager._load_reality_keys)
         if not reality_keys.get('public_key'):
             raise HTTPException(
                 status_code=500,
@@ -365,28 +408,12 @@ async def create_key(request: Request, key_request: CreateKeyRequest, api_key: s
 
         # Генерация индивидуального shortId для каждого ключа (для разделения пользователей)
         # Используем 4 байта для получения 8 hex символов (совместимость с Android)
-        # Проверяем уникальность short_id
-        existing_keys = storage.get_all_keys()
-        existing_short_ids = {k.get('short_id') for k in existing_keys if k.get('short_id')}
-        short_id = secrets.token_hex(4)  # 4 байта = 8 hex символов
-        # Проверка: short_id должен быть ровно 8 символов
-        if len(short_id) != 8:
-            raise HTTPException(status_code=500, detail=f"Invalid short_id length: {len(short_id)}, expected 8")
-        max_attempts = 10
-        attempt = 0
-        while short_id in existing_short_ids and attempt < max_attempts:
-            short_id = secrets.token_hex(4)
-            # Проверка длины при каждой генерации
-            if len(short_id) != 8:
-                raise HTTPException(status_code=500, detail=f"Invalid short_id length: {len(short_id)}, expected 8")
-            attempt += 1
-        if short_id in existing_short_ids:
-            raise HTTPException(status_code=500, detail="Failed to generate unique short_id")
+        # Проверяем уникальность short_id (индексированный поиск)
+        tried_short_ids = set()
+        short_id = await run_in_threadpool(pick_short_id, tried_short_ids)
         
         # Выбор случайного SNI из доступных ServerNames (будет сохранен и использоваться постоянно)
-        import json
-        with open('/root/vpn-server/config/config.json', 'r') as f:
-            config = json.load(f)
+        config = await run_in_threadpool(load_config)
         # Находим первый vless inbound для получения списка ServerNames
         server_names = []
         for inbound in config.get('inbounds', []):
@@ -401,11 +428,6 @@ async def create_key(request: Request, key_request: CreateKeyRequest, api_key: s
         # Используем фиксированный SNI для всех ключей (iOS и Android совместимость)
         selected_sni = "www.microsoft.com"  # Фиксированный для всех ключей
         
-        # Назначаем порт для ключа
-        assigned_port = assign_port_for_key(key_uuid, str(uuid.uuid4()), key_request.name)
-        if not assigned_port:
-            raise HTTPException(status_code=500, detail="No available ports")
-        
         # Создание нового ключа с индивидуальным short_id и SNI
         new_key = {
             "id": str(uuid.uuid4()),
@@ -413,38 +435,40 @@ async def create_key(request: Request, key_request: CreateKeyRequest, api_key: s
             "uuid": key_uuid,
             "created_at": datetime.now().isoformat(),
             "is_active": True,
-            "port": assigned_port,
             "short_id": short_id,  # Индивидуальный short_id для каждого ключа
             "sni": selected_sni  # Случайно выбранный SNI, который будет использоваться постоянно
         }
         
-        # Сохраняем ключ в хранилище
-        storage.add_key(new_key)
+        # Порт, ключ и история трафика сохраняются одной транзакцией (writer-поток async_storage).
+        # shortId мог занять параллельный запрос (уникальный индекс) - повтор со свежим shortId
+        assigned_port = None
+        for _ in range(SHORT_ID_ATTEMPTS):
+            try:
+                assigned_port = await async_storage.run(create_key_with_port, new_key, write=True)
+                break
+            except sqlite3.IntegrityError as e:
+                if "short_id" not in str(e):
+                    raise
+                tried_short_ids.add(short_id)
+                short_id = await run_in_threadpool(pick_short_id, tried_short_ids)
+                new_key["short_id"] = short_id
+        else:
+            raise HTTPException(status_code=500, detail="Failed to generate unique short_id")
+        if not assigned_port:
+            raise HTTPException(status_code=500, detail="No available ports")
+        new_key["port"] = assigned_port
         key_stored = True
         
         # Добавляем ключ в конфигурацию Xray с индивидуальным short_id
-        if not add_key_to_xray_config(key_uuid, key_request.name, short_id):
+        if not await run_in_threadpool(add_key_to_xray_config, key_uuid, key_request.name, short_id):
             raise HTTPException(status_code=500, detail="Failed to add key to Xray config")
         
+        # Ключ применён в Xray - снимаем аренду порта
+        await async_storage.confirm_port_lease(key_uuid)
+        
         # КРИТИЧЕСКАЯ ПРОВЕРКА: Убеждаемся, что publicKey добавлен в конфигурацию
         try:
-            config = xray_config_manager._load_config()
-            if config:
-                reality_keys = xray_config_manager._load_reality_keys()
-                public_key = reality_keys.get('public_key')
-                if public_key:
-                    for inbound in config.get('inbounds', []):
-                        clients = inbound.get('settings', {}).get('clients', [])
-                        for client in clients:
-                            if client.get('id') == key_uuid:
-                                reality_settings = inbound.get('streamSettings', {}).get('realitySettings', {})
-                                if not reality_settings.get('publicKey'):
-                                    # Исправляем отсутствие publicKey
-                                    reality_settings['publicKey'] = public_key
-                                    xray_config_manager._save_config(config)
-                                    xray_config_manager._apply_inbound_via_api(inbound)
-                                    logger.warning(f"Fixed missing publicKey for key {key_uuid} after creation")
-                                break
+            await run_in_threadpool(ensure_public_key_in_config, key_uuid)
         except Exception as e:
             logger.error(f"Failed to verify publicKey after key creation: {e}")
             # Не прерываем создание, но логируем ошибку
@@ -452,31 +476,20 @@ async def create_key(request: Request, key_request: CreateKeyRequest, api_key: s
         # Проверяем синхронизацию short_id после создания
         try:
             # Перезагружаем ключ из БД для проверки
-            created_key = storage.get_key_by_uuid(key_uuid)
+            created_key = await async_storage.get_key_by_uuid(key_uuid)
             if created_key and created_key.get("short_id") != short_id:
                 print(f"Warning: Short ID mismatch after creation for key {key_uuid}")
                 # Исправляем несоответствие
-                sync_result = sync_short_ids_from_db()
+                sync_result = await run_in_threadpool(sync_short_ids_from_db)
                 if sync_result.get("success") and sync_result.get("fixed_count", 0) > 0:
                     print(f"Fixed {sync_result.get('fixed_count')} short_id mismatch(es)")
         except Exception as e:
             print(f"Warning: Failed to verify short_id sync after key creation: {e}")
         
-        # Инициализируем историю трафика для нового ключа
-        try:
-            traffic_history.update_key_traffic(
-                key_uuid, 
-                key_request.name, 
-                assigned_port, 
-                {"total_bytes": 0, "rx_bytes": 0, "tx_bytes": 0, "connections": 0}
-            )
-        except Exception as e:
-            print(f"Warning: Failed to initialize traffic history for key {key_uuid}: {e}")
-        
         # Проверка корректности сгенерированного URL
         try:
             from generate_client_config import generate_client_config
-            test_url = generate_client_config(key_uuid, key_request.name, assigned_port)
+            test_url = await run_in_threadpool(generate_client_config, key_uuid, key_request.name, assigned_port)
             # Проверяем, что URL содержит все необходимые параметры
             required_params = ['pbk=', 'sid=', 'sni=']
             if not all(param in test_url for param in required_params):
@@ -497,18 +510,13 @@ async def create_key(request: Request, key_request: CreateKeyRequest, api_key: s
         return VPNKey(**new_key)
         
     except HTTPException:
-        if assigned_port:
-            release_port_for_key(key_uuid)
         if key_stored:
-            storage.delete_key_by_uuid(key_uuid)
-            traffic_history.reset_key_traffic(key_uuid)
+            # inbound мог уже попасть в Xray - порт удерживается до reconcile
+            await async_storage.abandon_key(key_uuid)
         raise
     except Exception as e:
-        if assigned_port:
-            release_port_for_key(key_uuid)
         if key_stored:
-            storage.delete_key_by_uuid(key_uuid)
-            traffic_history.reset_key_traffic(key_uuid)
+            await async_storage.abandon_key(key_uuid)
         raise HTTPException(status_code=500, detail=f"Failed to create key: {str(e)}")
 
 @app.delete("/api/keys/{key_id}")
@@ -516,29 +524,18 @@ async def create_key(request: Request, key_request: CreateKeyRequest, api_key: s
 async def delete_key(key_id: str, request: Request, api_key: str = Depends(verify_api_key)):
     """Удалить VPN ключ с освобождением порта"""
     try:
-        # Загрузка ключей
-        keys = load_keys()
-        
         # Поиск ключа (по ID или UUID)
-        key_to_delete = None
-        for key in keys:
-            if key["id"] == key_id or key["uuid"] == key_id:
-                key_to_delete = key
-                break
+        key_to_delete = await async_storage.get_key_by_identifier(key_id)
         
         if not key_to_delete:
             raise HTTPException(status_code=404, detail="Key not found")
         
         # Удаление ключа из конфигурации Xray
-        if not remove_key_from_xray_config(key_to_delete["uuid"]):
+        if not await run_in_threadpool(remove_key_from_xray_config, key_to_delete["uuid"]):
             raise HTTPException(status_code=500, detail="Failed to remove key from Xray config")
         
-        # Освобождение порта
-        if not release_port_for_key(key_to_delete["uuid"]):
-            print(f"Warning: Failed to release port for UUID: {key_to_delete['uuid']}")
-        
-        # Удаление ключа из хранилища
-        storage.delete_key_by_uuid(key_to_delete["uuid"])
+        # Удаление ключа, порта и истории трафика одной транзакцией
+        await async_storage.delete_key_cascade(key_to_delete["uuid"])
         
         return {"message": "Key deleted successfully"}
         
@@ -549,18 +546,47 @@ async def delete_key(key_id: str, request: Request, api_key: str = Depends(verif
 
 @app.get("/api/keys", response_model=List[VPNKey])
 @limiter.limit("30/minute")
-async def list_keys(request: Request, api_key: str = Depends(verify_api_key)):
-    """Получить список всех VPN ключей"""
+async def list_keys(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=KEYS_PAGE_MAX_LIMIT),
+    after: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    name_prefix: Optional[str] = None,
+    api_key: str = Depends(verify_api_key),
+):
+    """
+    Получить список VPN ключей.
+    С limit/after/is_active/name_prefix - keyset-пагинация по (created_at, id),
+    курсор следующей страницы возвращается в заголовке X-Next-Cursor.
+    """
     try:
-        keys = load_keys()
+        if limit is None and after is None and is_active is None and not name_prefix:
+            keys = await async_storage.get_all_keys()
+        else:
+            try:
+                keys, next_cursor = await async_storage.get_keys_page(
+                    limit=limit or KEYS_PAGE_DEFAULT_LIMIT,
+                    after=after,
+                    is_active=is_active,
+                    name_prefix=name_prefix,
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
         
-        # Добавляем информацию о портах для каждого ключа
-        for key in keys:
-            if "port" not in key:
-                port = get_port_for_key(key["uuid"])
-                key["port"] = port
+        # Порт хранится в строке ключа; для ключей без него (порт назначен позже) - один запрос
+        missing = [key["uuid"] for key in keys if key.get("port") is None]
+        if missing:
+            ports = await async_storage.get_ports_for_uuids(missing)
+            for key in keys:
+                if key.get("port") is None:
+                    key["port"] = ports.get(key["uuid"])
         
         return [VPNKey(**key) for key in keys]
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to load keys: {str(e)}")
 
@@ -569,10 +595,9 @@ async def list_keys(request: Request, api_key: str = Depends(verify_api_key)):
 async def get_key(key_id: str, request: Request, api_key: str = Depends(verify_api_key)):
     """Получить информацию о конкретном ключе"""
     try:
-        keys = load_keys()
-        for key in keys:
-            if key["id"] == key_id or key["uuid"] == key_id:
-                return VPNKey(**key)
+        key = await async_storage.get_key_by_identifier(key_id)
+        if key:
+            return VPNKey(**key)
         raise HTTPException(status_code=404, detail="Key not found")
     except HTTPException:
         raise
@@ -583,26 +608,25 @@ async def get_key(key_id: str, request: Request, api_key: str = Depends(verify_a
 async def get_key_config(key_id: str, api_key: str = Depends(verify_api_key)):
     """Получить конфигурацию клиента для ключа"""
     try:
-        keys = load_keys()
-        key = None
-        for k in keys:
-            if k["id"] == key_id or k["uuid"] == key_id:
-                key = k
-                break
+        key = await async_storage.get_key_by_identifier(key_id)
         
         if not key:
             raise HTTPException(status_code=404, detail="Key not found")
         
         # Получение порта для ключа
-        port = get_port_for_key(key["uuid"])
+        port = await async_storage.run(get_port_for_key, key["uuid"])
         
-        # Генерация конфигурации клиента
-        result = subprocess.run([
-            '/root/vpn-server/generate_client_config.py',
-            key["uuid"],
-            key.get("name", "") or "",  # Убеждаемся, что имя передается
-            str(port) if port else "443"
-        ], capture_output=True, text=True, encoding='utf-8', check=True)
+        # Генерация конфигурации клиента (в пуле потоков - не блокирует event loop)
+        result = await run_in_threadpool(
+            subprocess.run,
+            [
+                '/root/vpn-server/generate_client_config.py',
+                key["uuid"],
+                key.get("name", "") or "",  # Убеждаемся, что имя передается
+                str(port) if port else "443"
+            ],
+            capture_output=True, text=True, encoding='utf-8', check=True
+        )
 
         vless_url = result.stdout.strip()
         response = {
@@ -633,27 +657,29 @@ async def get_key_config(key_id: str, api_key: str = Depends(verify_api_key)):
 @app.post("/api/system/sync-config")
 @limiter.limit("3/minute")
 async def sync_xray_config(request: Request, api_key: str = Depends(verify_api_key)):
-    """Принудительная синхронизация конфигурации Xray с SQLite"""
+    """Принудительная синхронизация конфигурации Xray с SQLite (без перезапуска, если не менялись глобальные секции)"""
     try:
-        # Принудительная синхронизация (включая short_id)
-        if not force_sync_xray_config():
-            raise HTTPException(status_code=500, detail="Failed to sync configuration")
-        
-        # Перезапуск Xray
-        if not restart_xray():
+        # Изменения inbounds (включая short_id) применяются через HandlerService с откатом
+        result = await run_in_threadpool(hot_sync_xray_config)
+        if result["path"] == "failed":
+            raise HTTPException(status_code=500, detail=f"Failed to sync configuration: {result['reconcile'].get('errors')}")
+        if result["global_changed"] and result["path"] != "restart":
             raise HTTPException(status_code=500, detail="Failed to restart Xray service")
         
         # Проверка синхронизации
-        if not verify_xray_config():
+        if not await run_in_threadpool(verify_xray_config):
             raise HTTPException(status_code=500, detail="Configuration sync verification failed")
         
         # Валидация синхронизации short_id
-        keys = load_keys()
-        validation = validate_xray_config_sync(keys)
+        keys = await async_storage.get_all_keys()
+        validation = await run_in_threadpool(validate_xray_config_sync, keys)
         
         return {
             "message": "Configuration synchronized successfully",
             "status": "synced",
+            "apply_path": result["path"],
+            "restarted": result["path"] == "restart",
+            "reconcile": result["reconcile"],
             "validation": validation,
             "timestamp": int(time.time())
         }
@@ -666,8 +692,8 @@ async def sync_xray_config(request: Request, api_key: str = Depends(verify_api_k
 async def get_config_status(api_key: str = Depends(verify_api_key)):
     """Получить статус синхронизации конфигурации"""
     try:
-        keys = load_keys()
-        config = load_config()
+        keys = await async_storage.get_all_keys()
+        config = await run_in_threadpool(load_config)
         
         # Получаем UUID из SQLite
         key_uuids = {key["uuid"] for key in keys}
@@ -696,14 +722,20 @@ async def get_config_status(api_key: str = Depends(verify_api_key)):
 async def verify_reality_endpoint(api_key: str = Depends(verify_api_key)):
     """Проверить и обновить настройки Reality"""
     try:
-        if verify_reality_settings():
+        result = await run_in_threadpool(verify_reality_settings)
+        if result:
             return {
                 "message": "Reality settings verified and updated successfully",
                 "status": "verified",
+                "apply_path": result["path"],
+                "restarted": result["path"] == "restart",
+                "reconcile": result["reconcile"],
                 "timestamp": int(time.time())
             }
         else:
             raise HTTPException(status_code=500, detail="Failed to verify Reality settings")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to verify Reality settings: {str(e)}")
 
@@ -713,26 +745,59 @@ async def verify_reality_endpoint(api_key: str = Depends(verify_api_key)):
 async def get_ports_status(api_key: str = Depends(verify_api_key)):
     """Получить статус портов"""
     try:
-        port_assignments = get_all_port_assignments()
-        used_count = port_manager.get_used_ports_count()
-        available_count = port_manager.get_available_ports_count()
+        port_assignments = await run_in_threadpool(get_all_port_assignments)
+        used_count = await async_storage.get_used_ports_count()
+        available_count = await async_storage.count_free_ports()
+        pools = await async_storage.get_port_pools()
+        quarantine = await async_storage.run(port_manager.get_quarantine_stats)
         
         return {
             "port_assignments": port_assignments,
             "used_ports": used_count,
             "available_ports": available_count,
-            "max_ports": 100,
-            "port_range": "10001-10100",
+            "max_ports": pools["capacity"],
+            "port_range": ",".join(f"{start}-{end}" for start, end in pools["ranges"]),
+            "port_pools": pools,
+            "port_quarantine": quarantine,
+            "inbound_mode": port_manager.inbound_mode,
+            "shared_port": port_manager.shared_port if port_manager.shared_mode else None,
             "timestamp": int(time.time())
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get ports status: {str(e)}")
 
+@app.get("/api/system/ports/pools")
+async def get_port_pools(api_key: str = Depends(verify_api_key)):
+    """Получить пулы портов (диапазоны, исключения, ёмкость)"""
+    try:
+        return {
+            "port_pools": await async_storage.get_port_pools(),
+            "timestamp": int(time.time())
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get port pools: {str(e)}")
+
+@app.put("/api/system/ports/pools")
+@limiter.limit("5/minute")
+async def set_port_pools(request: Request, pools_request: PortPoolsRequest, api_key: str = Depends(verify_api_key)):
+    """Заменить пулы портов; свободный список пересобирается"""
+    try:
+        result = await async_storage.set_port_pools(pools_request.ranges, pools_request.exclude)
+        return {
+            "status": "success",
+            "port_pools": result,
+            "timestamp": int(time.time())
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to set port pools: {str(e)}")
+
 @app.post("/api/system/ports/reset")
 async def reset_ports(api_key: str = Depends(verify_api_key)):
     """Сбросить все порты"""
     try:
-        if reset_all_ports():
+        if await async_storage.run(reset_all_ports, write=True):
             return {
                 "message": "All ports reset successfully",
                 "status": "reset",
@@ -747,7 +812,7 @@ async def reset_ports(api_key: str = Depends(verify_api_key)):
 async def get_ports_validation_status(api_key: str = Depends(verify_api_key)):
     """Получить статус валидации портов"""
     try:
-        validation = port_manager.validate_port_assignments()
+        validation = await async_storage.run(port_manager.validate_port_assignments)
         return {
             "validation": validation,
             "timestamp": int(time.time())
@@ -764,9 +829,14 @@ async def get_ports_validation_status(api_key: str = Depends(verify_api_key)):
 async def get_xray_config_status_endpoint(api_key: str = Depends(verify_api_key)):
     """Получить статус конфигурации Xray"""
     try:
-        status = get_xray_config_status()
+        status = await run_in_threadpool(get_xray_config_status)
+        sys_stats = None
+        if XRAY_STATS_AVAILABLE:
+            # GetSysStats по gRPC-каналу: память и uptime процесса Xray
+            sys_stats = await run_in_threadpool(xray_stats_reader.get_sys_stats)
         return {
             "config_status": status,
+            "xray_sys_stats": sys_stats,
             "timestamp": int(time.time())
         }
     except Exception as e:
@@ -777,7 +847,7 @@ async def get_xray_config_status_endpoint(api_key: str = Depends(verify_api_key)
 async def list_xray_inbounds(api_key: str = Depends(verify_api_key)):
     """Список активных VLESS inbound'ов согласно конфигурации"""
     try:
-        config = load_config()
+        config = await run_in_threadpool(load_config)
         inbounds = []
         for inbound in config.get("inbounds", []):
             if inbound.get("protocol") != "vless":
@@ -805,34 +875,52 @@ async def list_xray_inbounds(api_key: str = Depends(verify_api_key)):
 async def sync_xray_config_endpoint(api_key: str = Depends(verify_api_key)):
     """Синхронизировать конфигурацию Xray с ключами"""
     try:
-        keys = load_keys()
-        if update_xray_config_for_keys(keys):
-            # Синхронизируем short_id из БД в конфигурацию
-            sync_result = sync_short_ids_from_db()
-            if not sync_result.get("success"):
-                print(f"Warning: Failed to sync short_ids: {sync_result.get('error')}")
-            
-            # Перезапуск Xray
-            if not restart_xray():
-                raise HTTPException(status_code=500, detail="Failed to restart Xray service")
-            
-            return {
-                "message": "Xray configuration synchronized successfully",
-                "status": "synced",
-                "short_id_sync": sync_result,
-                "timestamp": int(time.time())
-            }
-        else:
-            raise HTTPException(status_code=500, detail="Failed to sync Xray configuration")
+        keys = await async_storage.get_all_keys()
+        # Применяются только изменившиеся inbounds (short_id берутся из БД);
+        # Xray перезапускается, только если изменились глобальные секции
+        result = await run_in_threadpool(hot_apply_xray_config, keys, restart_xray)
+        if result["path"] == "failed":
+            raise HTTPException(status_code=500, detail=f"Failed to sync Xray configuration: {result['reconcile'].get('errors')}")
+        if result["global_changed"] and result["path"] != "restart":
+            raise HTTPException(status_code=500, detail="Failed to restart Xray service")
+        
+        return {
+            "message": "Xray configuration synchronized successfully",
+            "status": "synced",
+            "apply_path": result["path"],
+            "restarted": result["path"] == "restart",
+            "reconcile": result["reconcile"],
+            "timestamp": int(time.time())
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to sync Xray configuration: {str(e)}")
 
+@app.post("/api/system/xray/reconcile")
+@limiter.limit("5/minute")
+async def reconcile_xray_endpoint(request: Request, dry_run: bool = False, api_key: str = Depends(verify_api_key)):
+    """Сверить inbounds Xray с SQLite и применить только изменения (dry_run - только diff)"""
+    try:
+        keys = await async_storage.get_all_keys()
+        report = await run_in_threadpool(reconcile_xray_inbounds, keys, dry_run)
+        if not dry_run and not report.get("applied"):
+            raise HTTPException(status_code=500, detail=f"Failed to reconcile Xray inbounds: {report.get('errors')}")
+        return {
+            "reconcile": report,
+            "timestamp": int(time.time())
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to reconcile Xray inbounds: {str(e)}")
+
 @app.get("/api/system/xray/validate-sync")
 async def validate_xray_config_sync_endpoint(api_key: str = Depends(verify_api_key)):
     """Валидировать синхронизацию конфигурации Xray"""
     try:
-        keys = load_keys()
-        validation = validate_xray_config_sync(keys)
+        keys = await async_storage.get_all_keys()
+        validation = await run_in_threadpool(validate_xray_config_sync, keys)
         return {
             "validation": validation,
             "timestamp": int(time.time())
@@ -844,26 +932,97 @@ async def validate_xray_config_sync_endpoint(api_key: str = Depends(verify_api_k
 async def fix_reality_keys(api_key: str = Depends(verify_api_key)):
     """Исправление Reality ключей в конфигурации Xray"""
     try:
-        if fix_reality_keys_in_xray_config():
-            if restart_xray():
-                return {
-                    "status": "fixed",
-                    "message": "Reality keys fixed successfully",
-                    "timestamp": int(time.time())
-                }
-            else:
-                return {
-                    "status": "error",
-                    "message": "Failed to restart Xray service"
-                }
-        else:
+        # Эталонные inbounds (privateKey, short_id из БД, fingerprint, spiderX) применяются
+        # через HandlerService - только изменившиеся, с откатом при ошибке
+        result = await run_in_threadpool(hot_sync_xray_config)
+        if result["path"] == "failed":
+            return {
+                "status": "error",
+                "message": "Failed to fix Reality keys",
+                "apply_path": result["path"],
+                "errors": result["reconcile"].get("errors")
+            }
+        if result["global_changed"] and result["path"] != "restart":
             return {
                 "status": "error",
-                "message": "Failed to fix Reality keys"
+                "message": "Failed to restart Xray service",
+                "apply_path": result["path"]
             }
+        return {
+            "status": "fixed",
+            "message": "Reality keys fixed successfully",
+            "apply_path": result["path"],
+            "restarted": result["path"] == "restart",
+            "reconcile": result["reconcile"],
+            "timestamp": int(time.time())
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ===== ЭНДПОИНТЫ БАЗЫ ДАННЫХ =====
+
+@app.post("/api/system/db/backup")
+@limiter.limit("2/minute")
+async def backup_database(request: Request, api_key: str = Depends(verify_api_key)):
+    """Онлайн-бэкап SQLite (VACUUM INTO + quick_check на копии)"""
+    try:
+        backup_path = os.path.join(
+            DB_BACKUP_DIR, f"vpn-db-{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+        )
+        result = await run_in_threadpool(storage.backup_to, backup_path)
+        return {
+            "status": "success",
+            "backup": result,
+            "timestamp": int(time.time())
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to backup database: {str(e)}")
+
+@app.get("/api/system/db/metrics")
+async def get_database_metrics(
+    reset: bool = False,
+    api_key: str = Depends(verify_api_key),
+):
+    """Латентность методов storage и SQL-выражений, ожидание блокировок (текущий воркер)"""
+    try:
+        metrics = await async_storage.get_metrics()
+        if reset:
+            await async_storage.reset_metrics()
+        return {
+            "status": "success",
+            "metrics": metrics,
+            "timestamp": int(time.time())
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get database metrics: {str(e)}")
+
+@app.get("/api/system/db/maintenance")
+async def get_database_maintenance(api_key: str = Depends(verify_api_key)):
+    """Размер WAL/freelist, пороги и отчёт последнего обслуживания БД"""
+    try:
+        status = await run_in_threadpool(StorageMaintenance(storage).status)
+        return {
+            "status": "success",
+            "maintenance": status,
+            "timestamp": int(time.time())
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get maintenance status: {str(e)}")
+
+@app.post("/api/system/db/maintenance")
+@limiter.limit("2/minute")
+async def run_database_maintenance(request: Request, api_key: str = Depends(verify_api_key)):
+    """Checkpoint WAL, PRAGMA optimize и incremental vacuum"""
+    try:
+        report = await run_in_threadpool(StorageMaintenance(storage).run)
+        return {
+            "status": "success" if not report["errors"] else "partial",
+            "maintenance": report,
+            "timestamp": int(time.time())
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to run maintenance: {str(e)}")
+
 # ===== ЭНДПОИНТЫ ТРАФИКА =====
 
 @app.get("/api/keys/{key_id}/traffic")
@@ -871,31 +1030,32 @@ async def get_key_traffic(key_id: str, api_key: str = Depends(verify_api_key)):
     """Получить накопительный трафик для конкретного ключа"""
     try:
         # Находим ключ по key_id
-        keys = load_keys()
-        key = next((k for k in keys if k["id"] == key_id), None)
+        key = await async_storage.get_key_by_id(key_id)
         
         if not key:
             raise HTTPException(status_code=404, detail="Key not found")
         
         # Обновляем историю на основе данных из Xray Stats API перед возвратом
         if XRAY_STATS_AVAILABLE:
-            traffic_history.update_key_traffic(
+            await run_in_threadpool(
+                traffic_history.update_key_traffic,
                 key["uuid"], 
                 key["name"], 
                 key.get("port", 0)
             )
         
         # Получаем накопительный трафик ключа
-        result = traffic_history.get_key_total_traffic(key["uuid"])
+        result = await run_in_threadpool(traffic_history.get_key_total_traffic, key["uuid"])
         
         if not result:
             # Если записи нет, создаем пустую
-            traffic_history.update_key_traffic(
+            await run_in_threadpool(
+                traffic_history.update_key_traffic,
                 key["uuid"], 
                 key["name"], 
                 key.get("port", 0)
             )
-            result = traffic_history.get_key_total_traffic(key["uuid"])
+            result = await run_in_threadpool(traffic_history.get_key_total_traffic, key["uuid"])
         
         return {
             "status": "success",
@@ -914,14 +1074,13 @@ async def reset_key_traffic(key_id: str, api_key: str = Depends(verify_api_key))
     """Обнулить накопительный трафик для конкретного ключа"""
     try:
         # Находим ключ по key_id
-        keys = load_keys()
-        key = next((k for k in keys if k["id"] == key_id), None)
+        key = await async_storage.get_key_by_id(key_id)
         
         if not key:
             raise HTTPException(status_code=404, detail="Key not found")
         
         # Обнуляем накопительный трафик
-        success = traffic_history.reset_key_traffic(key["uuid"])
+        success = await async_storage.run(traffic_history.reset_key_traffic, key["uuid"], write=True)
         
         if not success:
             raise HTTPException(status_code=404, detail="Traffic history not found for this key")
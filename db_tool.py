@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Обслуживание базы data/vpn.db.
+Запуск: python3 db_tool.py backup [--output PATH] [--timeout SEC] [--no-compress]
+        python3 db_tool.py maintenance [--checkpoint MODE] [--no-vacuum] [--status]
+        python3 db_tool.py export [--output PATH] [--tables T ...]
+        python3 db_tool.py import PATH [--replace] [--batch N]
+        python3 db_tool.py port-pools [--range START-END ...] [--exclude PORT ...]
+        python3 db_tool.py short-id-index
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+# Добавляем путь к модулям
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from storage.maintenance import StorageMaintenance
+from storage.sqlite_storage import BACKUP_TIMEOUT, DB_BACKUP_DIR, NDJSON_TABLES, storage
+
+
+def cmd_backup(args) -> int:
+    output = args.output or os.path.join(
+        DB_BACKUP_DIR, f"vpn-db-{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+    )
+    result = storage.backup_to(
+        output,
+        timeout=args.timeout,
+        compress=not args.no_compress,
+    )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+def _open_text(path: str, mode: str):
+    # "-" - stdin/stdout, *.gz - gzip
+    if path == "-":
+        return sys.stdout if "w" in mode else sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _progress(table: str, rows: int):
+    print(f"  {table}: {rows}", file=sys.stderr)
+
+
+def cmd_export(args) -> int:
+    output = args.output or os.path.join(
+        DB_BACKUP_DIR, f"vpn-db-{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson.gz"
+    )
+    if output != "-":
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    started = time.monotonic()
+    fh = _open_text(output, "w")
+    try:
+        counts = storage.export_ndjson(fh, tables=args.tables, progress=_progress)
+    finally:
+        if fh is not sys.stdout:
+            fh.close()
+    result = {
+        "path": output,
+        "rows": counts,
+        "duration_ms": round((time.monotonic() - started) * 1000, 1),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2), file=sys.stderr)
+    return 0
+
+
+def cmd_import(args) -> int:
+    started = time.monotonic()
+    fh = _open_text(args.path, "r")
+    try:
+        counts = storage.import_ndjson(
+            fh, replace=args.replace, batch_size=args.batch, progress=_progress
+        )
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+    result = {
+        "path": args.path,
+        "rows": counts,
+        "duration_ms": round((time.monotonic() - started) * 1000, 1),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+def _parse_range(value: str):
+    try:
+        start, end = value.split("-", 1)
+        return int(start), int(end)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Ожидается START-END, получено: {value}")
+
+
+def cmd_port_pools(args) -> int:
+    if args.range:
+        result = storage.set_port_pools(args.range, args.exclude or [])
+    else:
+        result = storage.get_port_pools()
+    result["free_ports"] = storage.count_free_ports()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+def cmd_maintenance(args) -> int:
+    maintenance = StorageMaintenance(storage)
+    if args.status:
+        print(json.dumps(maintenance.status(), ensure_ascii=False, indent=2))
+        return 0
+    report = maintenance.run(checkpoint_mode=args.checkpoint, vacuum=not args.no_vacuum)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 1 if report["errors"] else 0
+
+
+def cmd_short_id_index(args) -> int:
+    result = storage.ensure_short_id_index()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0 if result["unique"] else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Обслуживание базы VPN сервера")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backup = subparsers.add_parser("backup", help="Онлайн-бэкап БД (VACUUM INTO)")
+    backup.add_argument("--output", help=f"Путь снимка (по умолчанию {DB_BACKUP_DIR}/vpn-db-<timestamp>.db.gz)")
+    backup.add_argument("--timeout", type=float, default=BACKUP_TIMEOUT, help="Предел длительности бэкапа, секунды")
+    backup.add_argument("--no-compress", action="store_true", help="Не сжимать снимок gzip")
+    backup.set_defaults(func=cmd_backup)
+
+    maintenance = subparsers.add_parser(
+        "maintenance", help="Checkpoint WAL, PRAGMA optimize, incremental vacuum"
+    )
+    maintenance.add_argument(
+        "--checkpoint",
+        choices=["PASSIVE", "FULL", "RESTART", "TRUNCATE"],
+        help="Режим checkpoint (по умолчанию - по порогам размера WAL)",
+    )
+    maintenance.add_argument("--no-vacuum", action="store_true", help="Не выполнять vacuum")
+    maintenance.add_argument("--status", action="store_true", help="Только показать состояние БД")
+    maintenance.set_defaults(func=cmd_maintenance)
+
+    export = subparsers.add_parser("export", help="Потоковый экспорт таблиц в NDJSON")
+    export.add_argument(
+        "--output",
+        help=f"Файл (*.gz - сжатие, - - stdout; по умолчанию {DB_BACKUP_DIR}/vpn-db-<timestamp>.ndjson.gz)",
+    )
+    export.add_argument(
+        "--tables",
+        nargs="+",
+        choices=list(NDJSON_TABLES),
+        help="Таблицы для экспорта (по умолчанию все)",
+    )
+    export.set_defaults(func=cmd_export)
+
+    import_parser = subparsers.add_parser("import", help="Импорт NDJSON одной транзакцией")
+    import_parser.add_argument("path", help="Файл NDJSON (*.gz - сжатый, - - stdin)")
+    import_parser.add_argument(
+        "--replace", action="store_true", help="Перезаписывать строки с совпадающим ключом"
+    )
+    import_parser.add_argument("--batch", type=int, default=500, help="Строк на один executemany")
+    import_parser.set_defaults(func=cmd_import)
+
+    pools = subparsers.add_parser(
+        "port-pools", help="Показать или заменить пулы портов (без --range - показать)"
+    )
+    pools.add_argument(
+        "--range", action="append", type=_parse_range, help="Диапазон START-END (можно несколько)"
+    )
+    pools.add_argument("--exclude", nargs="+", type=int, help="Исключённые порты")
+    pools.set_defaults(func=cmd_port_pools)
+
+    short_ids = subparsers.add_parser(
+        "short-id-index",
+        help="Создать уникальный индекс short_id (без него - показать повторяющиеся short_id)",
+    )
+    short_ids.set_defaults(func=cmd_short_id_index)
+
+    return parser
+
+
+def main() -> int:
+    args = build_parser().parse_args()
+    try:
+        return args.func(args)
+    except Exception as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
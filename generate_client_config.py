@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
-import json
 import sys
 import os
 
+from xray_config_model import get_config_model
+
 def generate_client_config(key_uuid, key_name, port=None):
     """Генерация конфигурации клиента для VLESS+Reality"""
     
-    # Загрузка конфигурации сервера
-    with open('/root/vpn-server/config/config.json', 'r') as f:
-        server_config = json.load(f)
+    # Загрузка конфигурации сервера (из модели в памяти, файл перечитывается при изменении)
+    server_config = get_config_model('/root/vpn-server/config/config.json').load()
+    if server_config is None:
+        raise FileNotFoundError('/root/vpn-server/config/config.json')
     
     # Поиск правильного inbound для данного ключа
     vless_inbound = None
@@ -47,12 +49,16 @@ def generate_client_config(key_uuid, key_name, port=None):
     # Используем SNI из БД, если он сохранен (выбирался случайно при создании ключа)
     # Если SNI нет в БД (старые ключи), используем первый из списка как fallback
     from storage.sqlite_storage import storage
-    key_from_db = None
-    keys = storage.get_all_keys()
-    for k in keys:
-        if k.get('uuid') == key_uuid:
-            key_from_db = k
-            break
+    key_from_db = storage.get_key_by_uuid(key_uuid)
+    
+    # В общем inbound (XRAY_INBOUND_MODE=shared) shortIds содержит id всех клиентов -
+    # берём shortId ключа из БД, если он есть в списке
+    db_short_id = (key_from_db or {}).get('short_id')
+    if db_short_id:
+        for candidate in (db_short_id, db_short_id[:8]):
+            if candidate in short_ids:
+                short_id = candidate
+                break
     
     # Используем фиксированный SNI для всех ключей (iOS и Android совместимость)
     sni = "www.microsoft.com"  # Фиксированный для всех
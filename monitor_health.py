@@ -18,6 +18,7 @@ import psutil
 # Добавляем путь к проекту для импорта storage
 sys.path.insert(0, '/root/vpn-server')
 from storage import sqlite_storage
+from port_manager import get_listening_ports
 
 # Настройка логирования
 logging.basicConfig(
@@ -142,23 +143,19 @@ def check_xray():
 def check_ports():
     """Проверка открытых портов VPN"""
     try:
-        result = subprocess.run(['ss', '-tuln'], capture_output=True, text=True, timeout=10)
+        listening = get_listening_ports()
         
-        # Получаем количество активных ключей из SQLite
+        # Назначенные порты активных ключей из SQLite (пулы портов настраиваются)
         try:
             all_keys = sqlite_storage.storage.get_all_keys()
-            expected_ports = len([k for k in all_keys if k.get('is_active', True)])
+            expected = {k['port'] for k in all_keys if k.get('is_active', True) and k.get('port')}
         except Exception as e:
-            logger.error(f"Failed to get keys count from SQLite: {e}")
-            expected_ports = 0
+            logger.error(f"Failed to get keys from SQLite: {e}")
+            expected = set()
+        expected_ports = len(expected)
         
-        # Считаем открытые VPN порты
-        vpn_ports_count = 0
-        for line in result.stdout.split('\n'):
-            for port in range(10001, 10101):
-                if f':{port}' in line and 'LISTEN' in line:
-                    vpn_ports_count += 1
-                    break
+        # Считаем открытые VPN порты (точное совпадение номера порта)
+        vpn_ports_count = len(expected & listening)
         
         # 90% портов должны быть открыты (минимально 1 если есть ключи)
         if expected_ports == 0:
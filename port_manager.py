@@ -3,63 +3,170 @@
 SQLite-backed port management with legacy JSON syncing.
 """
 
+import logging
+import os
 import subprocess
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Set
 
 from storage.sqlite_storage import storage
 
+logger = logging.getLogger(__name__)
+
+# Срок аренды порта при создании ключа: если create не дошёл до confirm_port_lease
+# (падение воркера между записью в БД и применением в Xray), ключ и порт освобождаются
+PORT_LEASE_TTL = int(os.getenv("VPN_PORT_LEASE_TTL", "120"))
+
+# Карантин освобождённых портов: порт, освобождённый менее N секунд назад, считается
+# в карантине (старые клиенты ещё могут переподключаться); выдаётся последним
+PORT_QUARANTINE_SECONDS = int(os.getenv("VPN_PORT_QUARANTINE_SECONDS", "3600"))
+
+# Режим inbound'ов Xray: per_key - отдельный inbound и порт на ключ,
+# shared - все ключи клиентами одного inbound на XRAY_SHARED_INBOUND_PORT
+INBOUND_MODE_PER_KEY = "per_key"
+INBOUND_MODE_SHARED = "shared"
+XRAY_INBOUND_MODE = os.getenv("XRAY_INBOUND_MODE", INBOUND_MODE_PER_KEY).strip().lower()
+if XRAY_INBOUND_MODE not in (INBOUND_MODE_PER_KEY, INBOUND_MODE_SHARED):
+    logger.warning("Unknown XRAY_INBOUND_MODE=%r, using %s", XRAY_INBOUND_MODE, INBOUND_MODE_PER_KEY)
+    XRAY_INBOUND_MODE = INBOUND_MODE_PER_KEY
+SHARED_INBOUND_TAG = "inbound-shared"
+SHARED_INBOUND_PORT = int(os.getenv("XRAY_SHARED_INBOUND_PORT", "10001"))
+SHARED_INBOUND_MAX_CLIENTS = int(os.getenv("XRAY_SHARED_MAX_CLIENTS", "1000"))
+
+# Таблицы сокетов ядра: локальный адрес - второе поле, состояние - четвёртое
+PROC_NET_TABLES = ("/proc/net/tcp", "/proc/net/tcp6", "/proc/net/udp", "/proc/net/udp6")
+TCP_LISTEN_STATE = "0A"
+
+
+def _read_proc_ports() -> Optional[Set[int]]:
+    """Порты, занятые слушающими TCP и UDP сокетами; None - если /proc недоступен."""
+    ports: Set[int] = set()
+    found = False
+    for path in PROC_NET_TABLES:
+        try:
+            with open(path, "r") as fh:
+                next(fh, None)  # заголовок
+                is_tcp = "tcp" in os.path.basename(path)
+                for line in fh:
+                    fields = line.split()
+                    if len(fields) < 4:
+                        continue
+                    if is_tcp and fields[3] != TCP_LISTEN_STATE:
+                        continue
+                    ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+            found = True
+        except (OSError, ValueError, IndexError):
+            continue
+    return ports if found else None
+
+
+def get_listening_ports() -> Set[int]:
+    """Снимок портов, занятых в ОС: /proc/net, при недоступности - один вызов ss"""
+    ports = _read_proc_ports()
+    if ports is None:
+        ports = _read_ss_ports()
+    return ports
+
+
+def _read_ss_ports() -> Set[int]:
+    """Один вызов ss; порт берётся из колонки Local Address:Port (точное совпадение)."""
+    result = subprocess.run(
+        ['/usr/bin/ss', '-Htuln'],
+        capture_output=True, text=True, timeout=10
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or "ss failed")
+    ports: Set[int] = set()
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) < 5:
+            continue
+        port = fields[4].rsplit(":", 1)[-1]
+        if port.isdigit():
+            ports.add(int(port))
+    return ports
+
 
 class PortManager:
-    def __init__(self):
-        self.port_range_start = 10001
-        self.port_range_end = 10100
-        self.max_ports = self.port_range_end - self.port_range_start + 1  # 100 портов (10001-10100)
+    """
+    Пулы портов (диапазоны и исключения) хранятся в metadata SQLite.
+    В режиме shared все ключи получают порт общего inbound, пулы не используются.
+    """
     
-    def _check_port_availability(self, port: int) -> bool:
-        """Проверка доступности порта"""
+    def __init__(self, inbound_mode: str = XRAY_INBOUND_MODE, shared_port: int = SHARED_INBOUND_PORT):
+        self.inbound_mode = inbound_mode
+        self.shared_port = shared_port
+    
+    @property
+    def shared_mode(self) -> bool:
+        return self.inbound_mode == INBOUND_MODE_SHARED
+    
+    @property
+    def max_ports(self) -> int:
+        """Ёмкость пулов портов (в режиме shared - лимит клиентов общего inbound)"""
+        if self.shared_mode:
+            return SHARED_INBOUND_MAX_CLIENTS
+        return storage.get_port_capacity()
+    
+    def get_pools(self) -> Dict:
+        """Диапазоны, исключения и ёмкость пулов"""
+        return storage.get_port_pools()
+    
+    def set_pools(self, ranges, exclude=()) -> Dict:
+        """Замена пулов портов (свободный список пересобирается)"""
+        return storage.set_port_pools(ranges, exclude)
+    
+    def _occupied_ports(self) -> Set[int]:
+        """Снимок портов, занятых в ОС (один раз на выделение)"""
         try:
-            # Проверяем, что порт не используется другими процессами
-            result = subprocess.run(
-                ['/usr/bin/ss', '-tuln'],
-                capture_output=True, text=True, timeout=10
-            )
-            
-            if result.returncode == 0:
-                # Ищем порт в выводе
-                for line in result.stdout.split('\n'):
-                    if f':{port}' in line:
-                        return False  # Порт занят
-                return True  # Порт свободен
-            else:
-                print(f"Error running ss command: {result.stderr}")
-                return True  # В случае ошибки считаем порт свободным
+            return get_listening_ports()
         except Exception as e:
-            print(f"Error checking port availability: {e}")
-            return True  # В случае ошибки считаем порт свободным
+            print(f"Error reading socket table: {e}")
+            return set()  # В случае ошибки полагаемся только на SQLite
+    
+    def _check_port_availability(self, port: int) -> bool:
+        """Проверка доступности порта"""
+        return port not in self._occupied_ports()
     
     def get_available_port(self) -> Optional[int]:
-        """Получение свободного порта"""
-        used_ports = set(storage.get_used_ports().keys())
-        
-        # Если это первый ключ, используем порт 10001 (443 занят Nginx)
-        if len(used_ports) == 0:
-            if self._check_port_availability(10001):
-                return 10001
-        
-        # Ищем первый свободный порт в диапазоне 10001-10100
-        for port in range(self.port_range_start, self.port_range_end + 1):
-            if port not in used_ports and self._check_port_availability(port):
-                return port
-        
-        return None
+        """Получение свободного порта (без резервирования)"""
+        return storage.peek_free_port(self._occupied_ports())
+    
+    def get_available_ports(self, count: int) -> List[int]:
+        """Первые count свободных портов (без резервирования) - для плана reconcile"""
+        return storage.peek_free_ports(count, self._occupied_ports())
+    
+    def assign_specific_port(self, uuid: str, key_id: str, key_name: str, port: int) -> bool:
+        """Назначение выбранного порта; False - если его уже занял другой ключ"""
+        return storage.add_port_assignment(uuid, key_id, key_name, port)
     
     def assign_port(self, uuid: str, key_id: str, key_name: str) -> Optional[int]:
         """Назначение порта для ключа"""
-        port = self.get_available_port()
-        if not port:
-            return None
-        storage.add_port_assignment(uuid, key_id, key_name, port)
-        return port
+        return storage.claim_port_assignment(
+            uuid, key_id, key_name, exclude_ports=self._occupied_ports()
+        )
+    
+    def create_key_with_port(self, key: Dict, lease_ttl: Optional[int] = PORT_LEASE_TTL) -> Optional[int]:
+        """
+        Создание ключа вместе с портом одной транзакцией.
+        Порт берётся из free_ports в той же транзакции - гонки между воркерами нет.
+        Порт арендуется на lease_ttl секунд до confirm_lease.
+        В режиме shared порт не назначается - возвращается порт общего inbound,
+        на lease_ttl арендуется сам ключ.
+        """
+        if self.shared_mode:
+            storage.create_key({**key, "port": self.shared_port}, lease_ttl=lease_ttl)
+            return self.shared_port
+        return storage.create_key_with_port(
+            key, exclude_ports=self._occupied_ports(), lease_ttl=lease_ttl
+        )
+    
+    def confirm_lease(self, uuid: str) -> bool:
+        """Подтверждение аренды порта после успешного применения в Xray"""
+        return storage.confirm_port_lease(uuid)
+    
+    def reclaim_expired_leases(self):
+        """Освобождение портов недосозданных ключей с истёкшей арендой"""
+        return storage.reclaim_expired_leases()
     
     def release_port(self, uuid: str) -> bool:
         """Освобождение порта"""
@@ -67,6 +174,8 @@ class PortManager:
     
     def get_port_for_uuid(self, uuid: str) -> Optional[int]:
         """Получение порта для UUID"""
+        if self.shared_mode:
+            return self.shared_port
         return storage.get_port_for_uuid(uuid)
     
     def get_uuid_for_port(self, port: int) -> Optional[str]:
@@ -84,9 +193,13 @@ class PortManager:
         """Получение количества использованных портов"""
         return storage.get_used_ports_count()
     
+    def get_quarantine_stats(self) -> Dict:
+        """Очередь карантина освобождённых портов"""
+        return storage.get_port_quarantine_stats(PORT_QUARANTINE_SECONDS)
+    
     def get_available_ports_count(self) -> int:
         """Получение количества свободных портов"""
-        return self.max_ports - self.get_used_ports_count()
+        return storage.count_free_ports()
     
     def reset_all_ports(self) -> bool:
         """Сброс всех портов"""
@@ -123,6 +236,10 @@ def assign_port_for_key(uuid: str, key_id: str, key_name: str) -> Optional[int]:
     """Назначение порта для ключа"""
     return port_manager.assign_port(uuid, key_id, key_name)
 
+def create_key_with_port(key: Dict) -> Optional[int]:
+    """Создание ключа с назначением порта (одна транзакция)"""
+    return port_manager.create_key_with_port(key)
+
 def release_port_for_key(uuid: str) -> bool:
     """Освобождение порта для ключа"""
     return port_manager.release_port(uuid)
@@ -23,21 +23,18 @@ cd "$PROJECT_ROOT"
 
 log "Создание локального архива $ARCHIVE_PATH"
 
-# Проверка целостности базы перед бэкапом
+# Консистентный снимок живой базы (VACUUM INTO, quick_check выполняется на копии)
+DB_SNAPSHOT=""
 if [[ -f "$PROJECT_ROOT/data/vpn.db" ]]; then
-    if command -v sqlite3 >/dev/null 2>&1; then
-        log "Проверка целостности data/vpn.db"
-        if ! sqlite3 "$PROJECT_ROOT/data/vpn.db" "PRAGMA integrity_check;" | grep -qx "ok"; then
-            log "ERROR: integrity_check не прошёл, прерываю бэкап"
-            exit 1
-        fi
-    else
-        log "WARN: sqlite3 не найден, пропускаю проверку целостности базы"
+    DB_SNAPSHOT="data/backups/vpn-db-$(date +%Y%m%d_%H%M%S).db.gz"
+    log "Снимок data/vpn.db -> $DB_SNAPSHOT"
+    if ! "${PYTHON_BIN:-python3}" "$PROJECT_ROOT/db_tool.py" backup --output "$PROJECT_ROOT/$DB_SNAPSHOT" >> "$LOG_FILE" 2>&1; then
+        log "ERROR: снимок базы не создан или не прошёл quick_check, прерываю бэкап"
+        exit 1
     fi
 fi
 
 declare -a INCLUDE_PATHS=(
-    "data/vpn.db"
     "config/keys.env"
     ".env"
     "systemd/xray.service"
@@ -46,6 +43,9 @@ declare -a INCLUDE_PATHS=(
     "sync_inbounds.py"
     "nginx"
 )
+if [[ -n "$DB_SNAPSHOT" ]]; then
+    INCLUDE_PATHS=("$DB_SNAPSHOT" "${INCLUDE_PATHS[@]}")
+fi
 
 declare -a EXISTING_PATHS=()
 for path in "${INCLUDE_PATHS[@]}"; do
@@ -63,6 +63,11 @@ fi
 
 tar czf "$ARCHIVE_PATH" "${EXISTING_PATHS[@]}"
 
+# Снимок базы уже в архиве - отдельную копию не храним
+if [[ -n "$DB_SNAPSHOT" ]]; then
+    rm -f "$DB_SNAPSHOT"
+fi
+
 log "Архив создан: $ARCHIVE_PATH"
 
 # Опциональная выгрузка в S3
@@ -44,6 +44,16 @@ mkdir -p "$VPN_DIR/config/backups/"
 chown root:vpnapi "$VPN_DIR/config/backups/"
 chmod 775 "$VPN_DIR/config/backups/"
 
+# 4.0. Хранилище бэкапов config.json и блокировки - общие для vpn-api (vpnapi) и sync_inbounds.py (root)
+echo "4.0. Установка прав на config/backups/xray-config/ и файлы блокировок..."
+mkdir -p "$VPN_DIR/config/backups/xray-config/objects"
+chown -R root:vpnapi "$VPN_DIR/config/backups/xray-config/"
+find "$VPN_DIR/config/backups/xray-config/" -type d -exec chmod 2775 {} +
+find "$VPN_DIR/config/backups/xray-config/" -type f -exec chmod 664 {} +
+touch "$VPN_DIR/config/backups/xray-config/.lock" "$VPN_DIR/config/.config.lock"
+chown root:vpnapi "$VPN_DIR/config/backups/xray-config/.lock" "$VPN_DIR/config/.config.lock"
+chmod 664 "$VPN_DIR/config/backups/xray-config/.lock" "$VPN_DIR/config/.config.lock"
+
 # 4.1. config/keys.env - должен быть доступен для чтения vpnapi
 echo "4.1. Установка прав на config/keys.env..."
 if [ -f "$VPN_DIR/config/keys.env" ]; then
@@ -69,5 +79,6 @@ ls -lad "$VPN_DIR/logs/"
 ls -lad "$VPN_DIR/config/"
 ls -la "$VPN_DIR/config/config.json"
 ls -lad "$VPN_DIR/config/backups/"
+ls -lad "$VPN_DIR/config/backups/xray-config/"
 ls -lad "$VPN_DIR/data/"
 ls -la "$VPN_DIR/data/vpn.db"
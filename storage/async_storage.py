@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Асинхронный фасад над SQLiteStorage для обработчиков FastAPI.
+Методы SQLiteStorage возвращают awaitable и выполняются в выделенных пулах:
+записи - в одном writer-потоке, чтения - в VPN_DB_READER_THREADS потоках
+(у каждого своё read-only соединение из пула SQLiteStorage).
+Пока идёт запись, чтения не ждут ни event loop, ни writer-поток.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from storage.sqlite_storage import storage as default_storage
+
+DEFAULT_READER_THREADS = 4
+
+# Методы, которые открывают транзакцию записи (BEGIN IMMEDIATE) или
+# работают с writer-соединением; остальные публичные методы - чтения
+WRITE_METHODS = frozenset(
+    {
+        "add_key",
+        "delete_key_by_uuid",
+        "update_key_fields",
+        "create_key",
+        "create_key_with_port",
+        "delete_key_cascade",
+        "abandon_key",
+        "add_port_assignment",
+        "claim_port_assignment",
+        "confirm_port_lease",
+        "reclaim_expired_leases",
+        "release_orphaned_ports",
+        "set_port_pools",
+        "release_port_assignment",
+        "reset_ports",
+        "save_traffic_history_entry",
+        "save_traffic_history_entries",
+        "reset_traffic_history_entry",
+        "prune_traffic_buckets",
+        "set_metadata",
+        "wal_checkpoint",
+        "optimize",
+        "enable_incremental_vacuum",
+        "ensure_short_id_index",
+        "incremental_vacuum",
+    }
+)
+
+
+class AsyncSQLiteStorage:
+    def __init__(self, storage=None, reader_threads: Optional[int] = None):
+        self._storage = storage if storage is not None else default_storage
+        if reader_threads is None:
+            reader_threads = int(os.getenv("VPN_DB_READER_THREADS", DEFAULT_READER_THREADS))
+        self.reader_threads = max(1, reader_threads)
+        self._guard = threading.Lock()
+        self._pid: Optional[int] = None
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._readers: Optional[ThreadPoolExecutor] = None
+
+    def _executors(self):
+        # Пулы создаются при первом вызове (и заново после fork)
+        if self._pid != os.getpid():
+            with self._guard:
+                if self._pid != os.getpid():
+                    self._writer = ThreadPoolExecutor(
+                        max_workers=1, thread_name_prefix="sqlite-writer"
+                    )
+                    self._readers = ThreadPoolExecutor(
+                        max_workers=self.reader_threads, thread_name_prefix="sqlite-reader"
+                    )
+                    self._pid = os.getpid()
+        return self._writer, self._readers
+
+    async def run(self, func, *args, write: bool = False, **kwargs) -> Any:
+        """Выполнить произвольную функцию над storage в writer- или reader-пуле."""
+        writer, readers = self._executors()
+        executor = writer if write else readers
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        attr = getattr(self._storage, name)
+        if not callable(attr):
+            return attr
+        write = name in WRITE_METHODS
+
+        async def call(*args, **kwargs):
+            return await self.run(attr, *args, write=write, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = getattr(attr, "__doc__", None)
+        return call
+
+    def shutdown(self, wait: bool = True):
+        with self._guard:
+            for executor in (self._writer, self._readers):
+                if executor is not None:
+                    executor.shutdown(wait=wait)
+            self._writer = self._readers = None
+            self._pid = None
+
+
+async_storage = AsyncSQLiteStorage()
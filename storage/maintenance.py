@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Обслуживание data/vpn.db: checkpoint WAL по порогам размера, PRAGMA optimize,
+incremental vacuum и отложенный уникальный индекс short_id. Запускается из update_traffic_stats.py (systemd timer),
+`db_tool.py maintenance` и POST /api/system/db/maintenance.
+"""
+
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Пороги размера vpn.db-wal: выше PASSIVE - неблокирующий checkpoint,
+# выше TRUNCATE - checkpoint с ожиданием читателей и обрезкой файла
+DEFAULT_WAL_PASSIVE_BYTES = 4 * 1024 * 1024
+DEFAULT_WAL_TRUNCATE_BYTES = 64 * 1024 * 1024
+# Incremental vacuum запускается, когда во freelist накопилось столько страниц
+DEFAULT_VACUUM_FREELIST_PAGES = 1024
+DEFAULT_VACUUM_STEP_PAGES = 4096
+
+MAINTENANCE_REPORT_KEY = "maintenance_last_run"
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        logger.warning("Invalid %s value, using default %s", name, default)
+        return default
+
+
+class StorageMaintenance:
+    def __init__(
+        self,
+        storage=None,
+        wal_passive_bytes: Optional[int] = None,
+        wal_truncate_bytes: Optional[int] = None,
+        vacuum_freelist_pages: Optional[int] = None,
+        vacuum_step_pages: Optional[int] = None,
+    ):
+        if storage is None:
+            from storage.sqlite_storage import storage as default_storage
+            storage = default_storage
+        self.storage = storage
+        self.wal_passive_bytes = (
+            wal_passive_bytes
+            if wal_passive_bytes is not None
+            else _env_int("VPN_DB_WAL_CHECKPOINT_BYTES", DEFAULT_WAL_PASSIVE_BYTES)
+        )
+        self.wal_truncate_bytes = (
+            wal_truncate_bytes
+            if wal_truncate_bytes is not None
+            else _env_int("VPN_DB_WAL_TRUNCATE_BYTES", DEFAULT_WAL_TRUNCATE_BYTES)
+        )
+        self.vacuum_freelist_pages = (
+            vacuum_freelist_pages
+            if vacuum_freelist_pages is not None
+            else _env_int("VPN_DB_VACUUM_FREELIST_PAGES", DEFAULT_VACUUM_FREELIST_PAGES)
+        )
+        self.vacuum_step_pages = (
+            vacuum_step_pages if vacuum_step_pages is not None else DEFAULT_VACUUM_STEP_PAGES
+        )
+
+    def choose_checkpoint_mode(self, wal_size: int) -> Optional[str]:
+        if wal_size >= self.wal_truncate_bytes:
+            return "TRUNCATE"
+        if wal_size >= self.wal_passive_bytes:
+            return "PASSIVE"
+        return None
+
+    def run(self, checkpoint_mode: Optional[str] = None, vacuum: bool = True) -> Dict[str, Any]:
+        """
+        Один проход обслуживания. checkpoint_mode принудительно задаёт режим
+        checkpoint (иначе - по порогам размера WAL). Отчёт сохраняется в metadata.
+        """
+        started = time.monotonic()
+        report: Dict[str, Any] = {
+            "started_at": datetime.now().isoformat(),
+            "wal_size_before": self.storage.get_wal_size(),
+            "checkpoint": None,
+            "optimize": None,
+            "vacuum": None,
+            "short_id_index": None,
+            "errors": [],
+        }
+
+        # Уникальный индекс short_id, не созданный миграцией из-за дубликатов
+        try:
+            report["short_id_index"] = self.storage.ensure_short_id_index()
+        except Exception as e:
+            report["errors"].append(f"short_id_index: {e}")
+
+        try:
+            report["optimize"] = self.storage.optimize()
+        except Exception as e:
+            report["errors"].append(f"optimize: {e}")
+
+        if vacuum:
+            try:
+                report["vacuum"] = self._vacuum()
+            except Exception as e:
+                report["errors"].append(f"vacuum: {e}")
+
+        # Checkpoint последним - в него попадают и страницы, записанные vacuum
+        mode = checkpoint_mode or self.choose_checkpoint_mode(self.storage.get_wal_size())
+        if mode:
+            try:
+                report["checkpoint"] = self.storage.wal_checkpoint(mode)
+                if report["checkpoint"]["busy"]:
+                    logger.warning("WAL checkpoint (%s) was blocked by active connections", mode)
+            except Exception as e:
+                report["errors"].append(f"checkpoint: {e}")
+
+        report["wal_size_after"] = self.storage.get_wal_size()
+        report["space"] = self.storage.get_space_stats()
+        report["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+
+        for error in report["errors"]:
+            logger.error("Storage maintenance error: %s", error)
+        try:
+            self.storage.set_metadata(MAINTENANCE_REPORT_KEY, json.dumps(report))
+        except Exception as e:
+            logger.error("Failed to save maintenance report: %s", e)
+        return report
+
+    def _vacuum(self) -> Dict[str, Any]:
+        if self.storage.enable_incremental_vacuum():
+            return {"full_vacuum": True}
+        freelist = self.storage.get_space_stats()["freelist_count"]
+        if freelist < self.vacuum_freelist_pages:
+            return {"full_vacuum": False, "freelist_count": freelist, "skipped": True}
+        return {"full_vacuum": False, **self.storage.incremental_vacuum(self.vacuum_step_pages)}
+
+    def last_report(self) -> Optional[Dict[str, Any]]:
+        raw = self.storage.get_metadata(MAINTENANCE_REPORT_KEY)
+        if not raw:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "space": self.storage.get_space_stats(),
+            "thresholds": {
+                "wal_passive_bytes": self.wal_passive_bytes,
+                "wal_truncate_bytes": self.wal_truncate_bytes,
+                "vacuum_freelist_pages": self.vacuum_freelist_pages,
+            },
+            "last_run": self.last_report(),
+        }
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Метрики SQLiteStorage: число вызовов, суммарная латентность и перцентили
+по публичным методам и SQL-выражениям, возвращённые строки, ожидание
+_lock и SQLite busy (BEGIN IMMEDIATE). Медленные запросы логируются,
+если задан VPN_DB_SLOW_QUERY_MS. Метрики считаются на процесс (воркер).
+"""
+
+import bisect
+import functools
+import inspect
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин гистограммы, миллисекунды
+LATENCY_BUCKETS_MS = (
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+)
+MAX_TRACKED_STATEMENTS = 500
+
+_IN_LIST_RE = re.compile(r"\?(\s*,\s*\?)+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def normalize_sql(sql: str) -> str:
+    # Списки IN (?, ?, ...) разной длины считаются одним выражением
+    sql = _WHITESPACE_RE.sub(" ", sql).strip()
+    return _IN_LIST_RE.sub("?, ...", sql)[:300]
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+
+    def observe(self, duration_ms: float, rows: int = 0):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, duration_ms)] += 1
+        self.count += 1
+        self.total_ms += duration_ms
+        self.rows += rows
+        if duration_ms > self.max_ms:
+            self.max_ms = duration_ms
+
+    def percentile(self, p: float) -> float:
+        """Оценка перцентиля - верхняя граница корзины (последняя - max)."""
+        if not self.count:
+            return 0.0
+        threshold = self.count * p / 100.0
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= threshold:
+                if index < len(LATENCY_BUCKETS_MS):
+                    return round(min(LATENCY_BUCKETS_MS[index], self.max_ms), 3)
+                return round(self.max_ms, 3)
+        return round(self.max_ms, 3)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(self.max_ms, 3),
+            "rows": self.rows,
+        }
+
+
+class StorageMetrics:
+    def __init__(self, enabled: Optional[bool] = None, slow_query_ms: Optional[float] = None):
+        if enabled is None:
+            enabled = os.getenv("VPN_DB_METRICS", "1") != "0"
+        self.enabled = enabled
+        self.slow_query_ms = (
+            slow_query_ms if slow_query_ms is not None else _env_float("VPN_DB_SLOW_QUERY_MS", 0)
+        )
+        self._guard = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._guard:
+            self._started = time.time()
+            self._methods: Dict[str, LatencyHistogram] = {}
+            self._statements: Dict[str, LatencyHistogram] = {}
+            self._lock_wait = LatencyHistogram()
+            self._busy = LatencyHistogram()
+            self._slow_queries = 0
+
+    def record_method(self, name: str, duration_ms: float, rows: int = 0):
+        with self._guard:
+            histogram = self._methods.get(name)
+            if histogram is None:
+                histogram = self._methods[name] = LatencyHistogram()
+            histogram.observe(duration_ms, rows)
+        self._check_slow("method", name, duration_ms)
+
+    def record_statement(self, sql: str, duration_ms: float, rows: int = 0):
+        key = normalize_sql(sql)
+        with self._guard:
+            histogram = self._statements.get(key)
+            if histogram is None:
+                if len(self._statements) >= MAX_TRACKED_STATEMENTS:
+                    key = "<other>"
+                    histogram = self._statements.setdefault(key, LatencyHistogram())
+                else:
+                    histogram = self._statements[key] = LatencyHistogram()
+            histogram.observe(duration_ms, rows)
+        self._check_slow("statement", key, duration_ms)
+
+    def add_statement_rows(self, sql: str, rows: int):
+        key = normalize_sql(sql)
+        with self._guard:
+            histogram = self._statements.get(key) or self._statements.get("<other>")
+            if histogram is not None:
+                histogram.rows += rows
+
+    def record_lock_wait(self, duration_ms: float):
+        with self._guard:
+            self._lock_wait.observe(duration_ms)
+
+    def record_busy(self, duration_ms: float):
+        with self._guard:
+            self._busy.observe(duration_ms)
+
+    def _check_slow(self, kind: str, name: str, duration_ms: float):
+        if self.slow_query_ms and duration_ms >= self.slow_query_ms:
+            with self._guard:
+                self._slow_queries += 1
+            logger.warning("Slow SQLite %s (%.1f ms): %s", kind, duration_ms, name)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._guard:
+            return {
+                "pid": os.getpid(),
+                "enabled": self.enabled,
+                "since": self._started,
+                "slow_query_ms": self.slow_query_ms,
+                "slow_queries": self._slow_queries,
+                "lock_wait": self._lock_wait.snapshot(),
+                "sqlite_busy": self._busy.snapshot(),
+                "methods": {
+                    name: histogram.snapshot()
+                    for name, histogram in sorted(self._methods.items())
+                },
+                "statements": {
+                    sql: histogram.snapshot()
+                    for sql, histogram in sorted(
+                        self._statements.items(), key=lambda item: -item[1].total_ms
+                    )
+                },
+            }
+
+
+class TimedRLock:
+    """RLock, который записывает время ожидания при конкурентном захвате."""
+
+    def __init__(self, metrics: StorageMetrics):
+        self._lock = threading.RLock()
+        self._metrics = metrics
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self._lock.acquire(blocking=False):
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        acquired = self._lock.acquire(timeout=timeout)
+        if self._metrics.enabled:
+            self._metrics.record_lock_wait((time.perf_counter() - started) * 1000)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Курсор, который записывает латентность выражения и число строк."""
+
+    metrics: Optional[StorageMetrics] = None
+    _traced_sql: Optional[str] = None
+
+    def _record(self, sql: str, started: float):
+        metrics = self.metrics
+        if metrics is None or not metrics.enabled:
+            return
+        duration_ms = (time.perf_counter() - started) * 1000
+        # Для INSERT/UPDATE/DELETE rowcount известен сразу, для SELECT - строки
+        # досчитываются при чтении
+        rows = self.rowcount if self.rowcount > 0 else 0
+        metrics.record_statement(sql, duration_ms, rows)
+        self._traced_sql = sql if self.description is not None else None
+
+    def _count_rows(self, rows: int):
+        if rows and self._traced_sql is not None and self.metrics is not None:
+            self.metrics.add_statement_rows(self._traced_sql, rows)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self._record(sql, started)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._record(sql, started)
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._count_rows(1)
+        return row
+
+    def fetchmany(self, size: int = 1) -> List[Any]:
+        rows = super().fetchmany(size)
+        self._count_rows(len(rows))
+        return rows
+
+    def fetchall(self) -> List[Any]:
+        rows = super().fetchall()
+        self._count_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        count = 0
+        try:
+            while True:
+                row = super().fetchone()
+                if row is None:
+                    return
+                count += 1
+                yield row
+        finally:
+            self._count_rows(count)
+
+
+class TracedConnection(sqlite3.Connection):
+    """Фабрика соединений для sqlite3.connect(factory=...): все выражения через TracedCursor."""
+
+    metrics: Optional[StorageMetrics] = None
+
+    def cursor(self, factory=TracedCursor):
+        cursor = super().cursor(factory)
+        cursor.metrics = self.metrics
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _rows_in(result: Any) -> int:
+    if result is None or isinstance(result, bool):
+        return 0
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])  # (page, cursor) из get_keys_page
+    if isinstance(result, (list, dict)):
+        return len(result)
+    return 1
+
+
+def instrument_methods(cls):
+    """
+    Декоратор класса: публичные методы записывают латентность и число
+    возвращённых строк в self.metrics. Контекстные менеджеры и генераторы
+    (transaction, iter_keys) не оборачиваются - их время учитывается по SQL.
+    """
+    skip = getattr(cls, "UNINSTRUMENTED_METHODS", ())
+    for name, func in list(vars(cls).items()):
+        if name.startswith("_") or name in skip or not inspect.isfunction(func):
+            continue
+        if inspect.isgeneratorfunction(func) or hasattr(func, "__wrapped__"):
+            continue
+        setattr(cls, name, _instrumented(name, func))
+    return cls
+
+
+def _instrumented(name: str, func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.metrics
+        if not metrics.enabled:
+            return func(self, *args, **kwargs)
+        started = time.perf_counter()
+        result = func(self, *args, **kwargs)
+        metrics.record_method(name, (time.perf_counter() - started) * 1000, _rows_in(result))
+        return result
+
+    return wrapper
@@ -4,23 +4,34 @@ Centralized SQLite storage for VPN server state (keys, ports, metadata).
 SQLite is the single source of truth - all data operations use SQLite directly.
 """
 
+import base64
+import gzip
 import json
+import logging
 import os
+import shutil
 import sqlite3
+import tempfile
 import threading
+import time
 from contextlib import contextmanager
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from storage.metrics import StorageMetrics, TimedRLock, TracedConnection, instrument_methods
 
 
 PROJECT_ROOT = "/root/vpn-server"
 DATA_DIR = os.path.join(PROJECT_ROOT, "data")
 DB_PATH = os.path.join(DATA_DIR, "vpn.db")
+DB_BACKUP_DIR = os.path.join(DATA_DIR, "backups")
 
 KEYS_JSON_PATH = os.path.join(PROJECT_ROOT, "config", "keys.json")
 PORTS_JSON_PATH = os.path.join(PROJECT_ROOT, "config", "ports.json")
 TRAFFIC_HISTORY_JSON_PATH = os.path.join(PROJECT_ROOT, "config", "traffic_history.json")
 
+logger = logging.getLogger(__name__)
+
 
 def _ensure_parent(path: str):
     os.makedirs(os.path.dirname(path), exist_ok=True)
@@ -34,176 +45,866 @@ def _write_json_atomic(path: str, data: Any):
     os.replace(tmp_path, path)
 
 
+# PRAGMA, которые действуют только в рамках соединения - применяются один раз при открытии
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA busy_timeout=5000;",  # 5 секунд для обработки конкурентных запросов
+    "PRAGMA cache_size=-32000;",  # 128MB кэш для 100 пользователей
+    "PRAGMA temp_store=MEMORY;",
+)
+
+
+# Форматы начала интервала для traffic_buckets (лексикографический порядок = хронологический)
+TRAFFIC_BUCKET_FORMATS = {
+    "minute": "%Y-%m-%dT%H:%M",
+    "hour": "%Y-%m-%dT%H:00",
+    "day": "%Y-%m-%d",
+}
+
+TRAFFIC_HISTORY_UPSERT = """
+    INSERT INTO traffic_history (
+        key_uuid, total_bytes, snapshot_total_bytes, snapshot_at,
+        xray_uplink, xray_downlink, xray_at, created_at, last_update
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(key_uuid) DO UPDATE SET
+        total_bytes=excluded.total_bytes,
+        snapshot_total_bytes=excluded.snapshot_total_bytes,
+        snapshot_at=excluded.snapshot_at,
+        xray_uplink=excluded.xray_uplink,
+        xray_downlink=excluded.xray_downlink,
+        xray_at=excluded.xray_at,
+        last_update=excluded.last_update
+"""
+
+TRAFFIC_BUCKETS_UPSERT = """
+    INSERT INTO traffic_buckets (key_uuid, resolution, bucket_start, bytes)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(key_uuid, resolution, bucket_start) DO UPDATE SET
+        bytes = bytes + excluded.bytes
+"""
+
+# Порядок (created_at, id) совпадает с индексом idx_keys_created_id и с курсором пагинации
+KEYS_SELECT_ALL = "SELECT * FROM keys ORDER BY created_at ASC, id ASC"
+
+# Предел длительности онлайн-бэкапа (backup_to), секунды
+BACKUP_TIMEOUT = 300.0
+
+# Максимум параметров в одном IN (...) - ниже лимита SQLITE_MAX_VARIABLE_NUMBER
+SQL_BATCH_SIZE = 500
+
+# Пулы портов индивидуальных inbound'ов хранятся в metadata (PORT_POOLS_KEY):
+# {"ranges": [[start, end], ...], "exclude": [port, ...]}; free_ports - их свободная часть.
+# Без записи в metadata действует исходный диапазон 10001-10100
+PORT_RANGE_START = 10001
+PORT_RANGE_END = 10100
+PORT_POOLS_KEY = "port_pools"
+DEFAULT_PORT_POOLS = {"ranges": [[PORT_RANGE_START, PORT_RANGE_END]], "exclude": []}
+
+# Таблицы и порядок строк для NDJSON экспорта/импорта
+NDJSON_FORMAT = "vpn-storage-ndjson"
+NDJSON_TABLES = {
+    "keys": "created_at, id",
+    "port_assignments": "port",
+    "traffic_history": "key_uuid",
+    "traffic_buckets": "key_uuid, resolution, bucket_start",
+    "metadata": "key",
+}
+
+
+class _ConnectionPool:
+    """
+    Пул долгоживущих SQLite соединений внутри процесса:
+    одно writer-соединение (доступ сериализуется через SQLiteStorage._lock)
+    и по одному read-only соединению на поток. Кэш страниц переживает запросы.
+    """
+
+    def __init__(self, db_path: str, metrics: Optional[StorageMetrics] = None):
+        self.db_path = db_path
+        self.metrics = metrics
+        self._guard = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._probe: Optional[sqlite3.Connection] = None
+        self._readers: List[Tuple[threading.Thread, sqlite3.Connection]] = []
+        self._stats = {
+            "writer_opened": 0,
+            "writer_acquired": 0,
+            "readers_opened": 0,
+            "readers_closed": 0,
+            "reader_acquired": 0,
+        }
+
+    def _check_pid(self):
+        # После fork соединения родителя использовать нельзя - начинаем с чистого пула
+        if self._pid != os.getpid():
+            with self._guard:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def _open(self, readonly: bool) -> sqlite3.Connection:
+        conn = None
+        if readonly:
+            try:
+                conn = sqlite3.connect(
+                    f"file:{self.db_path}?mode=ro",
+                    uri=True,
+                    isolation_level=None,
+                    check_same_thread=False,
+                    factory=TracedConnection,
+                )
+            except sqlite3.OperationalError:
+                conn = None
+        if conn is None:
+            # isolation_level=None: транзакции открываются явно (BEGIN IMMEDIATE)
+            conn = sqlite3.connect(
+                self.db_path,
+                isolation_level=None,
+                check_same_thread=False,
+                factory=TracedConnection,
+            )
+            if readonly:
+                conn.execute("PRAGMA query_only=ON;")
+            else:
+                # Для нового файла действует сразу; существующие БД переводит
+                # StorageMaintenance однократным VACUUM
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+                conn.execute("PRAGMA journal_mode=WAL;")
+        conn.row_factory = sqlite3.Row
+        conn.metrics = self.metrics
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def writer(self) -> sqlite3.Connection:
+        self._check_pid()
+        if self._writer is None:
+            with self._guard:
+                if self._writer is None:
+                    self._writer = self._open(readonly=False)
+                    self._stats["writer_opened"] += 1
+        self._stats["writer_acquired"] += 1
+        return self._writer
+
+    def probe(self) -> sqlite3.Connection:
+        """Отдельное read-only соединение для PRAGMA data_version (кэш ключей)."""
+        self._check_pid()
+        if self._probe is None:
+            with self._guard:
+                if self._probe is None:
+                    self._probe = self._open(readonly=True)
+        return self._probe
+
+    def reader(self) -> sqlite3.Connection:
+        self._check_pid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open(readonly=True)
+            self._local.conn = conn
+            with self._guard:
+                self._prune_dead_readers()
+                self._readers.append((threading.current_thread(), conn))
+                self._stats["readers_opened"] += 1
+        self._stats["reader_acquired"] += 1
+        return conn
+
+    def _prune_dead_readers(self):
+        alive = []
+        for thread, conn in self._readers:
+            if thread.is_alive():
+                alive.append((thread, conn))
+                continue
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            self._stats["readers_closed"] += 1
+        self._readers = alive
+
+    def close_all(self):
+        with self._guard:
+            for _, conn in self._readers:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            for conn in (self._writer, self._probe):
+                if conn is not None:
+                    conn.close()
+            self._reset()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._guard:
+            self._prune_dead_readers()
+            return {
+                "pid": self._pid,
+                "writer_open": self._writer is not None,
+                "probe_open": self._probe is not None,
+                "readers_open": len(self._readers),
+                **self._stats,
+            }
+
+
+@instrument_methods
 class SQLiteStorage:
-    def __init__(self, db_path: str = DB_PATH):
+    KEYS_GENERATION_KEY = "keys_generation"
+    UNINSTRUMENTED_METHODS = ("get_metrics", "reset_metrics", "get_pool_stats", "close")
+
+    def __init__(self, db_path: str = DB_PATH, cache_keys: bool = True):
         self.db_path = db_path
-        self._lock = threading.RLock()
+        self.metrics = StorageMetrics()
+        self._lock = TimedRLock(self.metrics)
+        self._tx_owner: Optional[int] = None
+        # Кэш ключей: сверяется с PRAGMA data_version и счётчиком keys_generation в metadata
+        self.cache_keys = cache_keys
+        self._keys_cache: Optional[Dict[str, Any]] = None
+        self._keys_cache_version: Optional[int] = None
+        self._keys_cache_generation: Optional[str] = None
+        self._keys_cache_lock = threading.Lock()
         _ensure_parent(self.db_path)
+        self._pool = _ConnectionPool(self.db_path, self.metrics)
         self._init_db()
-        self._migrate_from_json()
         # JSON экспорт отключен - используем только SQLite
 
     @contextmanager
     def _connect(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        try:
+        """Writer-соединение в транзакции BEGIN IMMEDIATE.
+
+        Вложенные вызовы из того же потока присоединяются к внешней транзакции.
+        """
+        with self._lock:
+            conn = self._pool.writer()
+            if self._tx_owner == threading.get_ident():
+                yield conn
+                return
+            started = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            if self.metrics.enabled:
+                # Ожидание writer-блокировки других процессов (busy_timeout)
+                self.metrics.record_busy((time.perf_counter() - started) * 1000)
+            self._tx_owner = threading.get_ident()
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                started = time.perf_counter()
+                conn.commit()
+                if self.metrics.enabled:
+                    self.metrics.record_statement(
+                        "COMMIT", (time.perf_counter() - started) * 1000
+                    )
+            finally:
+                self._tx_owner = None
+
+    @contextmanager
+    def transaction(self):
+        """
+        Публичная транзакция BEGIN IMMEDIATE: вызовы методов storage внутри блока
+        (из того же потока) выполняются в ней же - один commit на весь блок.
+        """
+        with self._connect() as conn:
             yield conn
-            conn.commit()
-        finally:
-            conn.close()
+
+    @contextmanager
+    def _read(self):
+        """Reader-соединение текущего потока (внутри транзакции - writer)."""
+        if self._tx_owner == threading.get_ident():
+            yield self._pool.writer()
+            return
+        yield self._pool.reader()
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        return self._pool.stats()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Снимок метрик: методы, SQL-выражения, ожидание _lock и SQLite busy."""
+        return {**self.metrics.snapshot(), "pool": self._pool.stats()}
+
+    def reset_metrics(self):
+        self.metrics.reset()
+
+    def close(self):
+        with self._lock:
+            self._pool.close_all()
+
+    # ------------------------------------------------------------------
+    # Schema migrations (версия схемы хранится в PRAGMA user_version)
+    # ------------------------------------------------------------------
+    MIGRATIONS = (
+        (1, "_migration_base_schema"),
+        (2, "_migration_keys_sni"),
+        (3, "_migration_typed_traffic_history"),
+        (4, "_migration_key_indexes"),
+        (5, "_migration_import_legacy_json"),
+        (6, "_migration_free_ports"),
+        (7, "_migration_port_leases"),
+        (8, "_migration_free_ports_released_at"),
+        (9, "_migration_key_leases"),
+        (10, "_migration_keys_generation_triggers"),
+    )
+    SCHEMA_VERSION = MIGRATIONS[-1][0]
 
     def _init_db(self):
+        """Применение недостающих миграций; при актуальной схеме - один PRAGMA."""
+        with self._lock:
+            version = self._pool.writer().execute("PRAGMA user_version").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
         with self._connect() as conn:
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.execute("PRAGMA synchronous=NORMAL;")
-            conn.execute("PRAGMA busy_timeout=5000;")  # 5 секунд для обработки конкурентных запросов
-            conn.execute("PRAGMA cache_size=-32000;")  # 128MB кэш для 100 пользователей
+            # Повторная проверка под write-lock: схему мог обновить другой процесс
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for target, method_name in self.MIGRATIONS:
+                if target <= version:
+                    continue
+                getattr(self, method_name)(conn)
+                conn.execute(f"PRAGMA user_version = {int(target)}")
+                logger.info("Applied storage migration %s (%s)", target, method_name)
+
+    @staticmethod
+    def _migration_base_schema(conn: sqlite3.Connection):
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS keys (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                uuid TEXT NOT NULL UNIQUE,
+                created_at TEXT NOT NULL,
+                is_active INTEGER NOT NULL DEFAULT 1,
+                port INTEGER,
+                short_id TEXT,
+                sni TEXT
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS port_assignments (
+                port INTEGER PRIMARY KEY,
+                uuid TEXT NOT NULL UNIQUE,
+                key_id TEXT NOT NULL,
+                key_name TEXT NOT NULL,
+                assigned_at TEXT NOT NULL,
+                is_active INTEGER NOT NULL DEFAULT 1
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+            """
+        )
+
+    def _migration_keys_sni(self, conn: sqlite3.Connection):
+        # Колонка sni отсутствует в БД, созданных до её появления
+        if not self._has_column(conn, "keys", "sni"):
+            conn.execute("ALTER TABLE keys ADD COLUMN sni TEXT")
+
+    def _migration_typed_traffic_history(self, conn: sqlite3.Connection):
+        legacy_history = self._has_column(conn, "traffic_history", "payload")
+        if legacy_history:
+            conn.execute("ALTER TABLE traffic_history RENAME TO traffic_history_legacy")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS traffic_history (
+                key_uuid TEXT PRIMARY KEY,
+                total_bytes INTEGER NOT NULL DEFAULT 0,
+                snapshot_total_bytes INTEGER NOT NULL DEFAULT 0,
+                snapshot_at TEXT,
+                xray_uplink INTEGER NOT NULL DEFAULT 0,
+                xray_downlink INTEGER NOT NULL DEFAULT 0,
+                xray_at TEXT,
+                created_at TEXT NOT NULL,
+                last_update TEXT
+            )
+            """
+        )
+        # Дельты трафика по интервалам: minute / hour / day
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS traffic_buckets (
+                key_uuid TEXT NOT NULL,
+                resolution TEXT NOT NULL,
+                bucket_start TEXT NOT NULL,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (key_uuid, resolution, bucket_start)
+            ) WITHOUT ROWID
+            """
+        )
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_traffic_buckets_range
+            ON traffic_buckets (resolution, bucket_start)
+            """
+        )
+        if legacy_history:
+            self._migrate_history_payloads(conn)
+
+    @staticmethod
+    def _migration_key_indexes(conn: sqlite3.Connection):
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_keys_port ON keys (port)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_keys_created_id ON keys (created_at, id)"
+        )
+        SQLiteStorage._ensure_short_id_index(conn)
+
+    @staticmethod
+    def _ensure_short_id_index(conn: sqlite3.Connection) -> bool:
+        """
+        Уникальный индекс short_id. В старых БД short_id мог повторяться: тогда
+        дубликаты перечисляются в логе (short_id зашит в ссылки клиентов, менять его
+        автоматически нельзя) и остаётся обычный индекс; уникальный создаёт
+        ensure_short_id_index (обслуживание БД), когда дубликаты устранены.
+        """
+        try:
             conn.execute(
                 """
-                CREATE TABLE IF NOT EXISTS keys (
-                    id TEXT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    uuid TEXT NOT NULL UNIQUE,
-                    created_at TEXT NOT NULL,
-                    is_active INTEGER NOT NULL DEFAULT 1,
-                    port INTEGER,
-                    short_id TEXT,
-                    sni TEXT
-                )
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_keys_short_id
+                ON keys (short_id) WHERE short_id IS NOT NULL
                 """
             )
-            # Добавляем колонку sni если её нет (для существующих БД)
-            try:
-                conn.execute("ALTER TABLE keys ADD COLUMN sni TEXT")
-            except sqlite3.OperationalError:
-                pass  # Колонка уже существует
-            conn.execute(
+        except sqlite3.IntegrityError:
+            duplicates = conn.execute(
                 """
-                CREATE TABLE IF NOT EXISTS port_assignments (
-                    port INTEGER PRIMARY KEY,
-                    uuid TEXT NOT NULL UNIQUE,
-                    key_id TEXT NOT NULL,
-                    key_name TEXT NOT NULL,
-                    assigned_at TEXT NOT NULL,
-                    is_active INTEGER NOT NULL DEFAULT 1
-                )
+                SELECT short_id, GROUP_CONCAT(uuid, ', ') AS uuids FROM keys
+                WHERE short_id IS NOT NULL
+                GROUP BY short_id HAVING COUNT(*) > 1
                 """
+            ).fetchall()
+            for row in duplicates:
+                logger.warning("Duplicate short_id %s used by keys: %s", row["short_id"], row["uuids"])
+            logger.warning(
+                "Duplicate short_id values found (%s), unique index not created", len(duplicates)
             )
             conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_keys_short_id_nonunique ON keys (short_id)"
+            )
+            return False
+        conn.execute("DROP INDEX IF EXISTS idx_keys_short_id_nonunique")
+        return True
+
+    def get_short_id_duplicates(self) -> List[Dict[str, Any]]:
+        """short_id, которые носят несколько ключей (uuid ключей)."""
+        with self._read() as conn:
+            rows = conn.execute(
                 """
-                CREATE TABLE IF NOT EXISTS metadata (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL
-                )
+                SELECT short_id, GROUP_CONCAT(uuid, ',') AS uuids FROM keys
+                WHERE short_id IS NOT NULL
+                GROUP BY short_id HAVING COUNT(*) > 1
                 """
-            )
+            ).fetchall()
+        return [{"short_id": row["short_id"], "uuids": sorted(row["uuids"].split(","))} for row in rows]
+
+    def ensure_short_id_index(self) -> Dict[str, Any]:
+        """
+        Повторное создание уникального индекса short_id, не созданного миграцией 4
+        из-за дубликатов. Пока индекс на месте или дубликаты не устранены - только
+        чтение, без транзакции записи.
+        """
+        with self._read() as conn:
+            unique = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_keys_short_id'"
+            ).fetchone()
+        if unique:
+            return {"unique": True, "created": False}
+        duplicates = self.get_short_id_duplicates()
+        if duplicates:
+            return {"unique": False, "created": False, "duplicates": duplicates}
+        with self.transaction() as conn:
+            created = self._ensure_short_id_index(conn)
+        if created:
+            logger.info("Unique short_id index created")
+        return {"unique": created, "created": created}
+
+    def _migration_import_legacy_json(self, conn: sqlite3.Connection):
+        """Однократный импорт keys.json / ports.json / traffic_history.json."""
+        self._import_keys_json(conn)
+        self._import_ports_json(conn)
+        self._import_history_json(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+            ("legacy_json_imported_at", datetime.now().isoformat()),
+        )
+
+    def _migration_free_ports(self, conn: sqlite3.Connection):
+        # Свободный список портов: выделение - первая строка по PK, без сканирования ОС
+        conn.execute("CREATE TABLE IF NOT EXISTS free_ports (port INTEGER PRIMARY KEY)")
+        self._rebuild_free_ports(conn)
+
+    def _migration_port_leases(self, conn: sqlite3.Connection):
+        # Срок аренды порта недосозданного ключа (NULL - ключ подтверждён)
+        if not self._has_column(conn, "port_assignments", "lease_expires_at"):
+            conn.execute("ALTER TABLE port_assignments ADD COLUMN lease_expires_at TEXT")
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_port_assignments_lease
+            ON port_assignments (lease_expires_at) WHERE lease_expires_at IS NOT NULL
+            """
+        )
+
+    def _migration_free_ports_released_at(self, conn: sqlite3.Connection):
+        # Время освобождения порта (NULL - порт ещё не выдавался); выдача в порядке
+        # (released_at, port): сначала новые порты, затем давно освобождённые
+        if not self._has_column(conn, "free_ports", "released_at"):
+            conn.execute("ALTER TABLE free_ports ADD COLUMN released_at TEXT")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_free_ports_released ON free_ports (released_at, port)"
+        )
+
+    def _migration_key_leases(self, conn: sqlite3.Connection):
+        # Аренда ключа без назначения порта (режим shared): срок создания до подтверждения
+        if not self._has_column(conn, "keys", "lease_expires_at"):
+            conn.execute("ALTER TABLE keys ADD COLUMN lease_expires_at TEXT")
+        conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_keys_lease
+            ON keys (lease_expires_at) WHERE lease_expires_at IS NOT NULL
+            """
+        )
+
+    def _migration_keys_generation_triggers(self, conn: sqlite3.Connection):
+        # keys_generation растёт при любой записи в keys - из любого процесса и
+        # инструмента (db_tool, sqlite3 CLI), а не только из методов SQLiteStorage
+        for event in ("INSERT", "UPDATE", "DELETE"):
             conn.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS trg_keys_generation_{event.lower()}
+                AFTER {event} ON keys
+                BEGIN
+                    INSERT OR IGNORE INTO metadata (key, value) VALUES ('{self.KEYS_GENERATION_KEY}', '0');
+                    UPDATE metadata SET value = CAST(value AS INTEGER) + 1
+                    WHERE key = '{self.KEYS_GENERATION_KEY}';
+                END
                 """
-                CREATE TABLE IF NOT EXISTS traffic_history (
-                    key_uuid TEXT PRIMARY KEY,
-                    payload TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    last_update TEXT NOT NULL
-                )
-                """
             )
+        self._bump_keys_generation(conn)
+
+    @staticmethod
+    def _has_column(conn: sqlite3.Connection, table: str, column: str) -> bool:
+        rows = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        return any(row["name"] == column for row in rows)
+
+    @staticmethod
+    def _table_is_empty(conn: sqlite3.Connection, table: str) -> bool:
+        return conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+
+    def _migrate_history_payloads(self, conn: sqlite3.Connection):
+        """Однократный перенос JSON payload из старой таблицы в типизированные колонки."""
+        rows = conn.execute(
+            "SELECT key_uuid, payload, created_at, last_update FROM traffic_history_legacy"
+        ).fetchall()
+        records = []
+        for row in rows:
+            try:
+                entry = json.loads(row["payload"]) or {}
+            except json.JSONDecodeError:
+                entry = {}
+            if not isinstance(entry, dict):
+                entry = {}
+            entry.setdefault("last_update", row["last_update"])
+            records.append(
+                self._history_record(row["key_uuid"], entry, row["created_at"])
+            )
+        conn.executemany(TRAFFIC_HISTORY_UPSERT, records)
+        conn.execute("DROP TABLE traffic_history_legacy")
 
     # ------------------------------------------------------------------
     # JSON migration helpers
     # ------------------------------------------------------------------
-    def _migrate_from_json(self):
-        self._migrate_keys_json()
-        self._migrate_ports_json()
-        self._migrate_history_json()
-
-    def _migrate_keys_json(self):
-        if not os.path.exists(KEYS_JSON_PATH):
-            return
-        if self.count_keys() > 0:
-            return
+    @staticmethod
+    def _load_legacy_json(path: str) -> Any:
+        if not os.path.exists(path):
+            return None
         try:
-            with open(KEYS_JSON_PATH, "r", encoding="utf-8") as fh:
-                keys = json.load(fh) or []
+            with open(path, "r", encoding="utf-8") as fh:
+                return json.load(fh)
         except (json.JSONDecodeError, FileNotFoundError):
-            return
+            return None
 
+    def _import_keys_json(self, conn: sqlite3.Connection):
+        keys = self._load_legacy_json(KEYS_JSON_PATH) or []
+        if not keys or not self._table_is_empty(conn, "keys"):
+            return
+        records = []
         for key in keys:
-            if not isinstance(key, dict):
+            if not isinstance(key, dict) or not key.get("uuid"):
                 continue
-            key.setdefault("id", key.get("uuid") or "")
-            key.setdefault("created_at", datetime.now().isoformat())
-            self.add_key(key, sync_json=False)
+            records.append(
+                (
+                    key.get("id") or key["uuid"],
+                    key.get("name") or key["uuid"],
+                    key["uuid"],
+                    key.get("created_at") or datetime.now().isoformat(),
+                    1 if key.get("is_active", True) else 0,
+                    key.get("port"),
+                    key.get("short_id"),
+                    key.get("sni"),
+                )
+            )
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO keys (id, name, uuid, created_at, is_active, port, short_id, sni)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            records,
+        )
+        self._bump_keys_generation(conn)
 
-    def _migrate_ports_json(self):
-        if not os.path.exists(PORTS_JSON_PATH):
+    def _import_ports_json(self, conn: sqlite3.Connection):
+        ports_data = self._load_legacy_json(PORTS_JSON_PATH) or {}
+        if not ports_data or not self._table_is_empty(conn, "port_assignments"):
             return
-        if self.get_used_ports_count() > 0:
-            return
-        try:
-            with open(PORTS_JSON_PATH, "r", encoding="utf-8") as fh:
-                ports_data = json.load(fh) or {}
-        except (json.JSONDecodeError, FileNotFoundError):
-            return
-
-        assignments = ports_data.get("port_assignments", {})
-        for uuid, info in assignments.items():
+        records = []
+        for uuid, info in (ports_data.get("port_assignments") or {}).items():
             try:
                 port = int(info.get("port"))
-            except (TypeError, ValueError):
+            except (TypeError, ValueError, AttributeError):
                 continue
             key_id = info.get("key_id") or info.get("keyId") or uuid
             key_name = info.get("key_name") or info.get("keyName") or uuid
             assigned_at = info.get("assigned_at") or datetime.now().isoformat()
-            self.add_port_assignment(
-                uuid=uuid,
-                key_id=key_id,
-                key_name=key_name,
-                port=port,
-                assigned_at=assigned_at,
-                sync_json=False,
-            )
+            records.append((port, uuid, key_id, key_name, assigned_at, 1))
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO port_assignments
+            (port, uuid, key_id, key_name, assigned_at, is_active)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            records,
+        )
 
-    def _migrate_history_json(self):
-        if not os.path.exists(TRAFFIC_HISTORY_JSON_PATH):
+    def _import_history_json(self, conn: sqlite3.Connection):
+        history_data = self._load_legacy_json(TRAFFIC_HISTORY_JSON_PATH) or {}
+        if not history_data or not self._table_is_empty(conn, "traffic_history"):
             return
-        if self.count_traffic_history_entries() > 0:
-            return
-        try:
-            with open(TRAFFIC_HISTORY_JSON_PATH, "r", encoding="utf-8") as fh:
-                history_data = json.load(fh) or {}
-        except (json.JSONDecodeError, FileNotFoundError):
-            return
-
-        keys_history = history_data.get("keys_history", {})
-        for uuid, entry in keys_history.items():
-            if not isinstance(entry, dict):
-                continue
-            self.save_traffic_history_entry(uuid, entry, sync_json=False)
+        now = datetime.now().isoformat()
+        records = [
+            self._history_record(uuid, entry, now)
+            for uuid, entry in (history_data.get("keys_history") or {}).items()
+            if isinstance(entry, dict)
+        ]
+        conn.executemany(TRAFFIC_HISTORY_UPSERT, records)
 
     # ------------------------------------------------------------------
     # Key operations
     # ------------------------------------------------------------------
     def count_keys(self) -> int:
-        with self._connect() as conn:
+        cache = self._get_keys_cache()
+        if cache is not None:
+            return len(cache["list"])
+        with self._read() as conn:
             row = conn.execute("SELECT COUNT(*) AS c FROM keys").fetchone()
             return int(row["c"])
 
     def get_all_keys(self) -> List[Dict[str, Any]]:
-        with self._connect() as conn:
+        cache = self._get_keys_cache()
+        if cache is not None:
+            return [dict(key) for key in cache["list"]]
+        with self._read() as conn:
+            rows = conn.execute(KEYS_SELECT_ALL).fetchall()
+        return [self._format_key(row) for row in rows]
+
+    def get_keys_page(
+        self,
+        limit: Optional[int] = None,
+        after: Optional[str] = None,
+        is_active: Optional[bool] = None,
+        name_prefix: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Keyset-пагинация по (created_at, id). Возвращает страницу ключей и курсор
+        следующей страницы (None - страниц больше нет). Некорректный курсор - ValueError.
+        """
+        conditions = []
+        params: List[Any] = []
+        if after:
+            created_at, key_id = self._decode_keys_cursor(after)
+            conditions.append("(created_at > ? OR (created_at = ? AND id > ?))")
+            params.extend([created_at, created_at, key_id])
+        if is_active is not None:
+            conditions.append("is_active = ?")
+            params.append(1 if is_active else 0)
+        if name_prefix:
+            escaped = (
+                name_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            )
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            params.append(f"{escaped}%")
+
+        query = "SELECT * FROM keys"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY created_at ASC, id ASC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit + 1)
+
+        with self._read() as conn:
+            rows = conn.execute(query, params).fetchall()
+        keys = [self._format_key(row) for row in rows]
+
+        next_cursor = None
+        if limit is not None and len(keys) > limit:
+            keys = keys[:limit]
+            next_cursor = self._encode_keys_cursor(keys[-1])
+        return keys, next_cursor
+
+    def iter_keys(
+        self,
+        page_size: int = 500,
+        is_active: Optional[bool] = None,
+        name_prefix: Optional[str] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Обход всех ключей страницами - память ограничена размером страницы."""
+        cursor = None
+        while True:
+            keys, cursor = self.get_keys_page(
+                limit=page_size,
+                after=cursor,
+                is_active=is_active,
+                name_prefix=name_prefix,
+            )
+            yield from keys
+            if not cursor:
+                return
+
+    @staticmethod
+    def _encode_keys_cursor(key: Dict[str, Any]) -> str:
+        raw = json.dumps([key["created_at"], key["id"]], separators=(",", ":"))
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def _decode_keys_cursor(cursor: str) -> Tuple[str, str]:
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            created_at, key_id = json.loads(base64.urlsafe_b64decode(padded))
+        except (ValueError, TypeError) as exc:
+            raise ValueError(f"Invalid keys cursor: {cursor}") from exc
+        return str(created_at), str(key_id)
+
+    def get_key_by_identifier(self, identifier: str) -> Optional[Dict[str, Any]]:
+        return self.get_key_by_id(identifier) or self.get_key_by_uuid(identifier)
+
+    def get_key_by_id(self, key_id: str) -> Optional[Dict[str, Any]]:
+        return self._get_key_by("id", key_id)
+
+    def get_key_by_uuid(self, uuid: str) -> Optional[Dict[str, Any]]:
+        return self._get_key_by("uuid", uuid)
+
+    def get_key_by_port(self, port: int) -> Optional[Dict[str, Any]]:
+        """Ключ на порту; порт общего inbound (несколько ключей) - ValueError."""
+        keys = self.get_keys_by_port(port)
+        if len(keys) > 1:
+            raise ValueError(f"Port {port} is shared by {len(keys)} keys")
+        return keys[0] if keys else None
+
+    def get_keys_by_port(self, port: int) -> List[Dict[str, Any]]:
+        """Все ключи на порту (в режиме shared - все ключи общего inbound)."""
+        if not port:
+            return []
+        cache = self._get_keys_cache()
+        if cache is not None:
+            return [dict(key) for key in cache["by_port"].get(port, [])]
+        with self._read() as conn:
             rows = conn.execute(
-                "SELECT * FROM keys ORDER BY datetime(created_at) ASC, name ASC"
+                "SELECT * FROM keys WHERE port = ? ORDER BY created_at ASC, id ASC", (port,)
             ).fetchall()
         return [self._format_key(row) for row in rows]
 
-    def get_key_by_identifier(self, identifier: str) -> Optional[Dict[str, Any]]:
-        with self._connect() as conn:
+    def get_key_by_short_id(self, short_id: str) -> Optional[Dict[str, Any]]:
+        return self._get_key_by("short_id", short_id)
+
+    def get_used_short_ids(self, short_ids: List[str]) -> Set[str]:
+        """short_id из набора, уже занятые ключами (одним запросом, по частям)."""
+        used: Set[str] = set()
+        short_ids = [sid for sid in short_ids if sid]
+        with self._read() as conn:
+            for start in range(0, len(short_ids), SQL_BATCH_SIZE):
+                chunk = short_ids[start:start + SQL_BATCH_SIZE]
+                placeholders = ", ".join("?" for _ in chunk)
+                rows = conn.execute(
+                    f"SELECT short_id FROM keys WHERE short_id IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                used.update(row["short_id"] for row in rows)
+        return used
+
+    def _get_key_by(self, column: str, value: Any) -> Optional[Dict[str, Any]]:
+        """Поиск одного ключа: по индексу кэша, иначе по индексу таблицы keys."""
+        if value is None or value == "":
+            return None
+        cache = self._get_keys_cache()
+        if cache is not None:
+            key = cache[f"by_{column}"].get(value)
+            return dict(key) if key else None
+        with self._read() as conn:
             row = conn.execute(
-                "SELECT * FROM keys WHERE id = ? OR uuid = ?",
-                (identifier, identifier),
+                f"SELECT * FROM keys WHERE {column} = ? LIMIT 1", (value,)
             ).fetchone()
         return self._format_key(row) if row else None
 
+    def _get_keys_cache(self) -> Optional[Dict[str, Any]]:
+        """
+        Кэш всех ключей с индексами по id/uuid/short_id и port (список ключей).
+        Проверка актуальности - PRAGMA data_version (без обращения к диску);
+        при изменении БД сверяется keys_generation (его растят триггеры на keys),
+        и только при его смене ключи перечитываются. None - кэш отключен или
+        идёт своя транзакция.
+        """
+        if not self.cache_keys or self._tx_owner == threading.get_ident():
+            return None
+        with self._keys_cache_lock:
+            conn = self._pool.probe()
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if self._keys_cache is not None and version == self._keys_cache_version:
+                return self._keys_cache
+
+            conn.execute("BEGIN")
+            try:
+                row = conn.execute(
+                    "SELECT value FROM metadata WHERE key = ?",
+                    (self.KEYS_GENERATION_KEY,),
+                ).fetchone()
+                generation = row["value"] if row else None
+                if self._keys_cache is None or generation != self._keys_cache_generation:
+                    keys = [self._format_key(row) for row in conn.execute(KEYS_SELECT_ALL)]
+                    # В режиме shared порт общий у всех ключей - индекс хранит список
+                    by_port: Dict[int, List[Dict[str, Any]]] = {}
+                    for key in keys:
+                        if key["port"]:
+                            by_port.setdefault(key["port"], []).append(key)
+                    self._keys_cache = {
+                        "list": keys,
+                        "by_id": {key["id"]: key for key in keys},
+                        "by_uuid": {key["uuid"]: key for key in keys},
+                        "by_port": by_port,
+                        "by_short_id": {
+                            key["short_id"]: key for key in keys if key["short_id"]
+                        },
+                    }
+                    self._keys_cache_generation = generation
+            finally:
+                conn.execute("COMMIT")
+            self._keys_cache_version = version
+            return self._keys_cache
+
+    def _bump_keys_generation(self, conn: sqlite3.Connection):
+        conn.execute(
+            """
+            INSERT INTO metadata (key, value) VALUES (?, '1')
+            ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+            """,
+            (self.KEYS_GENERATION_KEY,),
+        )
+
     def add_key(self, key: Dict[str, Any], sync_json: bool = False):
         # Сохраняем индивидуальный short_id и sni для каждого ключа
         record = (
@@ -249,6 +950,79 @@ class SQLiteStorage:
                 )
             # JSON экспорт отключен - используем только SQLite
 
+    def create_key_with_port(
+        self,
+        key: Dict[str, Any],
+        port: Optional[int] = None,
+        exclude_ports: Iterable[int] = (),
+        lease_ttl: Optional[int] = None,
+    ) -> Optional[int]:
+        """
+        Назначение порта, строка ключа и нулевая запись traffic_history -
+        одна транзакция. Без port порт берётся из free_ports (кроме exclude_ports -
+        занятых в ОС). Возвращает порт или None, если свободного порта нет
+        (или переданный port уже занят) - тогда ничего не записано.
+        С lease_ttl порт арендуется: если create не подтвердит его через
+        confirm_port_lease за lease_ttl секунд, ключ будет удалён при следующем выделении.
+        """
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            self._reclaim_expired_leases(conn)
+            if port is None:
+                port = self._claim_free_port(conn, exclude_ports)
+                if port is None:
+                    return None
+            elif conn.execute(
+                "SELECT 1 FROM port_assignments WHERE port = ?", (port,)
+            ).fetchone():
+                return None
+            else:
+                conn.execute("DELETE FROM free_ports WHERE port = ?", (port,))
+            key = {**key, "port": port}
+            if not self._insert_port_assignment(
+                conn, port, key["uuid"], key["id"], key["name"], now, lease_ttl
+            ):
+                raise sqlite3.IntegrityError(f"Port {port} is already assigned")
+            self.add_key(key)
+            conn.execute(
+                TRAFFIC_HISTORY_UPSERT,
+                self._history_record(key["uuid"], {"last_update": now}, now),
+            )
+        return port
+
+    def create_key(self, key: Dict[str, Any], lease_ttl: Optional[int] = None):
+        """
+        Строка ключа и нулевая запись traffic_history одной транзакцией,
+        без назначения порта (ключи общего inbound слушают один порт).
+        С lease_ttl ключ арендуется, как порт в create_key_with_port: без
+        confirm_port_lease за lease_ttl секунд он будет удалён.
+        """
+        now = datetime.now().isoformat()
+        with self.transaction() as conn:
+            self._reclaim_expired_leases(conn)
+            self.add_key(key)
+            if lease_ttl:
+                conn.execute(
+                    "UPDATE keys SET lease_expires_at = ? WHERE uuid = ?",
+                    (
+                        (datetime.now() + timedelta(seconds=lease_ttl)).isoformat(timespec="seconds"),
+                        key["uuid"],
+                    ),
+                )
+            conn.execute(
+                TRAFFIC_HISTORY_UPSERT,
+                self._history_record(key["uuid"], {"last_update": now}, now),
+            )
+
+    def delete_key_cascade(self, uuid: str) -> bool:
+        """Ключ, назначение порта и история трафика удаляются одной транзакцией."""
+        with self.transaction() as conn:
+            cursor = conn.execute("DELETE FROM keys WHERE uuid = ?", (uuid,))
+            self._release_port(conn, uuid)
+            conn.execute("DELETE FROM traffic_history WHERE key_uuid = ?", (uuid,))
+            conn.execute("DELETE FROM traffic_buckets WHERE key_uuid = ?", (uuid,))
+        return cursor.rowcount > 0
+
     def export_keys_json(self):
         keys = self.get_all_keys()
         _write_json_atomic(KEYS_JSON_PATH, keys)
@@ -257,7 +1031,7 @@ class SQLiteStorage:
     # Port operations
     # ------------------------------------------------------------------
     def get_used_ports(self) -> Dict[int, Dict[str, Any]]:
-        with self._connect() as conn:
+        with self._read() as conn:
             rows = conn.execute(
                 "SELECT * FROM port_assignments ORDER BY port ASC"
             ).fetchall()
@@ -269,21 +1043,37 @@ class SQLiteStorage:
                 "key_name": row["key_name"],
                 "assigned_at": row["assigned_at"],
                 "is_active": bool(row["is_active"]),
+                "lease_expires_at": row["lease_expires_at"],
             }
         return result
 
     def get_used_ports_count(self) -> int:
-        with self._connect() as conn:
+        with self._read() as conn:
             row = conn.execute("SELECT COUNT(*) AS c FROM port_assignments").fetchone()
             return int(row["c"])
 
     def get_port_for_uuid(self, uuid: str) -> Optional[int]:
-        with self._connect() as conn:
+        with self._read() as conn:
             row = conn.execute(
                 "SELECT port FROM port_assignments WHERE uuid = ?", (uuid,)
             ).fetchone()
         return int(row["port"]) if row else None
 
+    def get_ports_for_uuids(self, uuids: List[str]) -> Dict[str, int]:
+        """Порты для набора uuid одним запросом (по частям при длинном списке)."""
+        ports: Dict[str, int] = {}
+        uuids = list(uuids)
+        with self._read() as conn:
+            for start in range(0, len(uuids), SQL_BATCH_SIZE):
+                chunk = uuids[start:start + SQL_BATCH_SIZE]
+                placeholders = ", ".join("?" for _ in chunk)
+                rows = conn.execute(
+                    f"SELECT uuid, port FROM port_assignments WHERE uuid IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                ports.update((row["uuid"], int(row["port"])) for row in rows)
+        return ports
+
     def add_port_assignment(
         self,
         uuid: str,
@@ -292,36 +1082,265 @@ class SQLiteStorage:
         port: int,
         assigned_at: Optional[str] = None,
         sync_json: bool = False,
-    ):
-        assigned_at = assigned_at or datetime.now().isoformat()
-        record = (port, uuid, key_id, key_name, assigned_at, 1)
+    ) -> bool:
+        """
+        Назначение конкретного порта условным INSERT: если порт занят другим ключом,
+        ничего не меняется и возвращается False. Прежний порт ключа возвращается в free_ports.
+        """
         with self._lock:
             with self._connect() as conn:
-                conn.execute(
-                    """
-                    INSERT OR REPLACE INTO port_assignments
-                    (port, uuid, key_id, key_name, assigned_at, is_active)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    """,
-                    record,
+                owner = conn.execute(
+                    "SELECT uuid FROM port_assignments WHERE port = ?", (port,)
+                ).fetchone()
+                if owner and owner["uuid"] != uuid:
+                    return False
+                self._release_port(conn, uuid)
+                conn.execute("DELETE FROM free_ports WHERE port = ?", (port,))
+                self._insert_port_assignment(
+                    conn, port, uuid, key_id, key_name, assigned_at=assigned_at
                 )
             if sync_json:
                 self.export_ports_json()
+        return True
+
+    def claim_port_assignment(
+        self,
+        uuid: str,
+        key_id: str,
+        key_name: str,
+        exclude_ports: Iterable[int] = (),
+        lease_ttl: Optional[int] = None,
+    ) -> Optional[int]:
+        """Выделение первого свободного порта и его назначение - одна транзакция."""
+        with self.transaction() as conn:
+            self._reclaim_expired_leases(conn)
+            port = self._claim_free_port(conn, exclude_ports)
+            if port is None:
+                return None
+            if not self._insert_port_assignment(
+                conn, port, uuid, key_id, key_name, lease_ttl=lease_ttl
+            ):
+                raise sqlite3.IntegrityError(f"Port {port} is already assigned")
+        return port
+
+    def confirm_port_lease(self, uuid: str) -> bool:
+        """Снятие срока аренды: ключ создан полностью (Xray применил inbound/клиента)."""
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE port_assignments SET lease_expires_at = NULL WHERE uuid = ?", (uuid,)
+            )
+            key_cursor = conn.execute(
+                """
+                UPDATE keys SET lease_expires_at = NULL
+                WHERE uuid = ? AND lease_expires_at IS NOT NULL
+                """,
+                (uuid,),
+            )
+        return cursor.rowcount > 0 or key_cursor.rowcount > 0
+
+    def reclaim_expired_leases(self) -> List[str]:
+        """Удаление ключей, чьё создание не завершилось до истечения аренды (порта или ключа)."""
+        with self.transaction() as conn:
+            return self._reclaim_expired_leases(conn)
+
+    def _reclaim_expired_leases(self, conn: sqlite3.Connection) -> List[str]:
+        # Недосозданный ключ мог успеть попасть в Xray и config.json: его inbound
+        # слушает порт, пока реконсилятор его не удалит. Поэтому порт не возвращается
+        # в free_ports, а остаётся в карантине - назначение без строки ключа
+        # (is_active = 0); освобождает его release_orphaned_ports после reconcile
+        now = datetime.now().isoformat(timespec="seconds")
+        rows = conn.execute(
+            """
+            SELECT uuid, port FROM port_assignments
+            WHERE lease_expires_at IS NOT NULL AND lease_expires_at < ?
+            """,
+            (now,),
+        ).fetchall()
+        # Ключи общего inbound арендуются без порта: клиент в общем inbound удалит reconcile
+        shared_rows = conn.execute(
+            """
+            SELECT uuid FROM keys
+            WHERE lease_expires_at IS NOT NULL AND lease_expires_at < ?
+            """,
+            (now,),
+        ).fetchall()
+        for row in shared_rows:
+            logger.warning("Key lease expired for %s, reclaiming half-created key", row["uuid"])
+            conn.execute("DELETE FROM keys WHERE uuid = ?", (row["uuid"],))
+            conn.execute("DELETE FROM traffic_history WHERE key_uuid = ?", (row["uuid"],))
+            conn.execute("DELETE FROM traffic_buckets WHERE key_uuid = ?", (row["uuid"],))
+        for row in rows:
+            logger.warning(
+                "Port lease expired for %s (port %s), reclaiming half-created key, "
+                "port held until reconcile",
+                row["uuid"],
+                row["port"],
+            )
+            self._delete_key_holding_port(conn, row["uuid"])
+        return [row["uuid"] for row in rows] + [row["uuid"] for row in shared_rows]
+
+    def abandon_key(self, uuid: str) -> bool:
+        """
+        Удаление недосозданного ключа (ошибка применения в Xray) с удержанием
+        порта, как при истечении аренды: inbound мог уже появиться в Xray,
+        порт освободит release_orphaned_ports после reconcile.
+        """
+        with self.transaction() as conn:
+            deleted = self._delete_key_holding_port(conn, uuid)
+        return deleted
+
+    @staticmethod
+    def _delete_key_holding_port(conn: sqlite3.Connection, uuid: str) -> bool:
+        cursor = conn.execute("DELETE FROM keys WHERE uuid = ?", (uuid,))
+        conn.execute("DELETE FROM traffic_history WHERE key_uuid = ?", (uuid,))
+        conn.execute("DELETE FROM traffic_buckets WHERE key_uuid = ?", (uuid,))
+        conn.execute(
+            "UPDATE port_assignments SET lease_expires_at = NULL, is_active = 0 WHERE uuid = ?",
+            (uuid,),
+        )
+        return cursor.rowcount > 0
+
+    def release_orphaned_ports(self, keep_uuids: Iterable[str] = ()) -> List[int]:
+        """
+        Возврат в free_ports портов, удержанных за удалёнными недосозданными
+        ключами (назначение без строки ключа). Вызывается после успешного
+        reconcile: inbounds ключей не из keep_uuids в Xray уже удалены.
+        """
+        keep = set(keep_uuids)
+        released: List[int] = []
+        with self.transaction() as conn:
+            rows = conn.execute(
+                """
+                SELECT port, uuid FROM port_assignments
+                WHERE uuid NOT IN (SELECT uuid FROM keys)
+                """
+            ).fetchall()
+            for row in rows:
+                if row["uuid"] in keep:
+                    continue
+                conn.execute("DELETE FROM port_assignments WHERE port = ?", (row["port"],))
+                self._return_free_port(conn, row["port"])
+                released.append(int(row["port"]))
+        return released
+
+    @staticmethod
+    def _insert_port_assignment(
+        conn: sqlite3.Connection,
+        port: int,
+        uuid: str,
+        key_id: str,
+        key_name: str,
+        assigned_at: Optional[str] = None,
+        lease_ttl: Optional[int] = None,
+    ) -> bool:
+        # Условный INSERT: порт занимается, только если его ещё никто не держит
+        now = datetime.now()
+        lease_expires_at = (
+            (now + timedelta(seconds=lease_ttl)).isoformat(timespec="seconds")
+            if lease_ttl
+            else None
+        )
+        cursor = conn.execute(
+            """
+            INSERT INTO port_assignments
+            (port, uuid, key_id, key_name, assigned_at, is_active, lease_expires_at)
+            SELECT ?, ?, ?, ?, ?, 1, ?
+            WHERE NOT EXISTS (SELECT 1 FROM port_assignments WHERE port = ?)
+            """,
+            (
+                port,
+                uuid,
+                key_id,
+                key_name,
+                assigned_at or now.isoformat(),
+                lease_expires_at,
+                port,
+            ),
+        )
+        return cursor.rowcount == 1
+
+    def peek_free_port(self, exclude_ports: Iterable[int] = ()) -> Optional[int]:
+        with self._read() as conn:
+            return self._first_free_port(conn, exclude_ports)
+
+    def peek_free_ports(self, count: int, exclude_ports: Iterable[int] = ()) -> List[int]:
+        """Первые count свободных портов в порядке выдачи, без резервирования."""
+        exclude = {int(p) for p in exclude_ports}
+        ports: List[int] = []
+        if count <= 0:
+            return ports
+        with self._read() as conn:
+            for row in conn.execute("SELECT port FROM free_ports ORDER BY released_at, port"):
+                if row["port"] not in exclude:
+                    ports.append(int(row["port"]))
+                    if len(ports) == count:
+                        break
+        return ports
+
+    def count_free_ports(self) -> int:
+        with self._read() as conn:
+            return conn.execute("SELECT COUNT(*) FROM free_ports").fetchone()[0]
+
+    def get_port_quarantine_stats(self, cooldown_seconds: int) -> Dict[str, Any]:
+        """Очередь освобождённых портов: глубина карантина и возраст освобождений."""
+        now = datetime.now()
+        since = (now - timedelta(seconds=cooldown_seconds)).isoformat(timespec="seconds")
+        with self._read() as conn:
+            row = conn.execute(
+                """
+                SELECT
+                    COUNT(*) AS free_ports,
+                    SUM(released_at IS NULL) AS never_used,
+                    SUM(released_at IS NOT NULL) AS released,
+                    SUM(released_at >= ?) AS quarantined,
+                    MIN(released_at) AS oldest,
+                    MAX(released_at) AS newest
+                FROM free_ports
+                """,
+                (since,),
+            ).fetchone()
+            orphaned = conn.execute(
+                "SELECT COUNT(*) FROM port_assignments WHERE uuid NOT IN (SELECT uuid FROM keys)"
+            ).fetchone()[0]
+
+        def age(value: Optional[str]) -> Optional[int]:
+            if not value:
+                return None
+            return int((now - datetime.fromisoformat(value)).total_seconds())
+
+        return {
+            "cooldown_seconds": cooldown_seconds,
+            "free_ports": row["free_ports"],
+            "never_used": row["never_used"] or 0,
+            "released": row["released"] or 0,
+            "quarantined": row["quarantined"] or 0,
+            # Порты недосозданных ключей, удерживаемые до reconcile
+            "orphaned": orphaned,
+            "oldest_release_age_seconds": age(row["oldest"]),
+            "newest_release_age_seconds": age(row["newest"]),
+        }
 
     def release_port_assignment(self, uuid: str, sync_json: bool = False) -> bool:
         with self._lock:
             with self._connect() as conn:
-                cursor = conn.execute(
-                    "DELETE FROM port_assignments WHERE uuid = ?", (uuid,)
-                )
-            if cursor.rowcount and sync_json:
+                released = self._release_port(conn, uuid)
+            if released and sync_json:
                 self.export_ports_json()
-            return cursor.rowcount > 0
+            return released
 
     def reset_ports(self, sync_json: bool = False) -> bool:
         with self._lock:
             with self._connect() as conn:
+                # Сброшенные порты встают в очередь карантина как освобождённые сейчас
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO free_ports (port, released_at)
+                    SELECT port, ? FROM port_assignments
+                    """,
+                    (datetime.now().isoformat(timespec="seconds"),),
+                )
                 conn.execute("DELETE FROM port_assignments")
+                self._rebuild_free_ports(conn)
             if sync_json:
                 self.export_ports_json()
         return True
@@ -351,6 +1370,144 @@ class SQLiteStorage:
             "last_updated": now,
         }
 
+    @staticmethod
+    def _first_free_port(
+        conn: sqlite3.Connection, exclude_ports: Iterable[int]
+    ) -> Optional[int]:
+        # Обход индекса (released_at, port) до первого порта, не занятого в ОС:
+        # NULL (не выдававшиеся) идут первыми, затем давно освобождённые - недавно
+        # освобождённые порты, на которые ещё стучатся старые клиенты, выдаются последними.
+        # Стоимость зависит от числа занятых свободных портов, а не от размера пулов
+        exclude = {int(p) for p in exclude_ports}
+        for row in conn.execute("SELECT port FROM free_ports ORDER BY released_at, port"):
+            if row["port"] not in exclude:
+                return int(row["port"])
+        return None
+
+    def _claim_free_port(
+        self, conn: sqlite3.Connection, exclude_ports: Iterable[int]
+    ) -> Optional[int]:
+        port = self._first_free_port(conn, exclude_ports)
+        if port is not None:
+            conn.execute("DELETE FROM free_ports WHERE port = ?", (port,))
+        return port
+
+    def _return_free_port(self, conn: sqlite3.Connection, port: int):
+        if self._port_in_pools(self._load_port_pools(conn), port):
+            conn.execute(
+                "INSERT OR REPLACE INTO free_ports (port, released_at) VALUES (?, ?)",
+                (port, datetime.now().isoformat(timespec="seconds")),
+            )
+
+    def _release_port(self, conn: sqlite3.Connection, uuid: str) -> bool:
+        row = conn.execute(
+            "SELECT port FROM port_assignments WHERE uuid = ?", (uuid,)
+        ).fetchone()
+        if not row:
+            return False
+        conn.execute("DELETE FROM port_assignments WHERE uuid = ?", (uuid,))
+        self._return_free_port(conn, row["port"])
+        return True
+
+    def _rebuild_free_ports(self, conn: sqlite3.Connection):
+        # Свободные порты, оставшиеся в пулах, сохраняют released_at (очередь карантина)
+        pools = self._load_port_pools(conn)
+        conn.execute("DELETE FROM free_ports WHERE port IN (SELECT port FROM port_assignments)")
+        in_pools = " OR ".join("port BETWEEN ? AND ?" for _ in pools["ranges"])
+        conn.execute(
+            f"DELETE FROM free_ports WHERE NOT ({in_pools})",
+            [bound for port_range in pools["ranges"] for bound in port_range],
+        )
+        for start, end in pools["ranges"]:
+            conn.execute(
+                """
+                WITH RECURSIVE port_range(port) AS (
+                    SELECT ? UNION ALL SELECT port + 1 FROM port_range WHERE port < ?
+                )
+                INSERT OR IGNORE INTO free_ports (port)
+                SELECT port FROM port_range
+                WHERE port NOT IN (SELECT port FROM port_assignments)
+                """,
+                (start, end),
+            )
+        conn.executemany(
+            "DELETE FROM free_ports WHERE port = ?", ((port,) for port in pools["exclude"])
+        )
+
+    # ------------------------------------------------------------------
+    # Port pools
+    # ------------------------------------------------------------------
+    def get_port_pools(self) -> Dict[str, Any]:
+        with self._read() as conn:
+            pools = self._load_port_pools(conn)
+        return {**pools, "capacity": self._pools_capacity(pools)}
+
+    def get_port_capacity(self) -> int:
+        with self._read() as conn:
+            return self._pools_capacity(self._load_port_pools(conn))
+
+    def set_port_pools(
+        self, ranges: List[Tuple[int, int]], exclude: Iterable[int] = ()
+    ) -> Dict[str, Any]:
+        """
+        Замена пулов портов и пересборка free_ports одной транзакцией.
+        Назначенные порты вне новых пулов остаются за ключами (outside_pools).
+        """
+        pools = self._validate_port_pools(ranges, exclude)
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+                (PORT_POOLS_KEY, json.dumps(pools)),
+            )
+            self._rebuild_free_ports(conn)
+            assigned = [row["port"] for row in conn.execute("SELECT port FROM port_assignments")]
+        outside = sorted(port for port in assigned if not self._port_in_pools(pools, port))
+        return {**pools, "capacity": self._pools_capacity(pools), "outside_pools": outside}
+
+    @staticmethod
+    def _validate_port_pools(
+        ranges: List[Tuple[int, int]], exclude: Iterable[int]
+    ) -> Dict[str, Any]:
+        normalized = sorted((int(start), int(end)) for start, end in ranges)
+        if not normalized:
+            raise ValueError("At least one port range is required")
+        for start, end in normalized:
+            if not 1 <= start <= end <= 65535:
+                raise ValueError(f"Invalid port range: {start}-{end}")
+        for (_, prev_end), (start, end) in zip(normalized, normalized[1:]):
+            if start <= prev_end:
+                raise ValueError(f"Port range {start}-{end} overlaps another range")
+        excluded = sorted({int(port) for port in exclude})
+        for port in excluded:
+            if not 1 <= port <= 65535:
+                raise ValueError(f"Invalid excluded port: {port}")
+        return {"ranges": [list(r) for r in normalized], "exclude": excluded}
+
+    @staticmethod
+    def _load_port_pools(conn: sqlite3.Connection) -> Dict[str, Any]:
+        row = conn.execute(
+            "SELECT value FROM metadata WHERE key = ?", (PORT_POOLS_KEY,)
+        ).fetchone()
+        if not row:
+            return {"ranges": [list(r) for r in DEFAULT_PORT_POOLS["ranges"]], "exclude": []}
+        return json.loads(row["value"])
+
+    @staticmethod
+    def _port_in_pools(pools: Dict[str, Any], port: int) -> bool:
+        if port in pools["exclude"]:
+            return False
+        return any(start <= port <= end for start, end in pools["ranges"])
+
+    @staticmethod
+    def _pools_capacity(pools: Dict[str, Any]) -> int:
+        total = sum(end - start + 1 for start, end in pools["ranges"])
+        excluded = sum(
+            1
+            for port in pools["exclude"]
+            if any(start <= port <= end for start, end in pools["ranges"])
+        )
+        return total - excluded
+
     def export_ports_json(self):
         snapshot = self.get_ports_snapshot()
         _write_json_atomic(PORTS_JSON_PATH, snapshot)
@@ -359,57 +1516,153 @@ class SQLiteStorage:
     # Traffic history operations
     # ------------------------------------------------------------------
     def count_traffic_history_entries(self) -> int:
-        with self._connect() as conn:
+        with self._read() as conn:
             row = conn.execute("SELECT COUNT(*) AS c FROM traffic_history").fetchone()
             return int(row["c"])
 
     def get_traffic_history_entry(self, key_uuid: str) -> Optional[Dict[str, Any]]:
-        with self._connect() as conn:
+        with self._read() as conn:
             row = conn.execute(
-                "SELECT payload FROM traffic_history WHERE key_uuid = ?",
+                "SELECT * FROM traffic_history WHERE key_uuid = ?",
                 (key_uuid,),
             ).fetchone()
-        if not row:
-            return None
-        try:
-            return json.loads(row["payload"])
-        except json.JSONDecodeError:
-            return None
+        return self._format_history(row) if row else None
 
-    def get_all_traffic_history(self) -> Dict[str, Dict[str, Any]]:
-        with self._connect() as conn:
-            rows = conn.execute("SELECT key_uuid, payload FROM traffic_history").fetchall()
-        result = {}
-        for row in rows:
-            try:
-                result[row["key_uuid"]] = json.loads(row["payload"])
-            except json.JSONDecodeError:
-                continue
+    def get_traffic_history_entries(self, key_uuids: List[str]) -> Dict[str, Dict[str, Any]]:
+        result: Dict[str, Dict[str, Any]] = {}
+        key_uuids = list(key_uuids)
+        with self._read() as conn:
+            for start in range(0, len(key_uuids), SQL_BATCH_SIZE):
+                chunk = key_uuids[start:start + SQL_BATCH_SIZE]
+                placeholders = ", ".join("?" for _ in chunk)
+                rows = conn.execute(
+                    f"SELECT * FROM traffic_history WHERE key_uuid IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+                for row in rows:
+                    result[row["key_uuid"]] = self._format_history(row)
         return result
 
+    def get_all_traffic_history(self) -> Dict[str, Dict[str, Any]]:
+        with self._read() as conn:
+            rows = conn.execute("SELECT * FROM traffic_history").fetchall()
+        return {row["key_uuid"]: self._format_history(row) for row in rows}
+
+    def get_traffic_totals(self) -> Dict[str, int]:
+        with self._read() as conn:
+            rows = conn.execute(
+                "SELECT key_uuid, total_bytes FROM traffic_history"
+            ).fetchall()
+        return {row["key_uuid"]: int(row["total_bytes"]) for row in rows}
+
+    def get_total_traffic_bytes(self) -> int:
+        with self._read() as conn:
+            row = conn.execute(
+                "SELECT COALESCE(SUM(total_bytes), 0) AS total FROM traffic_history"
+            ).fetchone()
+        return int(row["total"])
+
     def save_traffic_history_entry(
         self,
         key_uuid: str,
         entry: Dict[str, Any],
         sync_json: bool = False,
+        delta_bytes: int = 0,
+        sampled_at: Optional[datetime] = None,
     ):
-        now = datetime.now().isoformat()
-        payload = json.dumps(entry, ensure_ascii=False)
+        """Сохранение накопительных счётчиков; delta_bytes > 0 добавляется в buckets."""
+        record = self._history_record(key_uuid, entry, datetime.now().isoformat())
         with self._lock:
             with self._connect() as conn:
-                conn.execute(
-                    """
-                    INSERT INTO traffic_history (key_uuid, payload, created_at, last_update)
-                    VALUES (?, ?, ?, ?)
-                    ON CONFLICT(key_uuid) DO UPDATE SET
-                        payload=excluded.payload,
-                        last_update=excluded.last_update
-                    """,
-                    (key_uuid, payload, entry.get("last_update", now) or now, now),
-                )
+                conn.execute(TRAFFIC_HISTORY_UPSERT, record)
+                if delta_bytes > 0:
+                    self._add_traffic_buckets(
+                        conn, key_uuid, delta_bytes, sampled_at or datetime.now()
+                    )
             if sync_json:
                 self.export_traffic_history_json()
 
+    def save_traffic_history_entries(
+        self,
+        entries: Dict[str, Dict[str, Any]],
+        deltas: Optional[Dict[str, int]] = None,
+        sampled_at: Optional[datetime] = None,
+        sync_json: bool = False,
+    ):
+        """Пакетное сохранение счётчиков и дельт одной транзакцией."""
+        if not entries:
+            return
+        created_at = datetime.now().isoformat()
+        sampled_at = sampled_at or datetime.now()
+        records = [
+            self._history_record(key_uuid, entry, created_at)
+            for key_uuid, entry in entries.items()
+        ]
+        bucket_records = [
+            (key_uuid, resolution, sampled_at.strftime(fmt), int(delta))
+            for key_uuid, delta in (deltas or {}).items()
+            if delta > 0
+            for resolution, fmt in TRAFFIC_BUCKET_FORMATS.items()
+        ]
+        with self._lock:
+            with self._connect() as conn:
+                conn.executemany(TRAFFIC_HISTORY_UPSERT, records)
+                if bucket_records:
+                    conn.executemany(TRAFFIC_BUCKETS_UPSERT, bucket_records)
+            if sync_json:
+                self.export_traffic_history_json()
+
+    @staticmethod
+    def _add_traffic_buckets(
+        conn: sqlite3.Connection, key_uuid: str, delta_bytes: int, sampled_at: datetime
+    ):
+        conn.executemany(
+            TRAFFIC_BUCKETS_UPSERT,
+            [
+                (key_uuid, resolution, sampled_at.strftime(fmt), int(delta_bytes))
+                for resolution, fmt in TRAFFIC_BUCKET_FORMATS.items()
+            ],
+        )
+
+    def get_traffic_buckets(
+        self,
+        resolution: str,
+        start: str,
+        end: str,
+        key_uuid: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Buckets в полуинтервале [start, end); start/end в формате bucket_start."""
+        if resolution not in TRAFFIC_BUCKET_FORMATS:
+            raise ValueError(f"Unknown traffic bucket resolution: {resolution}")
+        query = (
+            "SELECT key_uuid, bucket_start, bytes FROM traffic_buckets "
+            "WHERE resolution = ? AND bucket_start >= ? AND bucket_start < ?"
+        )
+        params: List[Any] = [resolution, start, end]
+        if key_uuid is not None:
+            query += " AND key_uuid = ?"
+            params.append(key_uuid)
+        query += " ORDER BY bucket_start ASC"
+        with self._read() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [
+            {
+                "key_uuid": row["key_uuid"],
+                "bucket_start": row["bucket_start"],
+                "bytes": int(row["bytes"]),
+            }
+            for row in rows
+        ]
+
+    def prune_traffic_buckets(self, resolution: str, before: str) -> int:
+        with self._lock:
+            with self._connect() as conn:
+                cursor = conn.execute(
+                    "DELETE FROM traffic_buckets WHERE resolution = ? AND bucket_start < ?",
+                    (resolution, before),
+                )
+            return cursor.rowcount
+
     def reset_traffic_history_entry(self, key_uuid: str, sync_json: bool = False) -> bool:
         with self._lock:
             with self._connect() as conn:
@@ -417,6 +1670,10 @@ class SQLiteStorage:
                     "DELETE FROM traffic_history WHERE key_uuid = ?",
                     (key_uuid,),
                 )
+                conn.execute(
+                    "DELETE FROM traffic_buckets WHERE key_uuid = ?",
+                    (key_uuid,),
+                )
             if cursor.rowcount and sync_json:
                 self.export_traffic_history_json()
             return cursor.rowcount > 0
@@ -430,9 +1687,369 @@ class SQLiteStorage:
         }
         _write_json_atomic(TRAFFIC_HISTORY_JSON_PATH, history)
 
+    # ------------------------------------------------------------------
+    # NDJSON export / import
+    # ------------------------------------------------------------------
+    def iter_ndjson(
+        self, tables: Optional[List[str]] = None, batch_size: int = SQL_BATCH_SIZE
+    ) -> Iterator[str]:
+        """
+        Строки NDJSON: заголовок, затем {"table": ..., "row": {...}} по одной на строку БД.
+        Читается отдельным read-only соединением в одной транзакции (согласованный
+        снимок), строки выбираются порциями по batch_size - память не растёт.
+        """
+        for _, line in self._iter_ndjson_records(tables, batch_size):
+            yield line
+
+    def _iter_ndjson_records(
+        self, tables: Optional[List[str]], batch_size: int
+    ) -> Iterator[Tuple[Optional[str], str]]:
+        tables = self._ndjson_tables(tables)
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN")
+            yield None, json.dumps(
+                {
+                    "format": NDJSON_FORMAT,
+                    "schema_version": conn.execute("PRAGMA user_version").fetchone()[0],
+                    "tables": tables,
+                    "created_at": datetime.now().isoformat(),
+                },
+                ensure_ascii=False,
+            ) + "\n"
+            for table in tables:
+                cursor = conn.execute(f"SELECT * FROM {table} ORDER BY {NDJSON_TABLES[table]}")
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield table, json.dumps(
+                            {"table": table, "row": dict(row)},
+                            ensure_ascii=False,
+                            separators=(",", ":"),
+                        ) + "\n"
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def export_ndjson(
+        self,
+        fh,
+        tables: Optional[List[str]] = None,
+        progress=None,
+        batch_size: int = SQL_BATCH_SIZE,
+    ) -> Dict[str, int]:
+        """Потоковая запись NDJSON в текстовый файл. progress(table, rows) - после каждой порции."""
+        counts: Dict[str, int] = {}
+        for table, line in self._iter_ndjson_records(tables, batch_size):
+            fh.write(line)
+            if table is None:
+                continue
+            counts[table] = counts.get(table, 0) + 1
+            if progress and counts[table] % batch_size == 0:
+                progress(table, counts[table])
+        if progress:
+            for table, count in counts.items():
+                progress(table, count)
+        return counts
+
+    def import_ndjson(
+        self,
+        lines,
+        replace: bool = False,
+        batch_size: int = SQL_BATCH_SIZE,
+        progress=None,
+    ) -> Dict[str, int]:
+        """
+        Импорт NDJSON (итерируемые строки) одной транзакцией: строки накапливаются
+        порциями по batch_size и пишутся executemany. replace=True перезаписывает
+        строки с совпадающим ключом, иначе они пропускаются (INSERT OR IGNORE).
+        Колонки сверяются со схемой - неизвестные таблицы и колонки отклоняются.
+        """
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        counts: Dict[str, int] = {}
+        buffer: List[Tuple] = []
+        buffer_key: Optional[Tuple[str, Tuple[str, ...]]] = None
+
+        with self.transaction() as conn:
+            columns_by_table = {
+                table: {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+                for table in NDJSON_TABLES
+            }
+
+            def flush():
+                table, columns = buffer_key
+                placeholders = ", ".join("?" for _ in columns)
+                conn.executemany(
+                    f"{verb} INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+                    buffer,
+                )
+                counts[table] = counts.get(table, 0) + len(buffer)
+                if progress:
+                    progress(table, counts[table])
+                buffer.clear()
+
+            for line_no, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if "format" in record:
+                    if record["format"] != NDJSON_FORMAT:
+                        raise ValueError(f"Unsupported NDJSON format: {record['format']}")
+                    if int(record.get("schema_version", 0)) > self.SCHEMA_VERSION:
+                        raise ValueError(
+                            f"Export schema {record['schema_version']} is newer than {self.SCHEMA_VERSION}"
+                        )
+                    continue
+                table = record.get("table")
+                row = record.get("row")
+                if table not in NDJSON_TABLES or not isinstance(row, dict):
+                    raise ValueError(f"Line {line_no}: unknown table or malformed row")
+                columns = tuple(sorted(row))
+                unknown = set(columns) - columns_by_table[table]
+                if unknown:
+                    raise ValueError(f"Line {line_no}: unknown columns {sorted(unknown)} in {table}")
+                if buffer_key != (table, columns) or len(buffer) >= batch_size:
+                    if buffer:
+                        flush()
+                    buffer_key = (table, columns)
+                buffer.append(tuple(row[column] for column in columns))
+            if buffer:
+                flush()
+            # Свободный список зависит и от назначений, и от пулов в metadata -
+            # пересобирается после любого импорта (очередь карантина сохраняется)
+            self._rebuild_free_ports(conn)
+            # Импорт metadata мог вернуть keys_generation к значению, с которым
+            # построен кэш другого процесса - счётчик сдвигается ещё раз
+            if counts.get("keys") or counts.get("metadata"):
+                self._bump_keys_generation(conn)
+        return counts
+
+    @staticmethod
+    def _ndjson_tables(tables: Optional[List[str]]) -> List[str]:
+        if not tables:
+            return list(NDJSON_TABLES)
+        unknown = [table for table in tables if table not in NDJSON_TABLES]
+        if unknown:
+            raise ValueError(f"Unknown tables: {', '.join(unknown)}")
+        return list(tables)
+
+    # ------------------------------------------------------------------
+    # Online backup
+    # ------------------------------------------------------------------
+    def backup_to(
+        self,
+        path: str,
+        timeout: float = BACKUP_TIMEOUT,
+        compress: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        Консистентный снимок живой БД через VACUUM INTO.
+        Снимок берётся одной читающей транзакцией: коммиты писателей (WAL) его не
+        перезапускают и не блокируются. Дольше timeout секунд копирование не идёт -
+        прерывается с sqlite3.OperationalError, частичный снимок удаляется.
+        PRAGMA quick_check выполняется на копии, результат сжимается gzip.
+        При compress=True к path добавляется .gz, если его нет.
+        """
+        started = time.monotonic()
+        if compress and not path.endswith(".gz"):
+            path = f"{path}.gz"
+        _ensure_parent(os.path.abspath(path))
+        target_dir = os.path.dirname(os.path.abspath(path))
+        fd, snapshot_path = tempfile.mkstemp(
+            prefix=".vpn-backup-", suffix=".db", dir=target_dir
+        )
+        os.close(fd)
+        try:
+            source = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            deadline = started + timeout
+            # Ненулевой результат обработчика прерывает VACUUM INTO (OperationalError: interrupted)
+            source.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+            try:
+                source.execute("VACUUM INTO ?", (snapshot_path,))
+            except sqlite3.OperationalError as e:
+                if time.monotonic() > deadline:
+                    raise sqlite3.OperationalError(
+                        f"backup timed out after {timeout}s"
+                    ) from e
+                raise
+            finally:
+                source.close()
+
+            check = sqlite3.connect(snapshot_path)
+            try:
+                check_result = check.execute("PRAGMA quick_check").fetchone()[0]
+                pages = check.execute("PRAGMA page_count").fetchone()[0]
+            finally:
+                check.close()
+            if check_result != "ok":
+                raise sqlite3.DatabaseError(f"quick_check failed on backup copy: {check_result}")
+
+            db_size = os.path.getsize(snapshot_path)
+            tmp_target = f"{path}.tmp"
+            if compress:
+                with open(snapshot_path, "rb") as src, gzip.open(tmp_target, "wb") as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            else:
+                shutil.copyfile(snapshot_path, tmp_target)
+            os.replace(tmp_target, path)
+        finally:
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+
+        return {
+            "path": path,
+            "compressed": compress,
+            "size_bytes": os.path.getsize(path),
+            "db_size_bytes": db_size,
+            "pages": pages,
+            "quick_check": check_result,
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+            "created_at": datetime.now().isoformat(),
+        }
+
+    # ------------------------------------------------------------------
+    # Metadata
+    # ------------------------------------------------------------------
+    def get_metadata(self, key: str) -> Optional[str]:
+        with self._read() as conn:
+            row = conn.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_metadata(self, key: str, value: str):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    # ------------------------------------------------------------------
+    # WAL checkpoint / optimize / incremental vacuum
+    # ------------------------------------------------------------------
+    WAL_CHECKPOINT_MODES = ("PASSIVE", "FULL", "RESTART", "TRUNCATE")
+    AUTO_VACUUM_INCREMENTAL = 2
+
+    @contextmanager
+    def _autocommit(self):
+        """Writer-соединение вне транзакции: checkpoint и VACUUM нельзя выполнять в BEGIN."""
+        with self._lock:
+            if self._tx_owner is not None:
+                raise RuntimeError("Maintenance PRAGMA cannot run inside a transaction")
+            yield self._pool.writer()
+
+    def get_wal_size(self) -> int:
+        try:
+            return os.path.getsize(f"{self.db_path}-wal")
+        except OSError:
+            return 0
+
+    def get_space_stats(self) -> Dict[str, Any]:
+        with self._read() as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        return {
+            "page_size": page_size,
+            "page_count": page_count,
+            "freelist_count": freelist_count,
+            "db_size_bytes": page_size * page_count,
+            "auto_vacuum": auto_vacuum,
+            "wal_size_bytes": self.get_wal_size(),
+        }
+
+    def wal_checkpoint(self, mode: str = "PASSIVE") -> Dict[str, Any]:
+        """
+        PRAGMA wal_checkpoint. PASSIVE не ждёт читателей и писателей,
+        TRUNCATE дожидается их (busy_timeout) и обрезает файл -wal до нуля.
+        """
+        mode = mode.upper()
+        if mode not in self.WAL_CHECKPOINT_MODES:
+            raise ValueError(f"Unsupported checkpoint mode: {mode}")
+        started = time.monotonic()
+        with self._autocommit() as conn:
+            busy, log_frames, checkpointed = conn.execute(
+                f"PRAGMA wal_checkpoint({mode})"
+            ).fetchone()
+        return {
+            "mode": mode,
+            "busy": bool(busy),
+            "log_frames": log_frames,
+            "checkpointed_frames": checkpointed,
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+        }
+
+    def optimize(self) -> Dict[str, Any]:
+        started = time.monotonic()
+        with self._autocommit() as conn:
+            conn.execute("PRAGMA optimize")
+        return {"duration_ms": round((time.monotonic() - started) * 1000, 1)}
+
+    def enable_incremental_vacuum(self) -> bool:
+        """
+        Переводит БД в auto_vacuum=INCREMENTAL. Для существующего файла режим
+        вступает в силу только после VACUUM - выполняется один раз.
+        """
+        with self._autocommit() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == self.AUTO_VACUUM_INCREMENTAL:
+                return False
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        logger.info("Database switched to auto_vacuum=INCREMENTAL")
+        return True
+
+    def incremental_vacuum(self, max_pages: int = 0) -> Dict[str, Any]:
+        """Возврат до max_pages страниц из freelist (0 - все). Требует auto_vacuum=INCREMENTAL."""
+        started = time.monotonic()
+        with self._autocommit() as conn:
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # execute() делает один шаг (одна страница), executescript - до конца
+            conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)});")
+            after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return {
+            "freelist_before": before,
+            "freelist_after": after,
+            "pages_freed": before - after,
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+        }
+
     # ------------------------------------------------------------------
     # Utility helpers
     # ------------------------------------------------------------------
+    @staticmethod
+    def _history_record(key_uuid: str, entry: Dict[str, Any], created_at: str) -> Tuple:
+        snapshot = entry.get("last_snapshot") or {}
+        xray_stats = entry.get("last_xray_stats") or {}
+        return (
+            key_uuid,
+            int(entry.get("total_bytes", 0) or 0),
+            int(snapshot.get("total_bytes", 0) or 0),
+            snapshot.get("timestamp"),
+            int(xray_stats.get("uplink", 0) or 0),
+            int(xray_stats.get("downlink", 0) or 0),
+            xray_stats.get("timestamp"),
+            created_at,
+            entry.get("last_update"),
+        )
+
+    @staticmethod
+    def _format_history(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "total_bytes": int(row["total_bytes"]),
+            "last_update": row["last_update"],
+            "last_snapshot": {
+                "total_bytes": int(row["snapshot_total_bytes"]),
+                "timestamp": row["snapshot_at"],
+            },
+            "last_xray_stats": {
+                "uplink": int(row["xray_uplink"]),
+                "downlink": int(row["xray_downlink"]),
+                "timestamp": row["xray_at"],
+            },
+        }
+
     @staticmethod
     def _format_key(row: sqlite3.Row) -> Dict[str, Any]:
         # Проверяем наличие поля sni (может отсутствовать в старых БД)
@@ -455,5 +2072,29 @@ class SQLiteStorage:
         }
 
 
-storage = SQLiteStorage()
+_storage_instance: Optional[SQLiteStorage] = None
+_storage_instance_lock = threading.Lock()
+
+
+def get_storage() -> SQLiteStorage:
+    """Общий экземпляр SQLiteStorage, создаётся (и мигрирует схему) при первом вызове."""
+    global _storage_instance
+    if _storage_instance is None:
+        with _storage_instance_lock:
+            if _storage_instance is None:
+                _storage_instance = SQLiteStorage()
+    return _storage_instance
+
+
+class _LazyStorage:
+    """Прокси для `storage`: импорт модуля не открывает БД и не создаёт каталоги."""
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_storage(), name)
+
+    def __repr__(self) -> str:
+        state = "initialized" if _storage_instance is not None else "not initialized"
+        return f"<lazy SQLiteStorage ({state})>"
+
 
+storage = _LazyStorage()
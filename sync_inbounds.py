@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """
-Пересоздание inbound'ов Xray на основе SQLite с использованием HandlerService.
+Сверка inbound'ов Xray с SQLite через HandlerService (применяются только изменения).
+Выполняется из ExecStartPost xray.service и запоминает конфигурацию, с которой
+запущен Xray (для hot-apply без перезапуска).
 Запуск: python3 sync_inbounds.py
 """
 
@@ -10,16 +12,24 @@ import os
 # Добавляем путь к модулям
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from xray_config_manager import update_xray_config_for_keys
+from xray_reconciler import reconcile_xray_inbounds, xray_reconciler
 from storage.sqlite_storage import storage
 
 
 def main():
     keys = storage.get_all_keys()
-    if update_xray_config_for_keys(keys):
-        print(f"Synced {len(keys)} keys with Xray via HandlerService.")
-    else:
-        raise SystemExit("Failed to sync Xray configuration.")
+    report = reconcile_xray_inbounds(keys)
+    if not report.get("applied"):
+        raise SystemExit(f"Failed to sync Xray configuration: {'; '.join(report.get('errors', []))}")
+    xray_reconciler.record_running_config()
+    users_added = sum(len(users) for users in report["users_added"].values())
+    users_removed = sum(len(users) for users in report["users_removed"].values())
+    print(
+        f"Synced {len(keys)} keys with Xray via HandlerService: "
+        f"+{len(report['added'])} -{len(report['removed'])} ~{len(report['altered'])} inbound(s), "
+        f"+{users_added} -{users_removed} user(s), {report['unchanged']} unchanged "
+        f"in {report['duration_ms']} ms."
+    )
 
 
 if __name__ == "__main__":
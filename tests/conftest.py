@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage.sqlite_storage import SQLiteStorage
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Пустая БД во временном каталоге (все миграции применены)"""
+    storage = SQLiteStorage(str(tmp_path / "vpn.db"))
+    yield storage
+    storage.close()
+
+
+def make_key(name: str, **fields):
+    """Запись ключа для create_key/create_key_with_port"""
+    return {
+        "id": f"id-{name}",
+        "name": name,
+        "uuid": f"uuid-{name}",
+        "created_at": "2025-01-01T00:00:00",
+        "is_active": True,
+        "short_id": fields.pop("short_id", name.encode().hex()[:8].ljust(8, "0")),
+        **fields,
+    }
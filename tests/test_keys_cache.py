@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+from conftest import make_key
+from storage.sqlite_storage import SQLiteStorage
+
+
+def test_external_write_invalidates_cache(db):
+    db.create_key(make_key("a"))
+    assert db.get_key_by_uuid("uuid-a")["name"] == "a"
+
+    # Запись в обход SQLiteStorage (sqlite3 CLI, сторонний скрипт) - keys_generation растят триггеры
+    conn = sqlite3.connect(db.db_path)
+    with conn:
+        conn.execute("UPDATE keys SET name = 'renamed' WHERE uuid = 'uuid-a'")
+        conn.execute(
+            "INSERT INTO keys (id, name, uuid, created_at, is_active, short_id) "
+            "VALUES ('id-b', 'b', 'uuid-b', '2025-01-02T00:00:00', 1, 'bbbb0000')"
+        )
+    conn.close()
+
+    assert db.get_key_by_uuid("uuid-a")["name"] == "renamed"
+    assert db.get_key_by_short_id("bbbb0000")["uuid"] == "uuid-b"
+
+
+def test_cache_of_another_process_sees_deletes(db):
+    other = SQLiteStorage(db.db_path)
+    try:
+        db.create_key(make_key("a"))
+        assert other.get_key_by_uuid("uuid-a")
+        db.delete_key_cascade("uuid-a")
+        assert other.get_key_by_uuid("uuid-a") is None
+    finally:
+        other.close()
+
+
+@pytest.mark.parametrize("cache_keys", [True, False])
+def test_shared_port_lookup_is_unambiguous(tmp_path, cache_keys):
+    db = SQLiteStorage(str(tmp_path / "vpn.db"), cache_keys=cache_keys)
+    try:
+        db.create_key(make_key("a", port=443))
+        db.create_key(make_key("b", port=443, created_at="2025-01-02T00:00:00"))
+        db.create_key(make_key("c", port=10001))
+
+        assert [key["uuid"] for key in db.get_keys_by_port(443)] == ["uuid-a", "uuid-b"]
+        with pytest.raises(ValueError, match="shared by 2 keys"):
+            db.get_key_by_port(443)
+        assert db.get_key_by_port(10001)["uuid"] == "uuid-c"
+        assert db.get_key_by_port(10002) is None
+    finally:
+        db.close()
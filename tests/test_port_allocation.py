@@ -0,0 +1,80 @@
+import sqlite3
+
+from conftest import make_key
+
+
+def set_released_at(db, port, released_at):
+    conn = sqlite3.connect(db.db_path)
+    with conn:
+        conn.execute("UPDATE free_ports SET released_at = ? WHERE port = ?", (released_at, port))
+    conn.close()
+
+
+def test_allocation_takes_lowest_never_used_port(db):
+    db.set_port_pools([(20000, 20004)])
+
+    assert [db.create_key_with_port(make_key(name)) for name in "abc"] == [20000, 20001, 20002]
+    assert db.count_free_ports() == 2
+
+
+def test_excluded_ports_are_skipped(db):
+    db.set_port_pools([(20000, 20004)])
+
+    assert db.create_key_with_port(make_key("a"), exclude_ports={20000, 20001}) == 20002
+    assert db.peek_free_ports(2, exclude_ports={20000}) == [20001, 20003]
+
+
+def test_released_port_is_handed_out_last(db):
+    db.set_port_pools([(20000, 20002)])
+    for name in "abc":
+        db.create_key_with_port(make_key(name))
+
+    db.delete_key_cascade("uuid-b")
+    db.delete_key_cascade("uuid-a")
+    set_released_at(db, 20001, "2025-01-01T00:00:00")
+    set_released_at(db, 20000, "2025-01-02T00:00:00")
+
+    # Сначала - давно освобождённый порт, недавно освобождённый уходит в конец очереди
+    assert db.peek_free_ports(3) == [20001, 20000]
+    assert db.create_key_with_port(make_key("d")) == 20001
+
+
+def test_never_used_ports_before_released(db):
+    db.set_port_pools([(20000, 20003)])
+    db.create_key_with_port(make_key("a"))
+    db.delete_key_cascade("uuid-a")
+
+    assert db.peek_free_ports(4) == [20001, 20002, 20003, 20000]
+
+
+def test_quarantine_stats(db):
+    db.set_port_pools([(20000, 20003)])
+    for name in "ab":
+        db.create_key_with_port(make_key(name))
+    db.delete_key_cascade("uuid-a")
+    db.delete_key_cascade("uuid-b")
+    set_released_at(db, 20000, "2000-01-01T00:00:00")
+
+    stats = db.get_port_quarantine_stats(3600)
+    assert stats["free_ports"] == 4
+    assert stats["never_used"] == 2
+    assert stats["released"] == 2
+    assert stats["quarantined"] == 1
+
+
+def test_pool_change_keeps_release_queue(db):
+    db.set_port_pools([(20000, 20003)])
+    db.create_key_with_port(make_key("a"))
+    db.delete_key_cascade("uuid-a")
+
+    db.set_port_pools([(20000, 20005)])
+    assert db.peek_free_ports(6) == [20001, 20002, 20003, 20004, 20005, 20000]
+
+
+def test_port_outside_pools_is_not_returned(db):
+    db.set_port_pools([(20000, 20003)])
+    db.create_key_with_port(make_key("a"))
+    db.set_port_pools([(20001, 20003)])
+
+    db.delete_key_cascade("uuid-a")
+    assert 20000 not in db.peek_free_ports(10)
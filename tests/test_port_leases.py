@@ -0,0 +1,44 @@
+from conftest import make_key
+
+
+def test_abandoned_key_holds_port_until_reconcile(db):
+    """Ошибка применения в Xray: ключ удалён, порт не выдаётся до release_orphaned_ports"""
+    port = db.create_key_with_port(make_key("a"), lease_ttl=120)
+    free_before = db.count_free_ports()
+
+    assert db.abandon_key("uuid-a")
+    assert db.get_key_by_uuid("uuid-a") is None
+    assert db.count_free_ports() == free_before
+    assert db.get_port_quarantine_stats(3600)["orphaned"] == 1
+
+    # inbound мог остаться в Xray - порт не достаётся следующему ключу
+    assert db.create_key_with_port(make_key("b")) != port
+
+    assert db.release_orphaned_ports(["uuid-b"]) == [port]
+    assert db.get_port_quarantine_stats(3600)["orphaned"] == 0
+    assert db.count_free_ports() == free_before
+
+
+def test_expired_lease_holds_port(db):
+    port = db.create_key_with_port(make_key("a"), lease_ttl=-1)
+
+    assert db.reclaim_expired_leases() == ["uuid-a"]
+    assert db.get_key_by_uuid("uuid-a") is None
+    assert db.get_used_ports()[port]["is_active"] is False
+    assert db.create_key_with_port(make_key("b")) != port
+
+
+def test_release_orphaned_ports_keeps_listed_uuids(db):
+    port = db.create_key_with_port(make_key("a"), lease_ttl=120)
+    db.abandon_key("uuid-a")
+
+    assert db.release_orphaned_ports(["uuid-a"]) == []
+    assert port in db.get_used_ports()
+
+
+def test_confirmed_lease_is_not_reclaimed(db):
+    db.create_key_with_port(make_key("a"), lease_ttl=-1)
+    assert db.confirm_port_lease("uuid-a")
+
+    assert db.reclaim_expired_leases() == []
+    assert db.get_key_by_uuid("uuid-a") is not None
@@ -0,0 +1,57 @@
+import json
+import sqlite3
+
+import pytest
+
+import storage.sqlite_storage as sqlite_storage
+from conftest import make_key
+from xray_config_manager import SHARED_INBOUND_TAG, XrayConfigManager
+
+
+@pytest.fixture
+def manager(tmp_path, db, monkeypatch):
+    """Конфигурация с общим inbound, shortIds которого частично заняты ключами в БД"""
+    monkeypatch.setattr(sqlite_storage, "_storage_instance", db)
+    inbound = {
+        "tag": SHARED_INBOUND_TAG,
+        "protocol": "vless",
+        "settings": {"clients": []},
+        "streamSettings": {"realitySettings": {"shortIds": ["aaaa0001", "aaaa0002", "aaaa0003"]}},
+    }
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"inbounds": [inbound]}))
+    return XrayConfigManager(str(config_file))
+
+
+def test_get_used_short_ids(db):
+    db.create_key(make_key("a", short_id="aaaa0001"))
+    db.create_key(make_key("b", short_id="aaaa0002"))
+    assert db.get_used_short_ids(["aaaa0001", "aaaa0002", "aaaa0003", ""]) == {"aaaa0001", "aaaa0002"}
+    assert db.get_used_short_ids([]) == set()
+
+
+def test_spare_short_id_skips_used_and_excluded(db, manager):
+    db.create_key(make_key("a", short_id="aaaa0001"))
+    assert manager.take_spare_short_id(exclude={"aaaa0002"}) == "aaaa0003"
+    assert manager.take_spare_short_id(exclude={"aaaa0002", "aaaa0003"}) is None
+
+
+def test_top_up_skips_short_ids_used_in_db(db, manager, monkeypatch):
+    # Первый сгенерированный кандидат уже занят ключом - в запас он не попадает
+    db.create_key(make_key("a", short_id="bbbb0001"))
+    tokens = iter(["bbbb0001"] + [f"cccc{i:04d}" for i in range(100)])
+    monkeypatch.setattr("xray_config_manager.secrets.token_hex", lambda n: next(tokens))
+    inbound = manager._find_inbound(manager._load_config(), SHARED_INBOUND_TAG)
+
+    added = manager._top_up_spare_short_ids(inbound)
+    short_ids = inbound["streamSettings"]["realitySettings"]["shortIds"]
+    assert added > 0
+    assert "bbbb0001" not in short_ids
+    assert not db.get_used_short_ids(short_ids[3:])
+
+
+def test_duplicate_short_id_is_integrity_error(db):
+    # На это сообщение create_key в API опирается при повторе со свежим shortId
+    db.create_key(make_key("a", short_id="aaaa0001"))
+    with pytest.raises(sqlite3.IntegrityError, match="short_id"):
+        db.create_key_with_port(make_key("b", short_id="aaaa0001"))
@@ -0,0 +1,48 @@
+import gzip
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from conftest import make_key
+
+
+def test_backup_completes_under_concurrent_writes(db, tmp_path):
+    # Коммиты писателя во время снимка не перезапускают копирование
+    for i in range(50):
+        db.create_key_with_port(make_key(f"k{i}"))
+    stop = threading.Event()
+
+    def writer():
+        n = 0
+        while not stop.is_set():
+            db.set_metadata("writer_tick", str(n))
+            n += 1
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        result = db.backup_to(str(tmp_path / "out" / "snap.db"), timeout=30)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert result["path"].endswith(".db.gz") and result["quick_check"] == "ok"
+    restored = tmp_path / "restored.db"
+    with gzip.open(result["path"], "rb") as src:
+        restored.write_bytes(src.read())
+    conn = sqlite3.connect(str(restored))
+    try:
+        assert conn.execute("SELECT COUNT(*) FROM keys").fetchone()[0] == 50
+    finally:
+        conn.close()
+
+
+def test_backup_timeout_removes_partial_snapshot(db, tmp_path):
+    for i in range(50):
+        db.create_key_with_port(make_key(f"k{i}"))
+    target_dir = tmp_path / "out"
+    with pytest.raises(sqlite3.OperationalError, match="timed out"):
+        db.backup_to(str(target_dir / "snap.db"), timeout=0)
+    assert os.listdir(target_dir) == []
@@ -0,0 +1,59 @@
+import sqlite3
+
+from conftest import make_key
+from storage.maintenance import StorageMaintenance
+from storage.sqlite_storage import SQLiteStorage
+
+
+def short_id_indexes(path):
+    conn = sqlite3.connect(path)
+    try:
+        return {
+            row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_keys_short_id%'"
+            )
+        }
+    finally:
+        conn.close()
+
+
+def legacy_duplicates(db):
+    """БД, где миграция 4 оставила обычный индекс из-за повторяющихся short_id"""
+    db.create_key(make_key("a", short_id="dupdup00"))
+    db.create_key(make_key("b", short_id="other000"))
+    conn = sqlite3.connect(db.db_path)
+    with conn:
+        conn.execute("DROP INDEX idx_keys_short_id")
+        conn.execute("CREATE INDEX idx_keys_short_id_nonunique ON keys (short_id)")
+        conn.execute("UPDATE keys SET short_id = 'dupdup00' WHERE uuid = 'uuid-b'")
+    conn.close()
+
+
+def test_startup_does_not_retry_unique_index(db):
+    legacy_duplicates(db)
+    conn = sqlite3.connect(db.db_path)
+    with conn:
+        conn.execute("UPDATE keys SET short_id = 'other000' WHERE uuid = 'uuid-b'")
+    conn.close()
+
+    SQLiteStorage(db.db_path).close()
+    assert short_id_indexes(db.db_path) == {"idx_keys_short_id_nonunique"}
+
+
+def test_maintenance_reports_duplicates_then_creates_index(db):
+    legacy_duplicates(db)
+
+    report = StorageMaintenance(db).run()
+    assert report["short_id_index"] == {
+        "unique": False,
+        "created": False,
+        "duplicates": [{"short_id": "dupdup00", "uuids": ["uuid-a", "uuid-b"]}],
+    }
+    assert short_id_indexes(db.db_path) == {"idx_keys_short_id_nonunique"}
+
+    db.update_key_fields("uuid-b", short_id="other000")
+    report = StorageMaintenance(db).run()
+    assert report["short_id_index"] == {"unique": True, "created": True}
+    assert short_id_indexes(db.db_path) == {"idx_keys_short_id"}
+
+    assert db.ensure_short_id_index() == {"unique": True, "created": False}
@@ -0,0 +1,83 @@
+import io
+import json
+
+import pytest
+
+from conftest import make_key
+from storage.sqlite_storage import SQLiteStorage
+
+
+@pytest.fixture
+def populated(db):
+    for name in ("a", "b", "c", "d", "e"):
+        db.create_key_with_port(make_key(name))
+    db.save_traffic_history_entry("uuid-a", {"total_bytes": 1024}, delta_bytes=1024)
+    db.set_metadata("custom", "value")
+    return db
+
+
+def export(storage, **kwargs) -> str:
+    fh = io.StringIO()
+    storage.export_ndjson(fh, **kwargs)
+    return fh.getvalue()
+
+
+def snapshot(storage):
+    return {
+        "keys": storage.get_all_keys(),
+        "ports": storage.get_used_ports(),
+        "history": {
+            uuid: entry["total_bytes"] for uuid, entry in storage.get_all_traffic_history().items()
+        },
+        "custom": storage.get_metadata("custom"),
+        "free_ports": storage.count_free_ports(),
+    }
+
+
+def test_round_trip(populated, tmp_path):
+    progress = []
+    data = export(populated, batch_size=2, progress=lambda table, rows: progress.append((table, rows)))
+    lines = data.splitlines()
+    assert json.loads(lines[0])["format"] == "vpn-storage-ndjson"
+    assert ("keys", 5) in progress
+
+    target = SQLiteStorage(str(tmp_path / "copy.db"))
+    counts = target.import_ndjson(io.StringIO(data), batch_size=2)
+    assert counts["keys"] == 5 and counts["port_assignments"] == 5
+    assert snapshot(target) == snapshot(populated)
+    target.close()
+
+
+def test_import_skips_or_replaces_existing_rows(populated):
+    data = export(populated, tables=["keys"])
+    populated.update_key_fields("uuid-a", name="renamed")
+
+    populated.import_ndjson(io.StringIO(data))
+    assert populated.get_key_by_uuid("uuid-a")["name"] == "renamed"
+
+    populated.import_ndjson(io.StringIO(data), replace=True)
+    assert populated.get_key_by_uuid("uuid-a")["name"] == "a"
+
+
+@pytest.mark.parametrize(
+    "bad_line",
+    [
+        '{"table": "unknown", "row": {"x": 1}}',
+        '{"table": "keys", "row": {"uuid": "u", "password": "x"}}',
+        '{"format": "vpn-storage-ndjson", "schema_version": 999}',
+    ],
+)
+def test_rejected_import_writes_nothing(db, bad_line):
+    good = json.dumps({"table": "metadata", "row": {"key": "custom", "value": "v"}})
+    with pytest.raises(ValueError):
+        db.import_ndjson([good, bad_line])
+    assert db.get_metadata("custom") is None
+
+
+def test_metadata_only_import_rebuilds_free_ports(db):
+    pools = {"ranges": [[20000, 20009]], "exclude": [20005]}
+    line = json.dumps({"table": "metadata", "row": {"key": "port_pools", "value": json.dumps(pools)}})
+
+    db.import_ndjson([line], replace=True)
+    assert db.count_free_ports() == 9
+    assert db.peek_free_ports(10) == [20000, 20001, 20002, 20003, 20004, 20006, 20007, 20008, 20009]
@@ -0,0 +1,138 @@
+import pytest
+
+pytest.importorskip("grpc")
+
+from xray_api_client import FakeXrayApiServer, XrayApiClient
+
+VLESS_INBOUND = {"tag": "inbound-a", "protocol": "vless", "settings": {"clients": []}}
+CLIENT = {"id": "11111111-2222-3333-4444-555555555555", "email": "user@b", "flow": ""}
+
+
+@pytest.fixture
+def xray_api():
+    """Fake-сервер Xray API и клиент gRPC к нему; вызовы CLI записываются, а не выполняются"""
+    started = []
+
+    def start(inbounds=None, stats=None, unimplemented=(), cli_output=""):
+        server = FakeXrayApiServer(inbounds, stats, unimplemented)
+        client = XrayApiClient(server.start(), xray_binary="/nonexistent/xray", use_grpc=True)
+        started.append((server, client))
+        client.cli_calls = []
+
+        def call_cli(command, extra_args):
+            client.cli_calls.append([command, *extra_args])
+            return cli_output
+
+        client.call_cli = call_cli
+        return server, client
+
+    yield start
+    for server, client in started:
+        client.close()
+        server.stop()
+
+
+def test_list_inbounds(xray_api):
+    server, client = xray_api({"inbound-a": [], "inbound-b": []})
+
+    assert client.list_inbound_tags() == ["inbound-a", "inbound-b"]
+    assert server.calls == ["ListInbounds"]
+    assert client.cli_calls == []
+
+
+def test_remove_inbound(xray_api):
+    server, client = xray_api({"inbound-a": [], "inbound-b": []})
+
+    assert client.remove_inbound("inbound-a")
+    assert not client.remove_inbound("inbound-missing")
+    assert set(server.inbounds) == {"inbound-b"}
+
+
+def test_remove_inbounds_skips_absent_tags(xray_api):
+    server, client = xray_api({"inbound-a": []})
+
+    assert client.remove_inbounds(["inbound-a", "inbound-missing"]) == {
+        "inbound-a": True,
+        "inbound-missing": True,
+    }
+    assert "RemoveInbound inbound-missing" not in server.calls
+
+
+def test_alter_inbound_add_and_remove_user(xray_api):
+    server, client = xray_api({"inbound-a": ["user@a"]})
+
+    assert client.add_user(VLESS_INBOUND, CLIENT)
+    assert server.inbounds["inbound-a"] == {"user@a", "user@b"}
+    assert not client.add_user(VLESS_INBOUND, CLIENT)  # пользователь уже есть
+
+    assert client.remove_user("inbound-a", "user@a")
+    assert server.inbounds["inbound-a"] == {"user@b"}
+    assert not client.remove_user("inbound-a", "user@a")
+    assert client.cli_calls == []
+
+
+def test_query_stats(xray_api):
+    stats = {
+        "user>>>user@a>>>traffic>>>uplink": 300,
+        "user>>>user@a>>>traffic>>>downlink": 2**40,
+        "inbound>>>api>>>traffic>>>uplink": 7,
+    }
+    server, client = xray_api(stats=stats)
+
+    result = client.query_stats("user>>>", reset=True)
+    assert sorted((stat["name"], stat["value"]) for stat in result["stat"]) == [
+        ("user>>>user@a>>>traffic>>>downlink", 2**40),
+        ("user>>>user@a>>>traffic>>>uplink", 300),
+    ]
+    assert server.stats["user>>>user@a>>>traffic>>>uplink"] == 0
+    assert server.stats["inbound>>>api>>>traffic>>>uplink"] == 7
+
+
+def test_get_sys_stats(xray_api):
+    server, client = xray_api()
+
+    result = client.get_sys_stats()
+    assert result["NumGoroutine"] == 12
+    assert result["Alloc"] == 32 * 1024 * 1024
+    assert result["Uptime"] == 3600
+    assert result["NumGC"] == 0
+
+
+def test_list_inbounds_falls_back_to_cli(xray_api):
+    server, client = xray_api(
+        {"inbound-a": []},
+        unimplemented=("ListInbounds",),
+        cli_output='{"inbounds": [{"tag": "inbound-cli"}]}',
+    )
+
+    assert client.list_inbound_tags() == ["inbound-cli"]
+    assert client.cli_calls == [["lsi"]]
+
+
+def test_alter_inbound_falls_back_to_cli(xray_api):
+    server, client = xray_api({"inbound-a": ["user@a"]}, unimplemented=("AlterInbound",))
+
+    assert client.remove_user("inbound-a", "user@a")
+    assert client.cli_calls == [["rmu", "-tag=inbound-a", "user@a"]]
+    assert server.inbounds["inbound-a"] == {"user@a"}
+
+
+def test_stats_fall_back_to_cli(xray_api):
+    server, client = xray_api(
+        unimplemented=("QueryStats", "GetSysStats"),
+        cli_output='{"stat": [{"name": "user>>>user@a>>>traffic>>>uplink", "value": "42"}], "Uptime": 5}',
+    )
+
+    assert client.query_stats("user>>>") == {
+        "stat": [{"name": "user>>>user@a>>>traffic>>>uplink", "value": 42}],
+        "Uptime": 5,
+    }
+    assert client.get_sys_stats()["Uptime"] == 5
+    assert client.cli_calls == [["statsquery", "-pattern", "user>>>"], ["statssys"]]
+
+
+def test_remove_inbound_falls_back_to_cli(xray_api):
+    server, client = xray_api({"inbound-a": []}, unimplemented=("RemoveInbound",))
+
+    assert client.remove_inbound("inbound-a")
+    assert client.cli_calls == [["rmi", "inbound-a"]]
@@ -0,0 +1,194 @@
+import json
+
+import pytest
+
+pytest.importorskip("grpc")
+
+import storage.sqlite_storage as sqlite_storage
+from conftest import make_key
+from xray_api_client import FakeXrayApiServer, XrayApiClient
+from xray_config_backups import ConfigBackupStore
+from xray_config_manager import XrayConfigManager
+from xray_reconciler import XrayReconciler, global_config_hash
+
+BASE_CONFIG = {
+    "log": {"loglevel": "warning"},
+    "api": {"tag": "api", "services": ["HandlerService", "StatsService"]},
+    "inbounds": [
+        {"listen": "127.0.0.1", "port": 10808, "protocol": "dokodemo-door", "tag": "api",
+         "settings": {"address": "127.0.0.1"}},
+    ],
+    "outbounds": [{"protocol": "freedom", "tag": "direct"}],
+    "routing": {"rules": [
+        {"type": "field", "inboundTag": ["api"], "outboundTag": "api"},
+        {"type": "field", "inboundTag": [], "outboundTag": "direct"},
+    ]},
+}
+
+
+class FakeXray:
+    """Fake-сервер Xray API; adi (JSON-конфиги) эмулируется поверх него, теги из fail_add отклоняются"""
+
+    def __init__(self):
+        self.server = FakeXrayApiServer()
+        self.client = XrayApiClient(self.server.start(), xray_binary="/nonexistent/xray", use_grpc=True)
+        self.client._cli_with_config = self._cli_with_config
+        self.fail_add = set()
+
+    def _cli_with_config(self, command, config):
+        assert command == "adi"
+        for inbound in config["inbounds"]:
+            tag = inbound["tag"]
+            if tag in self.fail_add or tag in self.server.inbounds:
+                return False
+            self.server.add_inbound(tag, [client["email"] for client in inbound["settings"]["clients"]])
+        return True
+
+    def stop(self):
+        self.client.close()
+        self.server.stop()
+
+
+@pytest.fixture
+def env(tmp_path, db, monkeypatch):
+    """config.json, keys.env и бэкапы во временном каталоге, БД - tmp, Xray - fake-сервер"""
+    monkeypatch.setattr(sqlite_storage, "_storage_instance", db)
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps(BASE_CONFIG))
+    keys_env = tmp_path / "keys.env"
+    keys_env.write_text("PRIVATE_KEY=test-private\nPUBLIC_KEY=test-public\nSHORT_ID=0123abcd\n")
+
+    manager = XrayConfigManager(str(config_file))
+    manager.keys_env_file = str(keys_env)
+    manager.backups = ConfigBackupStore(str(tmp_path / "backups"))
+    xray = FakeXray()
+    manager.api = xray.client
+    yield manager, XrayReconciler(manager), xray, db
+    xray.stop()
+
+
+def managed_tags(manager):
+    return sorted(i["tag"] for i in manager._load_config()["inbounds"] if i["tag"].startswith("inbound-"))
+
+
+def test_added_then_unchanged(env):
+    manager, reconciler, xray, db = env
+    db.create_key_with_port(make_key("a"))
+    db.create_key_with_port(make_key("b"))
+
+    report = reconciler.reconcile()
+    assert report["applied"] and report["errors"] == []
+    assert sorted(report["added"]) == ["inbound-uuid-a", "inbound-uuid-b"]
+    assert managed_tags(manager) == ["inbound-uuid-a", "inbound-uuid-b"]
+    assert set(xray.server.inbounds) == {"inbound-uuid-a", "inbound-uuid-b"}
+
+    xray.server.calls.clear()
+    report = reconciler.reconcile()
+    assert not report["changed"]
+    assert report["unchanged"] == 2
+    assert xray.server.calls == ["ListInbounds"]
+
+
+def test_removed(env):
+    manager, reconciler, xray, db = env
+    db.create_key_with_port(make_key("a"))
+    db.create_key_with_port(make_key("b"))
+    reconciler.reconcile()
+
+    db.delete_key_cascade("uuid-b")
+    report = reconciler.reconcile()
+    assert report["applied"]
+    assert report["removed"] == ["inbound-uuid-b"]
+    assert managed_tags(manager) == ["inbound-uuid-a"]
+    assert set(xray.server.inbounds) == {"inbound-uuid-a"}
+
+
+def test_altered(env):
+    manager, reconciler, xray, db = env
+    db.create_key_with_port(make_key("a"))
+    reconciler.reconcile()
+
+    db.update_key_fields("uuid-a", short_id="feedbeef")
+    report = reconciler.reconcile()
+    assert report["applied"]
+    assert report["altered"] == ["inbound-uuid-a"]
+    assert "RemoveInbound inbound-uuid-a" in xray.server.calls
+    inbound = manager._find_inbound(manager._load_config(), "inbound-uuid-a")
+    assert inbound["streamSettings"]["realitySettings"]["shortIds"] == ["feedbeef"]
+
+
+def test_partial_add_failure_rolls_back(env):
+    manager, reconciler, xray, db = env
+    db.create_key_with_port(make_key("a"))
+    reconciler.reconcile()
+    config_before = manager.config_model.dumps()
+
+    db.update_key_fields("uuid-a", short_id="feedbeef")
+    db.create_key_with_port(make_key("c"))
+    xray.fail_add.add("inbound-uuid-c")
+    report = reconciler.reconcile()
+
+    assert not report["applied"]
+    assert "add inbound-uuid-c" in report["errors"]
+    assert report["rolled_back"]
+    # Работающий Xray и config.json - как до reconcile
+    assert set(xray.server.inbounds) == {"inbound-uuid-a"}
+    assert manager.config_model.dumps() == config_before
+
+
+def test_rollback_restores_live_only_inbound(env):
+    manager, reconciler, xray, db = env
+    xray.server.add_inbound("inbound-ghost")
+    db.create_key_with_port(make_key("c"))
+    xray.fail_add.add("inbound-uuid-c")
+
+    report = reconciler.reconcile()
+    assert report["removed"] == ["inbound-ghost"]
+    assert not report["applied"] and report["rolled_back"]
+    # inbound был только в работающем Xray - восстановлен по снимку ListInbounds
+    assert "AddInbound inbound-ghost" in xray.server.calls
+    assert set(xray.server.inbounds) == {"inbound-ghost"}
+
+
+def test_missing_ports_written_only_after_apply(env):
+    manager, reconciler, xray, db = env
+    db.create_key(make_key("s", port=10001))  # ключ режима shared: без назначения порта
+
+    report = reconciler.reconcile(dry_run=True)
+    planned = report["ports_planned"]["uuid-s"]
+    assert report["missing_ports"] == ["uuid-s"]
+    assert db.get_port_for_uuid("uuid-s") is None
+
+    xray.fail_add.add("inbound-uuid-s")
+    report = reconciler.reconcile()
+    assert not report["applied"]
+    assert db.get_port_for_uuid("uuid-s") is None
+
+    xray.fail_add.clear()
+    report = reconciler.reconcile()
+    assert report["applied"] and report["ports_assigned"] == ["uuid-s"]
+    assert db.get_port_for_uuid("uuid-s") == planned
+
+
+def test_hot_apply_restarts_only_on_global_change(env):
+    manager, reconciler, xray, db = env
+    restarts = []
+
+    def restart():
+        restarts.append(True)
+        return True
+
+    reconciler.record_running_config()
+    db.create_key_with_port(make_key("a"))
+    result = reconciler.hot_apply(restart=restart)
+    assert result["path"] == "hot" and not result["global_changed"]
+    assert reconciler.hot_apply(restart=restart)["path"] == "noop"
+    assert restarts == []
+
+    config = manager._load_config()
+    config["log"]["loglevel"] = "debug"
+    manager._save_config(config)
+    result = reconciler.hot_apply(restart=restart)
+    assert result["global_changed"] and result["path"] == "restart"
+    assert restarts == [True]
+    assert reconciler.running_config_hash() == global_config_hash(manager._load_config())
@@ -1,17 +1,18 @@
 #!/usr/bin/env python3
 """
-Снапшот-менеджер трафика: для каждого ключа храним только накопительный total_bytes.
+Менеджер трафика: накопительный total_bytes для каждого ключа
+и дельты по минутам/часам/дням в traffic_buckets.
 """
 
-from datetime import datetime
-from typing import Dict, Optional, Any
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Any
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 try:
-    from xray_stats_reader import get_xray_user_traffic
+    from xray_stats_reader import get_xray_user_traffic, get_all_xray_users_traffic
     XRAY_STATS_AVAILABLE = True
 except ImportError:
     XRAY_STATS_AVAILABLE = False
@@ -23,6 +24,7 @@ from storage.sqlite_storage import storage
 
 class TrafficHistoryManager:
     SNAPSHOT_VERSION = "2.0"
+    MINUTE_BUCKETS_RETENTION_DAYS = 2
 
     @staticmethod
     def _new_entry() -> Dict[str, Any]:
@@ -53,10 +55,86 @@ class TrafficHistoryManager:
         if delta > 0:
             entry["total_bytes"] += delta
 
-        entry["last_update"] = datetime.now().isoformat()
-        storage.save_traffic_history_entry(key_uuid, entry)
+        now = datetime.now()
+        entry["last_update"] = now.isoformat()
+        storage.save_traffic_history_entry(
+            key_uuid, entry, delta_bytes=delta, sampled_at=now
+        )
         logger.info("Обновлён total_bytes %s: +%s", key_uuid, delta)
 
+    def update_all_keys_traffic(
+        self,
+        stats_snapshot: Optional[Dict[str, Dict[str, int]]] = None,
+        key_uuids: Optional[List[str]] = None,
+    ) -> int:
+        """
+        Пакетное обновление: один снимок Xray Stats для всех ключей,
+        дельты считаются в памяти и записываются одной транзакцией.
+        Возвращает количество обновлённых ключей.
+        """
+        if stats_snapshot is None and XRAY_STATS_AVAILABLE:
+            stats_snapshot = get_all_xray_users_traffic()
+        if not stats_snapshot:
+            logger.warning("Снимок Xray Stats пуст, пакетное обновление пропущено")
+            return 0
+        if key_uuids is None:
+            key_uuids = list(stats_snapshot.keys())
+
+        entries = storage.get_traffic_history_entries(key_uuids)
+        now = datetime.now()
+        timestamp = now.isoformat()
+        deltas: Dict[str, int] = {}
+        for key_uuid in key_uuids:
+            entry = entries.get(key_uuid) or self._new_entry()
+            stats = stats_snapshot.get(key_uuid) or {}
+            delta = self._apply_xray_stats(entry, stats, timestamp)
+            if delta > 0:
+                entry["total_bytes"] += delta
+                deltas[key_uuid] = delta
+            entry["last_update"] = timestamp
+            entries[key_uuid] = entry
+
+        storage.save_traffic_history_entries(entries, deltas, sampled_at=now)
+        logger.info(
+            "Пакетно обновлён трафик %s ключей, суммарно +%s",
+            len(entries),
+            sum(deltas.values()),
+        )
+        return len(entries)
+
+    @staticmethod
+    def _apply_xray_stats(entry: Dict[str, Any], stats: Dict[str, Any], now: str) -> int:
+        """Дельта между текущими и последними счётчиками Xray (с учётом сброса)."""
+        uplink = int(stats.get("uplink", 0) or 0)
+        downlink = int(stats.get("downlink", 0) or 0)
+        last_stats = entry.get("last_xray_stats", {})
+        last_uplink = int(last_stats.get("uplink", 0) or 0)
+        last_downlink = int(last_stats.get("downlink", 0) or 0)
+
+        uplink_delta = (
+            uplink if uplink < last_uplink else max(0, uplink - last_uplink)
+        )
+        downlink_delta = (
+            downlink
+            if downlink < last_downlink
+            else max(0, downlink - last_downlink)
+        )
+
+        entry["last_xray_stats"] = {
+            "uplink": uplink,
+            "downlink": downlink,
+            "timestamp": now,
+        }
+
+        delta = uplink_delta + downlink_delta
+        if delta > 0:
+            snapshot = entry.setdefault(
+                "last_snapshot", {"total_bytes": 0, "timestamp": None}
+            )
+            snapshot["total_bytes"] = snapshot.get("total_bytes", 0) + delta
+            snapshot["timestamp"] = now
+        return delta
+
     def _calculate_delta(
         self,
         key_uuid: str,
@@ -70,34 +148,7 @@ class TrafficHistoryManager:
         if XRAY_STATS_AVAILABLE:
             try:
                 stats = get_xray_user_traffic(key_uuid)
-                uplink = int(stats.get("uplink", 0) or 0)
-                downlink = int(stats.get("downlink", 0) or 0)
-                last_stats = entry.get("last_xray_stats", {})
-                last_uplink = int(last_stats.get("uplink", 0) or 0)
-                last_downlink = int(last_stats.get("downlink", 0) or 0)
-
-                uplink_delta = (
-                    uplink if uplink < last_uplink else max(0, uplink - last_uplink)
-                )
-                downlink_delta = (
-                    downlink
-                    if downlink < last_downlink
-                    else max(0, downlink - last_downlink)
-                )
-
-                entry["last_xray_stats"] = {
-                    "uplink": uplink,
-                    "downlink": downlink,
-                    "timestamp": now,
-                }
-
-                delta = uplink_delta + downlink_delta
-                if delta > 0:
-                    snapshot = entry.setdefault(
-                        "last_snapshot", {"total_bytes": 0, "timestamp": None}
-                    )
-                    snapshot["total_bytes"] = snapshot.get("total_bytes", 0) + delta
-                    snapshot["timestamp"] = now
+                delta = self._apply_xray_stats(entry, stats, now)
                 return delta, connections
             except Exception as exc:
                 logger.error(
@@ -126,16 +177,16 @@ class TrafficHistoryManager:
         return self._format_key_snapshot(key_uuid, entry)
 
     def get_all_keys_total_traffic(self) -> Dict[str, Any]:
-        history = storage.get_all_traffic_history()
-        total_bytes = sum(entry.get("total_bytes", 0) for entry in history.values())
+        totals = storage.get_traffic_totals()
 
         keys = [
-            self._format_key_snapshot(uuid, entry) for uuid, entry in history.items()
+            {"key_uuid": uuid, "total_traffic": {"total_bytes": total_bytes}}
+            for uuid, total_bytes in totals.items()
         ]
 
         return {
             "total_keys": len(keys),
-            "total_traffic_bytes": total_bytes,
+            "total_traffic_bytes": storage.get_total_traffic_bytes(),
             "last_update": datetime.now().isoformat(),
             "keys": keys,
         }
@@ -143,43 +194,83 @@ class TrafficHistoryManager:
     def get_daily_stats(self, date: Optional[str] = None) -> Dict[str, Any]:
         if date is None:
             date = datetime.now().strftime("%Y-%m-%d")
+        day_start = datetime.strptime(date, "%Y-%m-%d")
+        next_day = (day_start + timedelta(days=1)).strftime("%Y-%m-%d")
+
+        keys: Dict[str, int] = {}
+        for bucket in storage.get_traffic_buckets("day", date, next_day):
+            keys[bucket["key_uuid"]] = bucket["bytes"]
+
+        hourly: Dict[str, int] = {}
+        for bucket in storage.get_traffic_buckets("hour", date, next_day):
+            hour = bucket["bucket_start"][11:16]
+            hourly[hour] = hourly.get(hour, 0) + bucket["bytes"]
+
         return {
             "date": date,
-            "total_bytes": 0,
-            "history_tracking": False,
+            "total_bytes": sum(keys.values()),
+            "keys": keys,
+            "hourly_breakdown": hourly,
+            "history_tracking": True,
         }
 
     def get_monthly_stats(self, year_month: Optional[str] = None) -> Dict[str, Any]:
         if year_month is None:
             year_month = datetime.now().strftime("%Y-%m")
+        start, end = self._month_range(year_month)
 
-        summary = self.get_all_keys_total_traffic()
-        summary.update(
-            {
-                "year_month": year_month,
-                "history_tracking": False,
-            }
-        )
-        return summary
+        keys: Dict[str, int] = {}
+        daily: Dict[str, int] = {}
+        for bucket in storage.get_traffic_buckets("day", start, end):
+            keys[bucket["key_uuid"]] = keys.get(bucket["key_uuid"], 0) + bucket["bytes"]
+            daily[bucket["bucket_start"]] = (
+                daily.get(bucket["bucket_start"], 0) + bucket["bytes"]
+            )
+
+        return {
+            "year_month": year_month,
+            "total_keys": len(keys),
+            "total_traffic_bytes": sum(keys.values()),
+            "last_update": datetime.now().isoformat(),
+            "keys": [
+                {"key_uuid": uuid, "total_traffic": {"total_bytes": total_bytes}}
+                for uuid, total_bytes in keys.items()
+            ],
+            "daily_breakdown": daily,
+            "history_tracking": True,
+        }
 
     def get_key_monthly_traffic(
         self, key_uuid: str, year_month: Optional[str] = None
     ) -> Optional[Dict[str, Any]]:
-        history = storage.get_all_traffic_history()
-        entry = history.get(key_uuid)
+        entry = storage.get_traffic_history_entry(key_uuid)
         if not entry:
             return None
 
+        year_month = year_month or datetime.now().strftime("%Y-%m")
+        start, end = self._month_range(year_month)
+        daily = {
+            bucket["bucket_start"]: bucket["bytes"]
+            for bucket in storage.get_traffic_buckets("day", start, end, key_uuid)
+        }
+
         snapshot = self._format_key_snapshot(key_uuid, entry)
         snapshot.update(
             {
-                "year_month": year_month or datetime.now().strftime("%Y-%m"),
-                "history_tracking": False,
-                "daily_breakdown": {},
+                "year_month": year_month,
+                "month_bytes": sum(daily.values()),
+                "history_tracking": True,
+                "daily_breakdown": daily,
             }
         )
         return snapshot
 
+    @staticmethod
+    def _month_range(year_month: str):
+        month_start = datetime.strptime(year_month, "%Y-%m")
+        next_month = (month_start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return month_start.strftime("%Y-%m-%d"), next_month.strftime("%Y-%m-%d")
+
     def reset_key_traffic(self, key_uuid: str) -> bool:
         success = storage.reset_traffic_history_entry(key_uuid)
         if success:
@@ -187,9 +278,17 @@ class TrafficHistoryManager:
         return success
 
     def cleanup_old_data(self, days_to_keep: int = 30):
-        logger.info(
-            "Очистка snapshot не требуется (храним только накопительные значения)."
-        )
+        """Удаление устаревших minute/hour buckets (дневные храним всегда)."""
+        now = datetime.now()
+        minute_before = (
+            now - timedelta(days=self.MINUTE_BUCKETS_RETENTION_DAYS)
+        ).strftime("%Y-%m-%dT%H:%M")
+        hour_before = (now - timedelta(days=days_to_keep)).strftime("%Y-%m-%dT%H:00")
+        removed = storage.prune_traffic_buckets("minute", minute_before)
+        removed += storage.prune_traffic_buckets("hour", hour_before)
+        if removed:
+            logger.info("Удалено устаревших интервалов трафика: %s", removed)
+        return removed
 
     def _format_key_snapshot(self, key_uuid: str, entry: Dict[str, Any]) -> Dict[str, Any]:
         return {
@@ -14,6 +14,7 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from traffic_history_manager import traffic_history
 from storage.sqlite_storage import storage
+from storage.maintenance import StorageMaintenance
 
 logging.basicConfig(
     level=logging.INFO,
@@ -45,23 +46,43 @@ def main():
     updated_count = 0
     error_count = 0
     
+    key_uuids = []
     for key in active_keys:
-        try:
-            uuid = key.get("uuid")
-            name = key.get("name")
-            port = key.get("port", 0)
-            
-            if not uuid:
-                logger.warning(f"Ключ {name} не имеет UUID, пропускаем")
-                continue
-            
-            # Обновляем статистику (использует Xray Stats API если доступен)
-            traffic_history.update_key_traffic(uuid, name, port)
-            updated_count += 1
-            
-        except Exception as e:
-            logger.error(f"Ошибка обновления статистики для ключа {key.get('name', 'unknown')}: {e}")
-            error_count += 1
+        if not key.get("uuid"):
+            logger.warning(f"Ключ {key.get('name')} не имеет UUID, пропускаем")
+            continue
+        key_uuids.append(key["uuid"])
+    
+    try:
+        # Один запрос к Xray Stats API и одна транзакция на все ключи
+        updated_count = traffic_history.update_all_keys_traffic(key_uuids=key_uuids)
+    except Exception as e:
+        logger.error(f"Ошибка пакетного обновления статистики: {e}")
+        error_count += 1
+    
+    try:
+        traffic_history.cleanup_old_data()
+    except Exception as e:
+        logger.error(f"Ошибка очистки устаревших интервалов трафика: {e}")
+    
+    try:
+        reclaimed = storage.reclaim_expired_leases()
+        if reclaimed:
+            logger.warning(f"Освобождены порты недосозданных ключей: {len(reclaimed)}")
+    except Exception as e:
+        logger.error(f"Ошибка освобождения просроченных аренд портов: {e}")
+    
+    try:
+        # Checkpoint WAL по порогам размера, PRAGMA optimize, incremental vacuum
+        report = StorageMaintenance(storage).run()
+        checkpoint = report.get("checkpoint") or {}
+        logger.info(
+            f"Обслуживание БД: WAL {report['wal_size_before']} -> {report['wal_size_after']} байт, "
+            f"checkpoint {checkpoint.get('mode', 'пропущен')} "
+            f"{checkpoint.get('duration_ms', 0)} мс"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка обслуживания БД: {e}")
     
     logger.info(f"Обновление завершено: {updated_count} успешно, {error_count} ошибок")
     return 0 if error_count == 0 else 1
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+"""
+Клиент Xray API (HandlerService, StatsService) через постоянный gRPC-канал.
+Сообщения protobuf кодируются вручную (несколько полей), сгенерированные
+стабы не нужны. Без пакета grpcio, при XRAY_API_GRPC=0 или если метод не
+реализован сервером - fallback на `xray api ...` (форк бинарника на вызов).
+AddInbound всегда идёт через CLI: JSON-конфиг inbound в protobuf переводит
+только сам xray.
+"""
+
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import grpc
+except ImportError:  # grpcio не установлен - работаем через CLI
+    grpc = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_SERVER = "127.0.0.1:10808"
+DEFAULT_XRAY_BINARY = "/usr/local/bin/xray"
+DEFAULT_TIMEOUT = 5.0
+
+HANDLER_SERVICE = "/xray.app.proxyman.command.HandlerService/"
+STATS_SERVICE = "/xray.app.stats.command.StatsService/"
+ADD_USER_OPERATION = "xray.app.proxyman.command.AddUserOperation"
+REMOVE_USER_OPERATION = "xray.app.proxyman.command.RemoveUserOperation"
+VLESS_ACCOUNT = "xray.proxy.vless.Account"
+
+# Поля SysStatsResponse: номер поля -> имя (как в выводе `xray api statssys`)
+SYS_STATS_FIELDS = {
+    1: "NumGoroutine",
+    2: "NumGC",
+    3: "Alloc",
+    4: "TotalAlloc",
+    5: "Sys",
+    6: "Mallocs",
+    7: "Frees",
+    8: "LiveObjects",
+    9: "PauseTotalNs",
+    10: "Uptime",
+}
+
+
+# ----------------------------------------------------------------------
+# Минимальный protobuf: varint (wire type 0) и length-delimited (2)
+# ----------------------------------------------------------------------
+def _varint(value: int) -> bytes:
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _field_varint(number: int, value: int) -> bytes:
+    if not value:
+        return b""
+    return _varint(number << 3) + _varint(int(value))
+
+
+def _field_bytes(number: int, value) -> bytes:
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if not value:
+        return b""
+    return _varint((number << 3) | 2) + _varint(len(value)) + value
+
+
+def _typed_message(type_name: str, value: bytes) -> bytes:
+    """xray.common.serial.TypedMessage"""
+    return _field_bytes(1, type_name) + _field_bytes(2, value)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(data: bytes) -> Iterator[Tuple[int, Any]]:
+    """(номер поля, значение): int для varint, bytes для length-delimited"""
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = int.from_bytes(data[pos:pos + 8], "little")
+            pos += 8
+        elif wire_type == 5:
+            value = int.from_bytes(data[pos:pos + 4], "little")
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield number, value
+
+
+def _int64(value: int) -> int:
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _encode_user(client: Dict) -> bytes:
+    """xray.common.protocol.User с VLESS-аккаунтом клиента"""
+    account = _field_bytes(1, client["id"]) + _field_bytes(2, client.get("flow", ""))
+    return (
+        _field_varint(1, client.get("level", 0))
+        + _field_bytes(2, client.get("email", ""))
+        + _field_bytes(3, _typed_message(VLESS_ACCOUNT, account))
+    )
+
+
+def _decode_stats(data: bytes) -> Dict[str, List[Dict[str, Any]]]:
+    """QueryStatsResponse -> {"stat": [{"name", "value"}]} как у `xray api statsquery`"""
+    stats = []
+    for number, value in _iter_fields(data):
+        if number != 1:
+            continue
+        stat = {"name": "", "value": 0}
+        for field, field_value in _iter_fields(value):
+            if field == 1:
+                stat["name"] = field_value.decode("utf-8")
+            elif field == 2:
+                stat["value"] = _int64(field_value)
+        stats.append(stat)
+    return {"stat": stats}
+
+
+def _decode_sys_stats(data: bytes) -> Dict[str, int]:
+    result = {name: 0 for name in SYS_STATS_FIELDS.values()}
+    for number, value in _iter_fields(data):
+        if number in SYS_STATS_FIELDS:
+            result[SYS_STATS_FIELDS[number]] = value
+    return result
+
+
+class XrayApiClient:
+    """Вызовы Xray API: gRPC по постоянному каналу, при недоступности - CLI"""
+
+    def __init__(
+        self,
+        server: Optional[str] = None,
+        xray_binary: Optional[str] = None,
+        timeout: Optional[float] = None,
+        use_grpc: Optional[bool] = None,
+    ):
+        self.server = server or os.getenv("XRAY_API_SERVER", DEFAULT_API_SERVER)
+        self.xray_binary = xray_binary or os.getenv("XRAY_BINARY_PATH", DEFAULT_XRAY_BINARY)
+        self.timeout = timeout if timeout is not None else float(
+            os.getenv("XRAY_API_TIMEOUT", DEFAULT_TIMEOUT)
+        )
+        if use_grpc is None:
+            use_grpc = os.getenv("XRAY_API_GRPC", "1") != "0"
+        self.use_grpc = use_grpc and grpc is not None
+        self._guard = threading.Lock()
+        self._pid: Optional[int] = None
+        self._channel = None
+        self._stubs: Dict[str, Any] = {}
+
+    # ------------------------------------------------------------------
+    # gRPC
+    # ------------------------------------------------------------------
+    def _stub(self, method: str):
+        # Канал создаётся при первом вызове и заново после fork (воркеры uvicorn)
+        if self._pid != os.getpid():
+            with self._guard:
+                if self._pid != os.getpid():
+                    self._channel = grpc.insecure_channel(self.server)
+                    self._stubs = {}
+                    self._pid = os.getpid()
+        stub = self._stubs.get(method)
+        if stub is None:
+            stub = self._stubs[method] = self._channel.unary_unary(method)
+        return stub
+
+    def _grpc_call(self, method: str, request: bytes) -> Optional[bytes]:
+        """
+        Ответ сервера (bytes) или None при ошибке. NotImplementedError -
+        сервер не поддерживает метод, вызывающий переходит на CLI.
+        """
+        try:
+            return self._stub(method)(request, timeout=self.timeout)
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                raise NotImplementedError(method)
+            logger.error("Xray API %s failed: %s %s", method.rsplit("/", 1)[-1], e.code(), e.details())
+            return None
+
+    def close(self):
+        with self._guard:
+            if self._channel is not None and self._pid == os.getpid():
+                self._channel.close()
+            self._channel = None
+            self._stubs = {}
+            self._pid = None
+
+    # ------------------------------------------------------------------
+    # CLI fallback
+    # ------------------------------------------------------------------
+    def call_cli(self, command: str, extra_args: List[str]) -> Optional[str]:
+        """`xray api <command>`: stdout или None при ошибке"""
+        if not self.server:
+            return None
+        if not os.path.exists(self.xray_binary):
+            logger.error("Xray binary not found at %s", self.xray_binary)
+            return None
+        cmd = [
+            self.xray_binary,
+            "api",
+            command,
+            f"--server={self.server}",
+            "-t",
+            str(int(self.timeout)),
+        ]
+        cmd.extend(extra_args)
+        try:
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=15  # Увеличено до 15 секунд для стабильности при высокой нагрузке
+            )
+        except subprocess.TimeoutExpired:
+            logger.error("Xray API command %s timed out", command)
+            return None
+        except OSError as e:
+            logger.error("Error calling Xray API %s: %s", command, e)
+            return None
+        if result.returncode != 0:
+            stderr = (result.stderr or "").strip()
+            stdout = (result.stdout or "").strip()
+            logger.error("Xray API command %s failed: %s", command, stderr or stdout)
+            return None
+        return result.stdout
+
+    def _cli_with_config(self, command: str, config: Dict) -> bool:
+        """adi/adu принимают JSON-конфиг файлом"""
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile("w", delete=False, suffix=".json") as tmp:
+                json.dump(config, tmp, ensure_ascii=False)
+                tmp_path = tmp.name
+            return self.call_cli(command, [tmp_path]) is not None
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # ------------------------------------------------------------------
+    # HandlerService
+    # ------------------------------------------------------------------
+    def add_inbound(self, inbound: Dict) -> bool:
+        """AddInbound (через CLI adi)"""
+        return self._cli_with_config("adi", {"inbounds": [inbound]})
+
+    def add_inbounds(self, inbounds: List[Dict]) -> Dict[str, bool]:
+        """
+        Пакетный AddInbound: один вызов adi с файлом из нескольких inbound'ов.
+        adi останавливается на первой ошибке, поэтому при неудаче применённые
+        inbound'ы определяются по ListInbounds, остальные добавляются по одному.
+        Возвращает результат по тегам.
+        """
+        if not inbounds:
+            return {}
+        if self._cli_with_config("adi", {"inbounds": inbounds}):
+            return {inbound.get("tag"): True for inbound in inbounds}
+        live = set(self.list_inbound_tags() or ())
+        return {
+            inbound.get("tag"): inbound.get("tag") in live or self.add_inbound(inbound)
+            for inbound in inbounds
+        }
+
+    def remove_inbounds(self, tags: List[str]) -> Dict[str, bool]:
+        """
+        Пакетный RemoveInbound. Удаляются только inbound'ы, которые есть в Xray
+        (rmi прерывается на первом отсутствующем теге): по gRPC - вызов на тег
+        без форков, через CLI - один rmi со всеми тегами. True - inbound'а нет после вызова.
+        """
+        tags = [tag for tag in tags if tag]
+        if not tags:
+            return {}
+        live = self.list_inbound_tags()
+        if live is None:
+            return {tag: self.remove_inbound(tag) for tag in tags}
+        live = set(live)
+        results = {tag: True for tag in tags if tag not in live}
+        targets = [tag for tag in tags if tag in live]
+        if targets and not self.use_grpc and self.call_cli("rmi", targets) is not None:
+            results.update((tag, True) for tag in targets)
+        else:
+            results.update((tag, self.remove_inbound(tag)) for tag in targets)
+        return results
+
+    def apply_inbounds(self, inbounds: List[Dict]) -> Dict[str, bool]:
+        """Пересоздание inbound'ов пакетом: remove_inbounds, затем add_inbounds"""
+        self.remove_inbounds([inbound.get("tag") for inbound in inbounds])
+        return self.add_inbounds(inbounds)
+
+    def list_inbound_tags(self) -> Optional[List[str]]:
+        """Теги inbound'ов работающего Xray (ListInbounds) или None при ошибке"""
+        if self.use_grpc:
+            try:
+                response = self._grpc_call(HANDLER_SERVICE + "ListInbounds", _field_varint(1, 1))
+                if response is None:
+                    return None
+                return [
+                    dict(_iter_fields(value)).get(1, b"").decode("utf-8")
+                    for number, value in _iter_fields(response) if number == 1
+                ]
+            except NotImplementedError:
+                pass
+        output = self.call_cli("lsi", [])
+        if output is None:
+            return None
+        try:
+            data = json.loads(output) if output.strip() else {}
+        except json.JSONDecodeError as e:
+            logger.error("Failed to parse ListInbounds response: %s", e)
+            return None
+        return [inbound.get("tag", "") for inbound in data.get("inbounds", [])]
+
+    def list_inbound_configs(self) -> Optional[Dict[str, bytes]]:
+        """
+        Полные InboundHandlerConfig работающего Xray (ListInbounds без isOnlyTags)
+        в protobuf по тегам - снимок для отката через add_inbound_config. None -
+        без gRPC или при ошибке (JSON `xray api lsi` в adi не подаётся)
+        """
+        if not self.use_grpc:
+            return None
+        try:
+            response = self._grpc_call(HANDLER_SERVICE + "ListInbounds", b"")
+        except NotImplementedError:
+            return None
+        if response is None:
+            return None
+        return {
+            dict(_iter_fields(value)).get(1, b"").decode("utf-8"): value
+            for number, value in _iter_fields(response) if number == 1
+        }
+
+    def add_inbound_config(self, config: bytes) -> bool:
+        """AddInbound по InboundHandlerConfig из list_inbound_configs (только gRPC)"""
+        if not self.use_grpc:
+            return False
+        try:
+            return self._grpc_call(HANDLER_SERVICE + "AddInbound", _field_bytes(1, config)) is not None
+        except NotImplementedError:
+            return False
+
+    def remove_inbound(self, tag: str) -> bool:
+        """RemoveInbound"""
+        if self.use_grpc:
+            try:
+                return self._grpc_call(HANDLER_SERVICE + "RemoveInbound", _field_bytes(1, tag)) is not None
+            except NotImplementedError:
+                pass
+        return self.call_cli("rmi", [tag]) is not None
+
+    def add_user(self, inbound: Dict, client: Dict) -> bool:
+        """AlterInbound(AddUserOperation): клиент добавляется в работающий inbound"""
+        if self.use_grpc and inbound.get("protocol") == "vless":
+            operation = _typed_message(ADD_USER_OPERATION, _field_bytes(1, _encode_user(client)))
+            try:
+                return self._alter_inbound(inbound["tag"], operation)
+            except NotImplementedError:
+                pass
+        user_inbound = dict(inbound)
+        user_inbound["settings"] = {**inbound.get("settings", {}), "clients": [client]}
+        return self._cli_with_config("adu", {"inbounds": [user_inbound]})
+
+    def remove_user(self, tag: str, email: str) -> bool:
+        """AlterInbound(RemoveUserOperation)"""
+        if self.use_grpc:
+            operation = _typed_message(REMOVE_USER_OPERATION, _field_bytes(1, email))
+            try:
+                return self._alter_inbound(tag, operation)
+            except NotImplementedError:
+                pass
+        return self.call_cli("rmu", [f"-tag={tag}", email]) is not None
+
+    def _alter_inbound(self, tag: str, operation: bytes) -> bool:
+        request = _field_bytes(1, tag) + _field_bytes(2, operation)
+        return self._grpc_call(HANDLER_SERVICE + "AlterInbound", request) is not None
+
+    # ------------------------------------------------------------------
+    # StatsService
+    # ------------------------------------------------------------------
+    def query_stats(self, pattern: str = "", reset: bool = False) -> Optional[Dict]:
+        """QueryStats: {"stat": [{"name", "value"}]} или None при ошибке"""
+        if self.use_grpc:
+            request = _field_bytes(1, pattern) + _field_varint(2, 1 if reset else 0)
+            try:
+                response = self._grpc_call(STATS_SERVICE + "QueryStats", request)
+                return _decode_stats(response) if response is not None else None
+            except NotImplementedError:
+                pass
+        args = ["-pattern", pattern] if pattern else []
+        if reset:
+            args.append("-reset")
+        output = self.call_cli("statsquery", args)
+        if output is None:
+            return None
+        try:
+            data = json.loads(output)
+        except json.JSONDecodeError as e:
+            logger.error("Failed to parse Stats API response: %s", e)
+            return None
+        # protojson отдаёт int64 строкой и опускает нулевые значения
+        for stat in data.get("stat", []):
+            stat["value"] = int(stat.get("value", 0))
+        return data
+
+    def get_sys_stats(self) -> Optional[Dict[str, int]]:
+        """GetSysStats: память, горутины и uptime процесса Xray"""
+        if self.use_grpc:
+            try:
+                response = self._grpc_call(STATS_SERVICE + "GetSysStats", b"")
+                return _decode_sys_stats(response) if response is not None else None
+            except NotImplementedError:
+                pass
+        output = self.call_cli("statssys", [])
+        if output is None:
+            return None
+        try:
+            data = json.loads(output)
+        except json.JSONDecodeError as e:
+            logger.error("Failed to parse Stats API response: %s", e)
+            return None
+        return {name: int(data.get(name, 0)) for name in SYS_STATS_FIELDS.values()}
+
+
+_clients: Dict[Tuple[str, str], XrayApiClient] = {}
+_clients_guard = threading.Lock()
+
+
+def get_xray_api_client(server: Optional[str] = None, xray_binary: Optional[str] = None) -> XrayApiClient:
+    """Общий клиент (и gRPC-канал) на адрес API - для менеджера конфигурации и статистики"""
+    server = server or os.getenv("XRAY_API_SERVER", DEFAULT_API_SERVER)
+    xray_binary = xray_binary or os.getenv("XRAY_BINARY_PATH", DEFAULT_XRAY_BINARY)
+    with _clients_guard:
+        client = _clients.get((server, xray_binary))
+        if client is None:
+            client = _clients[(server, xray_binary)] = XrayApiClient(server, xray_binary)
+        return client
+
+
+# ----------------------------------------------------------------------
+# Локальный fake-сервер HandlerService/StatsService для проверок без Xray
+# ----------------------------------------------------------------------
+class FakeXrayApiServer:
+    """
+    Хранит теги inbound'ов, email клиентов и счётчики статистики в памяти.
+    AddInbound принимает только InboundHandlerConfig из ListInbounds (откат);
+    JSON-конфиги inbound'ов добавляются через CLI adi, как в настоящем Xray.
+    Методы из unimplemented не регистрируются - сервер отвечает UNIMPLEMENTED,
+    как Xray без этого метода (проверка fallback на CLI). Пример:
+
+        server = FakeXrayApiServer({"inbound-a": ["user@a"]})
+        client = XrayApiClient(server.start(), use_grpc=True)
+        client.remove_user("inbound-a", "user@a")
+        server.stop()
+    """
+
+    def __init__(
+        self,
+        inbounds: Optional[Dict[str, List[str]]] = None,
+        stats: Optional[Dict[str, int]] = None,
+        unimplemented: Tuple[str, ...] = (),
+    ):
+        if grpc is None:
+            raise RuntimeError("grpcio is required for FakeXrayApiServer")
+        self.inbounds: Dict[str, set] = {tag: set(emails) for tag, emails in (inbounds or {}).items()}
+        # Полные InboundHandlerConfig; по умолчанию - только тег
+        self.configs: Dict[str, bytes] = {tag: _field_bytes(1, tag) for tag in self.inbounds}
+        self.stats: Dict[str, int] = dict(stats or {})
+        self.unimplemented = set(unimplemented)
+        self.calls: List[str] = []
+        self._server = None
+
+    def start(self, address: str = "127.0.0.1:0") -> str:
+        from concurrent.futures import ThreadPoolExecutor
+
+        handlers = {
+            name: grpc.unary_unary_rpc_method_handler(getattr(self, f"_{name}"))
+            for name in ("AddInbound", "RemoveInbound", "AlterInbound", "ListInbounds")
+            if name not in self.unimplemented
+        }
+        stats_handlers = {
+            name: grpc.unary_unary_rpc_method_handler(getattr(self, f"_{name}"))
+            for name in ("QueryStats", "GetSysStats")
+            if name not in self.unimplemented
+        }
+        self._server = grpc.server(ThreadPoolExecutor(max_workers=4))
+        self._server.add_generic_rpc_handlers((
+            grpc.method_handlers_generic_handler("xray.app.proxyman.command.HandlerService", handlers),
+            grpc.method_handlers_generic_handler("xray.app.stats.command.StatsService", stats_handlers),
+        ))
+        port = self._server.add_insecure_port(address)
+        self._server.start()
+        return f"{address.rsplit(':', 1)[0]}:{port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop(None)
+            self._server = None
+
+    @staticmethod
+    def _fields(request: bytes) -> Dict[int, Any]:
+        return dict(_iter_fields(request))
+
+    def add_inbound(self, tag: str, emails=()):
+        """Inbound в "работающем" Xray (как после adi)"""
+        self.inbounds[tag] = set(emails)
+        self.configs[tag] = _field_bytes(1, tag)
+
+    def _AddInbound(self, request: bytes, context) -> bytes:
+        config = self._fields(request).get(1, b"")
+        tag = self._fields(config).get(1, b"").decode()
+        self.calls.append(f"AddInbound {tag}")
+        if tag in self.inbounds:
+            context.abort(grpc.StatusCode.UNKNOWN, f"existing tag found: {tag}")
+        self.inbounds[tag] = set()
+        self.configs[tag] = config
+        return b""
+
+    def _RemoveInbound(self, request: bytes, context) -> bytes:
+        tag = self._fields(request).get(1, b"").decode()
+        self.calls.append(f"RemoveInbound {tag}")
+        if self.inbounds.pop(tag, None) is None:
+            context.abort(grpc.StatusCode.UNKNOWN, f"handler not found: {tag}")
+        self.configs.pop(tag, None)
+        return b""
+
+    def _ListInbounds(self, request: bytes, context) -> bytes:
+        only_tags = bool(self._fields(request).get(1, 0))
+        self.calls.append("ListInbounds")
+        return b"".join(
+            _field_bytes(1, _field_bytes(1, tag) if only_tags else self.configs.get(tag, _field_bytes(1, tag)))
+            for tag in self.inbounds
+        )
+
+    def _AlterInbound(self, request: bytes, context) -> bytes:
+        fields = self._fields(request)
+        tag = fields.get(1, b"").decode()
+        operation = self._fields(fields.get(2, b""))
+        op_type = operation.get(1, b"").decode()
+        op_value = self._fields(operation.get(2, b""))
+        self.calls.append(f"AlterInbound {tag} {op_type.rsplit('.', 1)[-1]}")
+        if tag not in self.inbounds:
+            context.abort(grpc.StatusCode.UNKNOWN, f"handler not found: {tag}")
+        if op_type == ADD_USER_OPERATION:
+            email = self._fields(op_value.get(1, b"")).get(2, b"").decode()
+            if email in self.inbounds[tag]:
+                context.abort(grpc.StatusCode.UNKNOWN, f"User {email} already exists.")
+            self.inbounds[tag].add(email)
+        elif op_type == REMOVE_USER_OPERATION:
+            email = op_value.get(1, b"").decode()
+            if email not in self.inbounds[tag]:
+                context.abort(grpc.StatusCode.UNKNOWN, f"User {email} not found.")
+            self.inbounds[tag].discard(email)
+        else:
+            context.abort(grpc.StatusCode.UNIMPLEMENTED, op_type)
+        return b""
+
+    def _QueryStats(self, request: bytes, context) -> bytes:
+        fields = self._fields(request)
+        pattern = fields.get(1, b"").decode()
+        reset = bool(fields.get(2, 0))
+        self.calls.append(f"QueryStats {pattern}")
+        response = b""
+        for name, value in self.stats.items():
+            if pattern in name:
+                response += _field_bytes(1, _field_bytes(1, name) + _field_varint(2, value))
+                if reset:
+                    self.stats[name] = 0
+        return response
+
+    def _GetSysStats(self, request: bytes, context) -> bytes:
+        self.calls.append("GetSysStats")
+        return _field_varint(1, 12) + _field_varint(3, 32 * 1024 * 1024) + _field_varint(10, 3600)
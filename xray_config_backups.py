@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Хранилище резервных копий config.json с адресацией по содержимому:
+blob - objects/<sha256>.json.gz (одинаковая конфигурация хранится один раз),
+index.json - записи (id, timestamp, hash, reason, size). Retention по числу
+и возрасту записей; blob удаляется, когда на него не ссылается ни одна запись.
+Восстановление по id - поиск в словаре индекса и чтение одного blob.
+"""
+
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKUPS = int(os.getenv("XRAY_CONFIG_BACKUP_MAX_COUNT", "50"))
+MAX_BACKUP_AGE_DAYS = float(os.getenv("XRAY_CONFIG_BACKUP_MAX_AGE_DAYS", "7"))
+
+# Хранилище общее для vpn-api (vpnapi, UMask=0077) и sync_inbounds.py (root):
+# права задаются явно, а не umask процесса (см. scripts/fix_permissions.sh)
+DIR_MODE = 0o2775
+FILE_MODE = 0o664
+
+
+def _chmod(path: str, mode: int):
+    # Права меняет только владелец; у чужих файлов они выставлены fix_permissions.sh
+    try:
+        os.chmod(path, mode)
+    except PermissionError:
+        pass
+
+
+def _makedirs(path: str):
+    if os.path.isdir(path):
+        return
+    parent = os.path.dirname(path)
+    if parent and parent != path:
+        _makedirs(parent)
+    try:
+        os.mkdir(path)
+    except FileExistsError:
+        return
+    _chmod(path, DIR_MODE)
+
+
+def _write_atomic(path: str, data: bytes):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.chmod(tmp_path, FILE_MODE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ConfigBackupStore:
+    def __init__(
+        self,
+        root: str,
+        max_count: int = MAX_BACKUPS,
+        max_age_days: float = MAX_BACKUP_AGE_DAYS,
+    ):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self.index_file = os.path.join(root, "index.json")
+        self.max_count = max(1, max_count)
+        self.max_age_days = max_age_days
+        self._guard = threading.Lock()
+        self._index: Dict[str, Dict] = {}
+        self._index_stat = None
+
+    @contextmanager
+    def _locked(self):
+        """Блокировка между потоками и процессами (воркеры API, sync_inbounds.py)"""
+        with self._guard:
+            _makedirs(self.objects_dir)
+            lock_path = os.path.join(self.root, ".lock")
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, FILE_MODE)
+            try:
+                _chmod(lock_path, FILE_MODE)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    self._load_index()
+                    yield
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+    def _load_index(self):
+        try:
+            st = os.stat(self.index_file)
+        except FileNotFoundError:
+            self._index, self._index_stat = {}, None
+            return
+        stat = (st.st_mtime_ns, st.st_size)
+        if stat == self._index_stat:
+            return
+        try:
+            with open(self.index_file, "r") as f:
+                self._index = {entry["id"]: entry for entry in json.load(f)}
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error("Corrupted backup index %s: %s", self.index_file, e)
+            self._index = {}
+        self._index_stat = stat
+
+    def _save_index(self):
+        data = json.dumps(list(self._index.values()), separators=(",", ":")).encode("utf-8")
+        _write_atomic(self.index_file, data)
+        st = os.stat(self.index_file)
+        self._index_stat = (st.st_mtime_ns, st.st_size)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, f"{digest}.json.gz")
+
+    def put(self, data: bytes, reason: str = "") -> str:
+        """Сохранить конфигурацию; возвращает id записи"""
+        digest = hashlib.sha256(data).hexdigest()
+        with self._locked():
+            latest = next(reversed(self._index.values()), None)
+            if latest is not None and latest["hash"] == digest:
+                return latest["id"]  # Конфигурация не менялась с последнего бэкапа
+            blob_path = self._blob_path(digest)
+            if not os.path.exists(blob_path):
+                _write_atomic(blob_path, gzip.compress(data, compresslevel=6))
+            now = datetime.now()
+            backup_id = f"{now.strftime('%Y%m%d_%H%M%S_%f')}_{digest[:12]}"
+            self._index[backup_id] = {
+                "id": backup_id,
+                "timestamp": now.isoformat(),
+                "hash": digest,
+                "reason": reason,
+                "size": len(data),
+            }
+            self._apply_retention(now)
+            self._save_index()
+            return backup_id
+
+    def _apply_retention(self, now: datetime):
+        entries = list(self._index.values())
+        expired = now - timedelta(days=self.max_age_days) if self.max_age_days > 0 else None
+        # Самая свежая запись сохраняется всегда
+        keep = entries[-self.max_count:]
+        if expired is not None:
+            keep = [e for e in keep[:-1] if datetime.fromisoformat(e["timestamp"]) >= expired] + keep[-1:]
+        kept_ids = {e["id"] for e in keep}
+        dropped = [e for e in entries if e["id"] not in kept_ids]
+        if not dropped:
+            return
+        self._index = {e["id"]: e for e in keep}
+        live_hashes = {e["hash"] for e in keep}
+        for digest in {e["hash"] for e in dropped} - live_hashes:
+            try:
+                os.remove(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def get(self, backup_id: str) -> Optional[bytes]:
+        """Содержимое конфигурации по id или None"""
+        with self._locked():
+            entry = self._index.get(backup_id)
+        if entry is None:
+            return None
+        try:
+            with open(self._blob_path(entry["hash"]), "rb") as f:
+                return gzip.decompress(f.read())
+        except FileNotFoundError:
+            logger.error("Backup blob for %s is missing", backup_id)
+            return None
+
+    def list(self) -> List[Dict]:
+        """Записи от новых к старым"""
+        with self._locked():
+            return list(reversed(list(self._index.values())))
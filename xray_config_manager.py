@@ -3,28 +3,54 @@
 Исправленный модуль управления конфигурацией Xray с централизованными Reality ключами
 """
 
+import functools
 import json
 import os
-import subprocess
 import secrets
 import string
-import shutil
-import tempfile
-from typing import Dict, List, Optional
-from datetime import datetime
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from port_manager import port_manager
+from port_manager import port_manager, SHARED_INBOUND_TAG
+from xray_api_client import get_xray_api_client
+from xray_config_model import get_config_model, ConfigConflictError
+from xray_config_backups import ConfigBackupStore
+
+# Запас shortIds в общем inbound: новый ключ получает свободный shortId
+# и добавляется через adu, inbound пересоздаётся только когда запас кончился
+SHARED_SPARE_SHORT_IDS = int(os.getenv("XRAY_SHARED_SPARE_SHORT_IDS", "32"))
+
+
+def config_batch(method):
+    """
+    Все _save_config/_restore_backup внутри метода - одна атомарная запись
+    config.json при выходе (откат после ошибки API не пишет файл вовсе).
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            with self.config_model.batch():
+                return method(self, *args, **kwargs)
+        except (OSError, ConfigConflictError) as e:
+            print(f"Error saving config: {e}")
+            return False
+    return wrapper
 
 class XrayConfigManager:
     def __init__(self, config_file: str = "/root/vpn-server/config/config.json"):
         self.config_file = config_file
+        # Разобранная конфигурация в памяти, атомарная запись на диск
+        self.config_model = get_config_model(config_file)
         self.backup_dir = "/root/vpn-server/config/backups"
+        # Бэкапы config.json с адресацией по содержимому и retention (см. xray_config_backups)
+        self.backups = ConfigBackupStore(os.path.join(self.backup_dir, "xray-config"))
         self.keys_env_file = "/root/vpn-server/config/keys.env"
         self.xray_api_server = os.getenv("XRAY_API_SERVER", "127.0.0.1:10808")
         self.xray_binary = os.getenv("XRAY_BINARY_PATH", "/usr/local/bin/xray")
-        
-        # Создаем директорию для бэкапов
-        os.makedirs(self.backup_dir, exist_ok=True)
+        # Общий с XrayStatsReader клиент: постоянный gRPC-канал, fallback на CLI
+        self.api = get_xray_api_client(self.xray_api_server, self.xray_binary)
+        # Результат последнего пакетного применения inbounds (update_config_for_keys)
+        self.last_apply_report: Optional[Dict] = None
     
     def _load_reality_keys(self) -> Dict[str, str]:
         """Загрузка Reality ключей из keys.env"""
@@ -50,8 +76,10 @@ class XrayConfigManager:
     def _load_config(self) -> Optional[Dict]:
         """Загрузка конфигурации Xray"""
         try:
-            with open(self.config_file, 'r') as f:
-                return json.load(f)
+            config = self.config_model.load()
+            if config is None:
+                print(f"Error loading config: {self.config_file} not found")
+            return config
         except Exception as e:
             print(f"Error loading config: {e}")
             return None
@@ -59,59 +87,29 @@ class XrayConfigManager:
     def _save_config(self, config: Dict) -> bool:
         """Сохранение конфигурации Xray"""
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(config, f, indent=2)
+            self.config_model.save(config)
             return True
         except Exception as e:
             print(f"Error saving config: {e}")
             return False
     
-    def _restore_backup(self, backup_file: str):
-        """Восстановление конфигурации из резервной копии"""
-        if not backup_file or not os.path.exists(backup_file):
+    def _restore_backup(self, backup_id: str):
+        """Восстановление конфигурации из резервной копии по id"""
+        if not backup_id:
             return
         try:
-            shutil.copy2(backup_file, self.config_file)
-            print(f"Configuration restored from backup {backup_file}")
+            data = self.backups.get(backup_id)
+            if data is None:
+                print(f"Backup {backup_id} not found")
+                return
+            self.config_model.save(json.loads(data))
+            print(f"Configuration restored from backup {backup_id}")
         except Exception as e:
-            print(f"Error restoring backup {backup_file}: {e}")
+            print(f"Error restoring backup {backup_id}: {e}")
 
     def _call_xray_api(self, command: str, extra_args: List[str]) -> bool:
-        """Вызов команды xray api"""
-        if not self.xray_api_server:
-            return False
-        if not os.path.exists(self.xray_binary):
-            print(f"Xray binary not found at {self.xray_binary}")
-            return False
-        try:
-            cmd = [
-                self.xray_binary,
-                "api",
-                command,
-                f"--server={self.xray_api_server}",
-                "-t",
-                "5",
-            ]
-            cmd.extend(extra_args)
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=15  # Увеличено до 15 секунд для стабильности при высокой нагрузке
-            )
-            if result.returncode != 0:
-                stderr = (result.stderr or "").strip()
-                stdout = (result.stdout or "").strip()
-                print(f"Xray API command {command} failed: {stderr or stdout}")
-                return False
-            return True
-        except FileNotFoundError:
-            print("Xray binary not found for API calls")
-        except subprocess.TimeoutExpired:
-            print(f"Xray API command {command} timed out")
-        except Exception as e:
-            print(f"Error calling Xray API {command}: {e}")
-        return False
+        """Вызов команды xray api (CLI)"""
+        return self.api.call_cli(command, extra_args) is not None
 
     def _apply_inbound_via_api(self, inbound: Dict) -> bool:
         """Применение inbound через Xray API без перезапуска"""
@@ -119,32 +117,48 @@ class XrayConfigManager:
             return False
         tag = inbound.get("tag")
         if tag:
-            self._call_xray_api("rmi", [tag])
-        try:
-            with tempfile.NamedTemporaryFile("w", delete=False, suffix=".json") as tmp:
-                json.dump({"inbounds": [inbound]}, tmp, ensure_ascii=False)
-                tmp_path = tmp.name
-            return self._call_xray_api("adi", [tmp_path])
-        finally:
-            if 'tmp_path' in locals() and os.path.exists(tmp_path):
-                os.remove(tmp_path)
+            self.api.remove_inbound(tag)
+        return self.api.add_inbound(inbound)
+
+    def _apply_inbounds_via_api(self, inbounds: List[Dict], remove_tags: List[str] = ()) -> Dict[str, bool]:
+        """
+        Пакетное применение inbounds: один проход удаления (inbounds и remove_tags)
+        и один adi со всеми inbounds. Результат по тегам - в last_apply_report.
+        """
+        started = time.monotonic()
+        tags = [inbound.get("tag") for inbound in inbounds if inbound.get("tag")]
+        removed = self.api.remove_inbounds(list(remove_tags) + tags)
+        results = self.api.add_inbounds(inbounds)
+        self.last_apply_report = {
+            "applied": [tag for tag, ok in results.items() if ok],
+            "failed": [tag for tag, ok in results.items() if not ok],
+            "removed": [tag for tag in remove_tags if removed.get(tag)],
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+        }
+        return results
 
     def _remove_inbound_via_api(self, tag: str) -> bool:
         """Удаление inbound через Xray API"""
         if not tag:
             return False
-        return self._call_xray_api("rmi", [tag])
+        return self.api.remove_inbound(tag)
+
+    def _add_user_via_api(self, inbound: Dict, client: Dict) -> bool:
+        """Добавление клиента в работающий inbound (AlterInbound/adu) без его пересоздания"""
+        return self.api.add_user(inbound, client)
+
+    def _remove_user_via_api(self, tag: str, email: str) -> bool:
+        """Удаление клиента из работающего inbound (AlterInbound/rmu)"""
+        return self.api.remove_user(tag, email)
     
-    def _backup_config(self) -> str:
-        """Создание резервной копии конфигурации"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_file = os.path.join(self.backup_dir, f"config_backup_{timestamp}.json")
-        
+    def _backup_config(self, reason: str = "") -> str:
+        """Создание резервной копии конфигурации; возвращает id бэкапа"""
         try:
-            with open(self.config_file, 'r') as src:
-                with open(backup_file, 'w') as dst:
-                    dst.write(src.read())
-            return backup_file
+            # Бэкап текущего состояния модели (внутри batch оно может быть ещё не записано)
+            data = self.config_model.dumps()
+            if data is None:
+                raise FileNotFoundError(self.config_file)
+            return self.backups.put(data, reason)
         except Exception as e:
             print(f"Error creating backup: {e}")
             return ""
@@ -224,6 +238,12 @@ class XrayConfigManager:
         """Создание inbound для ключа с централизованными Reality ключами"""
         # Получаем порт для ключа
         port = port_manager.get_port_for_uuid(uuid)
+        if not port:
+            # Ключ, созданный в режиме shared, получает порт из пула при переходе на per_key
+            from storage.sqlite_storage import storage
+            key = storage.get_key_by_uuid(uuid)
+            if key:
+                port = port_manager.assign_port(uuid, key["id"], key_name)
         if not port:
             print(f"No port assigned for UUID: {uuid}")
             return None
@@ -234,17 +254,151 @@ class XrayConfigManager:
             print("Error: Centralized Reality keys not found")
             return None
 
+        return self._build_reality_inbound(
+            port, f"inbound-{uuid}", [self._client_entry(uuid)],
+            self._short_ids_for_key(short_id, reality_keys), reality_keys
+        )
+
+    @staticmethod
+    def _short_ids_for_key(short_id: Optional[str], reality_keys: Dict[str, str]) -> List[str]:
         # Используем индивидуальный short_id для каждого ключа (для разделения пользователей)
         # Если short_id передан - используем его, иначе fallback на централизованный
         if short_id:
-            short_ids = [short_id]  # Индивидуальный short_id для ключа
-        elif reality_keys.get('short_id'):
-            short_ids = [reality_keys['short_id']]  # Fallback на централизованный
-        else:
-            # Последний fallback
-            print("WARNING: No short_id provided and centralized short_id not found")
-            short_ids = ["2680beb40ea2fde0"]
+            return [short_id]  # Индивидуальный short_id для ключа
+        if reality_keys.get('short_id'):
+            return [reality_keys['short_id']]  # Fallback на централизованный
+        # Последний fallback
+        print("WARNING: No short_id provided and centralized short_id not found")
+        return ["2680beb40ea2fde0"]
+
+    def create_shared_inbound(self, keys: List[Dict], existing_short_ids: Optional[List[str]] = None) -> Optional[Dict]:
+        """
+        Общий inbound: активные ключи - клиенты одного inbound, у каждого свой
+        email (uuid, для статистики) и свой shortId. Порядок existing_short_ids
+        сохраняется (свободные остаются в запасе), запас пополняется, только когда кончился.
+        """
+        reality_keys = self._load_reality_keys()
+        if not reality_keys.get('private_key'):
+            print("Error: Centralized Reality keys not found")
+            return None
+        
+        clients = []
+        short_ids = list(existing_short_ids or [])
+        for key in keys:
+            if not key.get("is_active", True):
+                continue
+            clients.append(self._client_entry(key["uuid"]))
+            if key.get("short_id"):
+                # Обрезаем short_id до 8 символов для Android совместимости
+                short_id = key["short_id"][:8]
+                if short_id not in short_ids:
+                    short_ids.append(short_id)
+        
+        inbound = self._build_reality_inbound(
+            port_manager.shared_port, SHARED_INBOUND_TAG, clients, short_ids, reality_keys
+        )
+        if not self._spare_short_ids(inbound, keys):
+            self._top_up_spare_short_ids(inbound, keys)
+        return inbound
+
+    def build_inbounds_for_keys(
+        self,
+        keys: List[Dict],
+        config: Optional[Dict] = None,
+        missing_ports: Optional[List[str]] = None,
+        planned_ports: Optional[Dict[str, int]] = None,
+    ) -> List[Dict]:
+        """
+        Желаемые inbounds для ключей из SQLite (без обращения к Xray и без записи
+        в БД): общий inbound в режиме shared, иначе inbound на активный ключ. Порты
+        читаются одним запросом; ключи без порта добавляются в missing_ports и
+        получают порт из planned_ports (см. plan_missing_ports), без него пропускаются.
+        """
+        if port_manager.shared_mode:
+            existing = self._find_inbound(config, SHARED_INBOUND_TAG) if config else None
+            existing_short_ids = (
+                existing.get("streamSettings", {}).get("realitySettings", {}).get("shortIds", [])
+                if existing else None
+            )
+            inbound = self.create_shared_inbound(keys, existing_short_ids)
+            return [inbound] if inbound else []
+        
+        reality_keys = self._load_reality_keys()
+        if not reality_keys.get('private_key'):
+            print("Error: Centralized Reality keys not found")
+            return []
+        from storage.sqlite_storage import storage
+        ports = {info["uuid"]: port for port, info in storage.get_used_ports().items()}
         
+        inbounds = []
+        for key in keys:
+            if not key.get("is_active", True):
+                continue
+            uuid = key["uuid"]
+            # Обрезаем short_id до 8 символов для Android совместимости
+            short_id = key["short_id"][:8] if key.get("short_id") else None
+            port = ports.get(uuid)
+            if port is None:
+                if missing_ports is not None:
+                    missing_ports.append(uuid)
+                port = (planned_ports or {}).get(uuid)
+                if port is None:
+                    continue
+            inbounds.append(self._build_reality_inbound(
+                port, f"inbound-{uuid}", [self._client_entry(uuid)],
+                self._short_ids_for_key(short_id, reality_keys), reality_keys
+            ))
+        return inbounds
+
+    def plan_missing_ports(self, keys: List[Dict]) -> Dict[str, int]:
+        """
+        Порты из пула для активных ключей без порта (созданных в режиме shared)
+        при работе в режиме per_key - без записи в БД: назначаются
+        commit_planned_ports после успешного применения.
+        """
+        if port_manager.shared_mode:
+            return {}
+        from storage.sqlite_storage import storage
+        assigned = {info["uuid"] for info in storage.get_used_ports().values()}
+        missing = [
+            key["uuid"] for key in keys
+            if key.get("is_active", True) and key["uuid"] not in assigned
+        ]
+        if not missing:
+            return {}
+        ports = port_manager.get_available_ports(len(missing))
+        for uuid in missing[len(ports):]:
+            print(f"No free port for key {uuid}")
+        return dict(zip(missing, ports))
+
+    def commit_planned_ports(self, keys: List[Dict], planned_ports: Dict[str, int]) -> Tuple[List[str], List[str]]:
+        """
+        Запись портов из плана. Возвращает (uuid получивших порт, uuid, чей порт
+        успел занять другой ключ - следующий reconcile назначит им новый).
+        """
+        by_uuid = {key["uuid"]: key for key in keys}
+        assigned, conflicts = [], []
+        for uuid, port in planned_ports.items():
+            key = by_uuid[uuid]
+            if port_manager.assign_specific_port(uuid, key["id"], key["name"], port):
+                assigned.append(uuid)
+            else:
+                print(f"Planned port {port} for key {uuid} was taken by another key")
+                conflicts.append(uuid)
+        return assigned, conflicts
+
+    @staticmethod
+    def _client_entry(uuid: str) -> Dict:
+        return {
+            "id": uuid,
+            "flow": "",
+            "email": uuid,
+            "level": 1  # Явно установлен для Android совместимости
+        }
+
+    @staticmethod
+    def _build_reality_inbound(port: int, tag: str, clients: List[Dict], short_ids: List[str], reality_keys: Dict[str, str]) -> Dict:
+        """VLESS+Reality inbound с централизованными ключами"""
         # Используем фиксированный serverName для всех ключей (iOS и Android совместимость)
         server_names_list = [
             "www.microsoft.com",
@@ -261,19 +415,12 @@ class XrayConfigManager:
         server_name = "www.microsoft.com"
         
         # Создаем inbound конфигурацию с централизованными ключами
-        inbound = {
+        return {
             "listen": "0.0.0.0",
             "port": port,
             "protocol": "vless",
             "settings": {
-                "clients": [
-                    {
-                        "id": uuid,
-                        "flow": "",
-                        "email": uuid,
-                        "level": 1  # Явно установлен для Android совместимости
-                    }
-                ],
+                "clients": clients,
                 "decryption": "none"
             },
             "streamSettings": {
@@ -293,16 +440,73 @@ class XrayConfigManager:
                     "maxTimeDiff": 600
                 }
             },
-            "tag": f"inbound-{uuid}"
+            "tag": tag
         }
-        
-        return inbound
-    
+
+    @staticmethod
+    def _find_inbound(config: Dict, tag: str) -> Optional[Dict]:
+        for inbound in config.get("inbounds", []):
+            if inbound.get("tag") == tag:
+                return inbound
+        return None
+
+    @staticmethod
+    def _spare_short_ids(inbound: Dict, keys: Optional[List[Dict]] = None) -> List[str]:
+        """shortIds общего inbound, не занятые ни одним ключом"""
+        short_ids = inbound.get("streamSettings", {}).get("realitySettings", {}).get("shortIds", [])
+        if keys is None:
+            # Занятые shortIds - одним запросом к keys
+            from storage.sqlite_storage import storage
+            used = storage.get_used_short_ids(short_ids)
+            return [sid for sid in short_ids if sid not in used]
+        used = {key["short_id"][:8] for key in keys if key.get("short_id")}
+        used.update(key["short_id"] for key in keys if key.get("short_id"))
+        return [sid for sid in short_ids if sid not in used]
+
+    def _top_up_spare_short_ids(self, inbound: Dict, keys: Optional[List[Dict]] = None) -> int:
+        """Пополнение запаса свободных shortIds общего inbound; возвращает число добавленных"""
+        short_ids = inbound["streamSettings"]["realitySettings"].setdefault("shortIds", [])
+        missing = SHARED_SPARE_SHORT_IDS - len(self._spare_short_ids(inbound, keys))
+        added = 0
+        while added < missing:
+            candidates = [secrets.token_hex(4) for _ in range(missing - added)]
+            # Не выдаём в запас shortIds, уже занятые ключами в БД
+            if keys is None:
+                from storage.sqlite_storage import storage
+                used = storage.get_used_short_ids(candidates)
+            else:
+                used = {key["short_id"] for key in keys if key.get("short_id")}
+            for short_id in candidates:
+                if short_id not in short_ids and short_id not in used:
+                    short_ids.append(short_id)
+                    added += 1
+        return added
+
+    def take_spare_short_id(self, exclude: Iterable[str] = ()) -> Optional[str]:
+        """
+        Свободный shortId общего inbound для нового ключа (None - запаса нет).
+        exclude - shortIds, уже отвергнутые вызывающим (конфликт при вставке).
+        """
+        config = self._load_config()
+        inbound = self._find_inbound(config, SHARED_INBOUND_TAG) if config else None
+        if not inbound:
+            return None
+        excluded = set(exclude)
+        spare = [sid for sid in self._spare_short_ids(inbound) if sid not in excluded]
+        # Случайный выбор - параллельные создания реже получают один и тот же shortId
+        return secrets.choice(spare) if spare else None
+
+    @config_batch
     def add_key_to_config(self, uuid: str, key_name: str, short_id: Optional[str] = None) -> bool:
         """Добавление ключа в конфигурацию Xray с проверкой Reality ключей"""
+        if port_manager.shared_mode:
+            return self._add_key_to_shared_inbound(uuid, short_id)
         try:
             # Создаем резервную копию
-            backup_file = self._backup_config()
+            backup_file = self._backup_config(f"add key {uuid}")
+            if not backup_file:
+                # Без точки восстановления изменения не применяются
+                return False
             
             # Загружаем конфигурацию
             config = self._load_config()
@@ -356,17 +560,108 @@ class XrayConfigManager:
             print(f"Error adding key to config: {e}")
             return False
     
+    def _add_key_to_shared_inbound(self, uuid: str, short_id: Optional[str] = None) -> bool:
+        """
+        Добавление ключа клиентом общего inbound. Если shortId ключа уже есть
+        в inbound (из запаса), клиент добавляется через adu без пересоздания
+        inbound; иначе inbound пересоздаётся с пополненным запасом shortIds.
+        """
+        try:
+            backup_file = self._backup_config(f"add key {uuid}")
+            if not backup_file:
+                # Без точки восстановления изменения не применяются
+                return False
+            
+            config = self._load_config()
+            if not config:
+                return False
+            
+            inbound = self._find_inbound(config, SHARED_INBOUND_TAG)
+            reapply = inbound is None
+            if inbound is None:
+                inbound = self.create_shared_inbound([])
+                if not inbound:
+                    return False
+                config["inbounds"].append(inbound)
+            
+            clients = inbound["settings"].setdefault("clients", [])
+            client = self._client_entry(uuid)
+            if not any(c.get("id") == uuid for c in clients):
+                clients.append(client)
+            
+            reality_settings = inbound["streamSettings"]["realitySettings"]
+            reality_keys = self._load_reality_keys()
+            if reality_keys.get('private_key') and reality_settings.get("privateKey") != reality_keys['private_key']:
+                reality_settings["privateKey"] = reality_keys['private_key']
+                reapply = True
+            short_ids = reality_settings.setdefault("shortIds", [])
+            if short_id and short_id not in short_ids:
+                short_ids.append(short_id)
+                self._top_up_spare_short_ids(inbound)
+                reapply = True
+            
+            self._update_routing_rules(config)
+            
+            if not self._validate_config(config):
+                print("Configuration validation failed")
+                return False
+            
+            if not self._save_config(config):
+                return False
+            
+            # adu не трогает shortIds и соединения остальных клиентов; если
+            # inbound в Xray отсутствует (adu не прошёл) - пересоздаём его целиком
+            if not reapply and self._add_user_via_api(inbound, client):
+                print(f"Successfully added key {uuid} to shared inbound")
+                return True
+            if self._apply_inbound_via_api(inbound):
+                print(f"Successfully added key {uuid} to shared inbound (inbound re-applied)")
+                return True
+            print(f"Failed to apply shared inbound for key {uuid} via Xray API, restoring backup")
+            self._restore_backup(backup_file)
+            return False
+            
+        except Exception as e:
+            print(f"Error adding key to shared inbound: {e}")
+            return False
+    
+    def _remove_key_from_shared_inbound(self, config: Dict, inbound: Dict, uuid: str, backup_file: str) -> bool:
+        """Удаление клиента общего inbound; его shortId остаётся в запасе"""
+        inbound["settings"]["clients"] = [
+            client for client in inbound["settings"].get("clients", [])
+            if client.get("id") != uuid
+        ]
+        
+        if not self._save_config(config):
+            return False
+        if self._remove_user_via_api(SHARED_INBOUND_TAG, uuid):
+            return True
+        print(f"Failed to remove user {uuid} from shared inbound via Xray API, restoring backup")
+        self._restore_backup(backup_file)
+        return False
+    
+    @config_batch
     def remove_key_from_config(self, uuid: str) -> bool:
         """Удаление ключа из конфигурации Xray"""
         try:
             # Создаем резервную копию
-            backup_file = self._backup_config()
+            backup_file = self._backup_config(f"remove key {uuid}")
+            if not backup_file:
+                # Без точки восстановления изменения не применяются
+                return False
             
             # Загружаем конфигурацию
             config = self._load_config()
             if not config:
                 return False
             
+            # Ключ общего inbound (режим определяется по конфигурации, а не по XRAY_INBOUND_MODE,
+            # чтобы после смены режима удалялись и ключи, созданные в прежнем)
+            shared_inbound = self._find_inbound(config, SHARED_INBOUND_TAG)
+            if (shared_inbound and not self._find_inbound(config, f"inbound-{uuid}") and
+                    any(c.get("id") == uuid for c in shared_inbound.get("settings", {}).get("clients", []))):
+                return self._remove_key_from_shared_inbound(config, shared_inbound, uuid, backup_file)
+            
             # Удаляем inbound для ключа
             config["inbounds"] = [
                 inbound for inbound in config["inbounds"]
@@ -395,11 +690,17 @@ class XrayConfigManager:
             print(f"Error removing key from config: {e}")
             return False
     
+    @config_batch
     def update_config_for_keys(self, keys: List[Dict]) -> bool:
         """Обновление конфигурации для всех ключей с централизованными ключами"""
+        if port_manager.shared_mode:
+            return self._update_shared_config_for_keys(keys)
         try:
             # Создаем резервную копию
-            backup_file = self._backup_config()
+            backup_file = self._backup_config("update config for keys")
+            if not backup_file:
+                # Без точки восстановления изменения не применяются
+                return False
             
             # Загружаем базовую конфигурацию
             config = self._load_config()
@@ -500,19 +801,18 @@ class XrayConfigManager:
             if not self._save_config(config):
                 return False
 
-            # Обновляем inbounds через API (если доступен HandlerService)
+            # Обновляем inbounds через API пакетом: устаревшие удаляются вместе с пересоздаваемыми
             new_tags = {inbound.get("tag") for inbound in new_inbounds if inbound.get("tag")}
-            for inbound in new_inbounds:
-                if not self._apply_inbound_via_api(inbound):
-                    print(f"Failed to apply inbound {inbound.get('tag')} via API, restoring backup")
-                    self._restore_backup(backup_file)
-                    return False
-
-            # Удаляем устаревшие inbounds
-            for inbound in existing_inbounds:
-                tag = inbound.get("tag")
-                if tag and tag not in new_tags:
-                    self._remove_inbound_via_api(tag)
+            stale_tags = [
+                inbound.get("tag") for inbound in existing_inbounds
+                if inbound.get("tag") and inbound.get("tag") not in new_tags
+            ]
+            results = self._apply_inbounds_via_api(new_inbounds, stale_tags)
+            failed = [tag for tag, ok in results.items() if not ok]
+            if failed:
+                print(f"Failed to apply {len(failed)} inbound(s) via API ({', '.join(failed[:5])}), restoring backup")
+                self._restore_backup(backup_file)
+                return False
 
             return True
             
@@ -520,6 +820,80 @@ class XrayConfigManager:
             print(f"Error updating config for keys: {e}")
             return False
     
+    def _update_shared_config_for_keys(self, keys: List[Dict]) -> bool:
+        """Все активные ключи - клиенты общего inbound; per-key inbounds удаляются"""
+        try:
+            backup_file = self._backup_config("update config for keys")
+            if not backup_file:
+                # Без точки восстановления изменения не применяются
+                return False
+            
+            config = self._load_config()
+            if not config:
+                return False
+            
+            existing_inbounds = [
+                inbound for inbound in config.get("inbounds", [])
+                if inbound.get("tag") and inbound.get("tag") != "api"
+            ]
+            # Запас shortIds сохраняется, чтобы выданные из него ключи не разошлись с Xray
+            shared_inbounds = self.build_inbounds_for_keys(keys, config)
+            if not shared_inbounds:
+                return False
+            inbound = shared_inbounds[0]
+            
+            config["inbounds"] = [
+                existing for existing in config["inbounds"]
+                if existing.get("tag") == "api"
+            ]
+            config["inbounds"].append(inbound)
+            
+            self._update_routing_rules(config)
+            
+            if not self._validate_config(config):
+                print("Configuration validation failed")
+                return False
+            
+            if not self._save_config(config):
+                return False
+            
+            # Per-key inbounds удаляются до добавления общего - порт может совпадать с одним из них
+            stale_tags = [
+                existing.get("tag") for existing in existing_inbounds
+                if existing.get("tag") != SHARED_INBOUND_TAG
+            ]
+            results = self._apply_inbounds_via_api([inbound], stale_tags)
+            if not results.get(SHARED_INBOUND_TAG):
+                print("Failed to apply shared inbound via API, restoring backup")
+                self._restore_backup(backup_file)
+                return False
+            return True
+            
+        except Exception as e:
+            print(f"Error updating shared config for keys: {e}")
+            return False
+    
+    def _sync_shared_short_ids(self, inbound: Dict, db_keys: Dict[str, Dict]) -> List[Dict]:
+        """Добавление в общий inbound недостающих shortIds его клиентов из БД"""
+        reality_settings = inbound["streamSettings"]["realitySettings"]
+        short_ids = reality_settings.setdefault("shortIds", [])
+        fixed_keys = []
+        for client in inbound.get("settings", {}).get("clients", []):
+            db_key = db_keys.get(client.get("id"))
+            if not db_key or not db_key.get("short_id"):
+                continue
+            # Обрезаем short_id до 8 символов для Android совместимости
+            short_id = db_key["short_id"][:8]
+            if short_id not in short_ids:
+                short_ids.append(short_id)
+                fixed_keys.append({
+                    "uuid": db_key["uuid"],
+                    "name": db_key.get("name", "unknown"),
+                    "old_short_id": None,
+                    "new_short_id": short_id
+                })
+        return fixed_keys
+    
     def get_config_status(self) -> Dict:
         """Получение статуса конфигурации"""
         try:
@@ -540,6 +914,7 @@ class XrayConfigManager:
         except Exception as e:
             return {"status": "error", "message": str(e)}
     
+    @config_batch
     def fix_reality_keys_in_config(self) -> bool:
         """Исправление Reality ключей в конфигурации Xray (только приватный ключ, short_id синхронизируется из БД)"""
         try:
@@ -584,7 +959,12 @@ class XrayConfigManager:
                     
                     # Исправляем Short ID на основе данных из БД
                     tag = inbound.get("tag", "")
-                    if tag.startswith("inbound-"):
+                    if tag == SHARED_INBOUND_TAG:
+                        # Общий inbound: shortIds всех клиентов должны присутствовать в списке
+                        for fixed in self._sync_shared_short_ids(inbound, db_keys):
+                            fixed_count += 1
+                            print(f"Added short ID {fixed['new_short_id']} to shared inbound (UUID: {fixed['uuid'][:8]}...)")
+                    elif tag.startswith("inbound-"):
                         uuid_from_tag = tag.replace("inbound-", "")
                         db_key = db_keys.get(uuid_from_tag)
                         
@@ -651,6 +1031,10 @@ class XrayConfigManager:
                 if inbound:
                     config_short_ids = inbound.get("streamSettings", {}).get("realitySettings", {}).get("shortIds", [])
                     config_short_id = config_short_ids[0] if config_short_ids else None
+                    if inbound.get("tag") == SHARED_INBOUND_TAG and db_short_id:
+                        # В общем inbound shortId ключа - один из элементов списка
+                        db_short_id = db_short_id[:8]
+                        config_short_id = db_short_id if db_short_id in config_short_ids else None
                     
                     if db_short_id and config_short_id != db_short_id:
                         short_id_mismatches.append({
@@ -699,7 +1083,11 @@ class XrayConfigManager:
                     inbound.get("streamSettings", {}).get("security") == "reality"):
                     
                     tag = inbound.get("tag", "")
-                    if tag.startswith("inbound-"):
+                    if tag == SHARED_INBOUND_TAG:
+                        shared_fixed = self._sync_shared_short_ids(inbound, db_keys)
+                        fixed_count += len(shared_fixed)
+                        fixed_keys.extend(shared_fixed)
+                    elif tag.startswith("inbound-"):
                         uuid_from_tag = tag.replace("inbound-", "")
                         db_key = db_keys.get(uuid_from_tag)
                         
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Модель конфигурации Xray в памяти: config.json разбирается один раз и
+перечитывается, только если файл изменили извне (mtime/размер, затем sha256
+содержимого). Копии для вызывающих создаются из снимка marshal - быстрее
+json.loads и copy.deepcopy. Запись атомарная (временный файл, fsync, os.replace) в
+компактном JSON; внутри batch() несколько изменений пишутся на диск одной записью.
+Чтение-изменение-запись выполняется под flock (общим для воркеров API и
+sync_inbounds.py); если файл изменили после чтения, запись отклоняется.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import marshal
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigConflictError(RuntimeError):
+    """config.json изменён другим процессом после чтения - изменения не записаны"""
+
+
+def dump_config(config: Dict) -> bytes:
+    """Компактный JSON конфигурации"""
+    return json.dumps(config, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class XrayConfigModel:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        # Конфигурация содержит только dict/list/скаляры - хранится снимком marshal
+        self._snapshot: Optional[bytes] = None
+        self._hash: Optional[str] = None
+        self._stat: Optional[Tuple[int, int]] = None
+        self._dirty = False
+        self._batch_depth = 0
+        self._flock_fd: Optional[int] = None
+
+    @contextmanager
+    def _file_lock(self):
+        """Межпроцессная блокировка config.json (повторный вход в том же потоке не блокирует)"""
+        if self._flock_fd is not None:
+            yield
+            return
+        lock_path = os.path.join(os.path.dirname(self.path) or ".", ".config.lock")
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o664)
+        try:
+            try:
+                os.fchmod(fd, 0o664)  # umask vpn-api (0077) не должен закрыть файл для root/vpnapi
+            except OSError:
+                pass
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._flock_fd = fd
+            try:
+                yield
+            finally:
+                self._flock_fd = None
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _file_stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _sync_from_disk(self):
+        """Перечитать файл, если он изменился с последнего чтения/записи"""
+        stat = self._file_stat()
+        if stat is None:
+            self._snapshot, self._hash, self._stat = None, None, None
+            return
+        if stat == self._stat and self._snapshot is not None:
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if digest != self._hash or self._snapshot is None:
+            self._snapshot = marshal.dumps(json.loads(data))
+            self._hash = digest
+        self._stat = stat
+
+    def load(self) -> Optional[Dict]:
+        """Копия текущей конфигурации (изменения применяются через save)"""
+        with self._lock:
+            if not self._dirty:
+                self._sync_from_disk()
+            return marshal.loads(self._snapshot) if self._snapshot is not None else None
+
+    def dumps(self) -> Optional[bytes]:
+        """Текущая конфигурация (включая ещё не записанные изменения) в компактном JSON"""
+        with self._lock:
+            if not self._dirty:
+                self._sync_from_disk()
+            return dump_config(marshal.loads(self._snapshot)) if self._snapshot is not None else None
+
+    def save(self, config: Dict):
+        """Заменить конфигурацию; на диск - сразу или в конце batch()"""
+        with self._lock:
+            self._snapshot = marshal.dumps(config)
+            self._dirty = True
+            if not self._batch_depth:
+                self.flush()
+
+    def flush(self) -> bool:
+        """
+        Атомарная запись конфигурации, если она изменена; False - если записывать
+        нечего. ConfigConflictError - файл изменён после чтения (изменения
+        сбрасываются, следующий load перечитает файл).
+        """
+        with self._lock, self._file_lock():
+            if not self._dirty or self._snapshot is None:
+                return False
+            if self._changed_on_disk():
+                self.invalidate()
+                logger.error("%s changed on disk since last read, pending changes discarded", self.path)
+                raise ConfigConflictError(f"{self.path} changed on disk since last read")
+            data = dump_config(marshal.loads(self._snapshot))
+            digest = hashlib.sha256(data).hexdigest()
+            if digest == self._hash:
+                self._dirty = False
+                return False
+            self._write_atomic(data)
+            self._hash = digest
+            self._stat = self._file_stat()
+            self._dirty = False
+            return True
+
+    def _changed_on_disk(self) -> bool:
+        """Файл отличается от прочитанного (stat, затем sha256 - touch без изменений не конфликт)"""
+        stat = self._file_stat()
+        if stat == self._stat:
+            return False
+        if stat is None or self._stat is None:
+            return stat != self._stat and self._hash is not None
+        with open(self.path, "rb") as f:
+            if hashlib.sha256(f.read()).hexdigest() != self._hash:
+                return True
+        self._stat = stat
+        return False
+
+    def _write_atomic(self, data: bytes):
+        directory = os.path.dirname(self.path) or "."
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            current = None
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".config-", suffix=".json.tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            # Права и владелец прежнего файла (root:vpnapi 664, см. fix_permissions.sh)
+            os.chmod(tmp_path, current.st_mode & 0o777 if current else 0o644)
+            if current:
+                try:
+                    os.chown(tmp_path, current.st_uid, current.st_gid)
+                except OSError:
+                    pass
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        # rename становится устойчивым после fsync каталога
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    @contextmanager
+    def batch(self):
+        """
+        Несколько save() внутри блока - одна запись на диск при выходе из внешнего
+        блока. flock держится весь блок, конфигурация перечитывается при входе -
+        другой процесс не может записать между чтением и записью.
+        """
+        with self._lock, self._file_lock():
+            if not self._batch_depth and not self._dirty:
+                self._sync_from_disk()
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self.flush()
+
+    def invalidate(self):
+        """Сбросить состояние в памяти (следующий load перечитает файл)"""
+        with self._lock:
+            self._snapshot, self._hash, self._stat = None, None, None
+            self._dirty = False
+
+
+_models: Dict[str, XrayConfigModel] = {}
+_models_lock = threading.Lock()
+
+
+def get_config_model(path: str) -> XrayConfigModel:
+    """Общая модель на файл (XrayConfigManager и api.py работают с одним состоянием)"""
+    path = os.path.abspath(path)
+    with _models_lock:
+        model = _models.get(path)
+        if model is None:
+            model = _models[path] = XrayConfigModel(path)
+        return model
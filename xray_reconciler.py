@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Сверка inbound'ов Xray с SQLite по diff вместо полного пересоздания.
+Желаемое состояние - inbounds, построенные из ключей SQLite; фактическое -
+config.json и список inbound'ов работающего Xray (ListInbounds / `xray api lsi`).
+Inbounds сравниваются по хешу канонического JSON; применяются только
+добавления, удаления и изменения. Если у inbound изменились только клиенты
+(общий inbound), клиенты добавляются/удаляются без пересоздания inbound.
+"""
+
+import copy
+import hashlib
+import json
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from port_manager import port_manager
+
+# Управляемые inbounds: per-key (inbound-<uuid>) и общий (inbound-shared);
+# api и прочие inbounds конфигурации не трогаются
+MANAGED_TAG_PREFIX = "inbound-"
+
+# Хеш глобальных секций config.json, с которым запущен Xray (пишет sync_inbounds.py
+# из ExecStartPost): если он не изменился, изменения применяются без перезапуска
+RUNNING_CONFIG_HASH_KEY = "xray_running_global_hash"
+
+
+def inbound_hash(inbound: Dict) -> str:
+    """sha256 канонического JSON inbound (ключи отсортированы, без пробелов)"""
+    canonical = json.dumps(inbound, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _without_clients(inbound: Dict) -> Dict:
+    stripped = copy.deepcopy(inbound)
+    stripped.get("settings", {}).pop("clients", None)
+    return stripped
+
+
+def _clients_by_id(inbound: Dict) -> Dict[str, Dict]:
+    return {
+        client.get("id"): client
+        for client in inbound.get("settings", {}).get("clients", [])
+    }
+
+
+def _is_managed(inbound: Dict) -> bool:
+    return str(inbound.get("tag", "")).startswith(MANAGED_TAG_PREFIX)
+
+
+def global_config_hash(config: Dict) -> str:
+    """
+    Хеш всего, что Xray применяет только при старте: log, policy, outbounds,
+    dns, routing, неуправляемые inbounds (api). Управляемые inbounds и
+    inboundTag правила direct (список тегов ключей) не учитываются -
+    они меняются через HandlerService.
+    """
+    global_sections = copy.deepcopy({k: v for k, v in config.items() if k != "inbounds"})
+    global_sections["inbounds"] = [
+        inbound for inbound in config.get("inbounds", []) if not _is_managed(inbound)
+    ]
+    for rule in global_sections.get("routing", {}).get("rules", []):
+        if rule.get("outboundTag") == "direct":
+            rule.pop("inboundTag", None)
+    return inbound_hash(global_sections)
+
+
+class XrayReconciler:
+    def __init__(self, manager=None):
+        if manager is None:
+            from xray_config_manager import xray_config_manager as manager
+        self.manager = manager
+
+    def plan(self, keys: Optional[List[Dict]] = None, config: Optional[Dict] = None) -> Dict[str, Any]:
+        """Diff желаемого и фактического состояния без применения"""
+        if config is None:
+            config = self.manager._load_config()
+        if not config:
+            raise RuntimeError("Config not found")
+        if keys is None:
+            from storage.sqlite_storage import storage
+            keys = storage.get_all_keys()
+
+        missing_ports: List[str] = []
+        # Порты ключам без порта выбираются без записи в БД (см. _reconcile)
+        planned_ports = self.manager.plan_missing_ports(keys)
+        desired = {
+            inbound["tag"]: inbound
+            for inbound in self.manager.build_inbounds_for_keys(keys, config, missing_ports, planned_ports)
+        }
+        actual = {
+            inbound["tag"]: inbound
+            for inbound in config.get("inbounds", []) if _is_managed(inbound)
+        }
+        live_tags = self.manager.api.list_inbound_tags()
+        live = None if live_tags is None else {tag for tag in live_tags if tag.startswith(MANAGED_TAG_PREFIX)}
+
+        plan: Dict[str, Any] = {
+            "mode": port_manager.inbound_mode,
+            "desired": len(desired),
+            "actual": len(actual),
+            "live": len(live) if live is not None else None,
+            "added": [],
+            "removed": [],
+            "altered": [],
+            "users_added": {},
+            "users_removed": {},
+            "unchanged": 0,
+            # Активные ключи без порта (созданы в режиме shared) и выбранные им порты:
+            # в БД порты записываются только после успешного применения
+            "missing_ports": missing_ports,
+            "ports_planned": planned_ports,
+        }
+        for tag, inbound in desired.items():
+            current = actual.get(tag)
+            if current is None or (live is not None and tag not in live):
+                plan["added"].append(tag)
+            elif inbound_hash(current) == inbound_hash(inbound):
+                plan["unchanged"] += 1
+            elif inbound_hash(_without_clients(current)) == inbound_hash(_without_clients(inbound)):
+                # Изменились только клиенты - AlterInbound вместо пересоздания
+                current_clients = _clients_by_id(current)
+                desired_clients = _clients_by_id(inbound)
+                removed_users = [
+                    client.get("email") or client_id
+                    for client_id, client in current_clients.items()
+                    if client_id not in desired_clients
+                    or inbound_hash(client) != inbound_hash(desired_clients[client_id])
+                ]
+                added_users = [
+                    client_id for client_id, client in desired_clients.items()
+                    if client_id not in current_clients
+                    or inbound_hash(client) != inbound_hash(current_clients[client_id])
+                ]
+                if removed_users:
+                    plan["users_removed"][tag] = removed_users
+                if added_users:
+                    plan["users_added"][tag] = added_users
+                if not removed_users and not added_users:
+                    plan["unchanged"] += 1  # Изменился только порядок клиентов
+            else:
+                plan["altered"].append(tag)
+        plan["removed"] = sorted((set(actual) | (live or set())) - set(desired))
+        plan["changed"] = bool(
+            plan["added"] or plan["removed"] or plan["altered"]
+            or plan["users_added"] or plan["users_removed"]
+        )
+        plan["_desired"] = desired
+        plan["_live"] = live
+        return plan
+
+    def reconcile(self, keys: Optional[List[Dict]] = None, dry_run: bool = False) -> Dict[str, Any]:
+        """
+        Применение diff: config.json пишется один раз (с бэкапом), в Xray -
+        удаление удалённых/изменённых inbounds одним проходом, один adi для
+        добавленных/изменённых и AlterInbound для клиентов. При ошибке API
+        выполненные операции откатываются в работающем Xray, config.json
+        восстанавливается из бэкапа. Возвращает отчёт.
+        """
+        # config.json пишется один раз при выходе; после отката - не пишется вовсе
+        with self.manager.config_model.batch():
+            return self._reconcile(keys, dry_run)
+
+    def _reconcile(self, keys: Optional[List[Dict]], dry_run: bool) -> Dict[str, Any]:
+        started = time.monotonic()
+        config = self.manager._load_config()
+        if not config:
+            return {"applied": False, "errors": ["Config not found"]}
+        if keys is None:
+            from storage.sqlite_storage import storage
+            keys = storage.get_all_keys()
+        # plan() ничего не пишет; порты ключам без порта записываются после применения
+        report = self.plan(keys, config)
+        report.update({"ports_assigned": [], "port_conflicts": []})
+        desired = report.pop("_desired")
+        live = report.pop("_live")
+        actual = {
+            inbound["tag"]: inbound
+            for inbound in config.get("inbounds", []) if _is_managed(inbound)
+        }
+        report.update({"dry_run": dry_run, "applied": False, "config_written": False, "errors": []})
+
+        if dry_run or not report["changed"]:
+            report["applied"] = not dry_run
+            if report["applied"]:
+                # Inbound с выбранным портом уже совпадает с работающим - порт записывается
+                report["ports_assigned"], report["port_conflicts"] = self.manager.commit_planned_ports(
+                    keys, report["ports_planned"]
+                )
+                report["ports_released"] = self._release_orphaned_ports(keys)
+            report["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            return report
+
+        backup_file = self.manager._backup_config("reconcile")
+        if not backup_file:
+            # Без точки восстановления откат config.json невозможен - ничего не применяем
+            report["errors"].append("Failed to back up config")
+            report["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            return report
+        config["inbounds"] = [
+            inbound for inbound in config.get("inbounds", []) if not _is_managed(inbound)
+        ] + list(desired.values())
+        self.manager._update_routing_rules(config)
+        if not self.manager._validate_config(config):
+            report["errors"].append("Configuration validation failed")
+            report["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            return report
+        if not self.manager._save_config(config):
+            report["errors"].append("Failed to save config")
+            report["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            return report
+        report["config_written"] = True
+
+        api = self.manager.api
+        # Выполненные операции - для отката работающего Xray при ошибке
+        done: Dict[str, List] = {
+            "removed": [], "removed_live": [], "added": [], "users_removed": [], "users_added": [],
+        }
+        recreate = report["added"] + report["altered"]
+        # Inbounds, которые есть только в работающем Xray (не в config.json): для
+        # отката снимаются их InboundHandlerConfig до удаления
+        live_only = [
+            tag for tag in report["removed"] + recreate
+            if tag not in actual and live is not None and tag in live
+        ]
+        live_snapshot = (api.list_inbound_configs() or {}) if live_only else {}
+        for tag in live_only:
+            if tag not in live_snapshot:
+                print(f"No snapshot of live inbound {tag}, it cannot be restored on rollback")
+        removed = api.remove_inbounds(report["removed"] + recreate)
+        for tag in report["removed"] + recreate:
+            if removed.get(tag) and tag in actual and tag not in report["added"]:
+                done["removed"].append(tag)
+            elif removed.get(tag) and tag in live_only:
+                done["removed_live"].append(tag)
+            elif not removed.get(tag) and tag in report["removed"]:
+                report["errors"].append(f"remove {tag}")
+        added = api.add_inbounds([desired[tag] for tag in recreate])
+        for tag, ok in added.items():
+            if ok:
+                done["added"].append(tag)
+            else:
+                report["errors"].append(f"add {tag}")
+        for tag, emails in report["users_removed"].items():
+            current_clients = {
+                client.get("email") or client_id: client
+                for client_id, client in _clients_by_id(actual[tag]).items()
+            }
+            for email in emails:
+                if api.remove_user(tag, email):
+                    done["users_removed"].append((actual[tag], current_clients[email]))
+                else:
+                    report["errors"].append(f"remove user {email} from {tag}")
+        for tag, client_ids in report["users_added"].items():
+            clients = _clients_by_id(desired[tag])
+            for client_id in client_ids:
+                if api.add_user(desired[tag], clients[client_id]):
+                    done["users_added"].append((tag, clients[client_id].get("email") or client_id))
+                else:
+                    report["errors"].append(f"add user {client_id} to {tag}")
+
+        if report["errors"]:
+            print(f"Xray reconcile failed ({'; '.join(report['errors'][:5])}), rolling back")
+            report["rolled_back"] = self._rollback(done, actual, live_snapshot)
+            self.manager._restore_backup(backup_file)
+        else:
+            report["applied"] = True
+            report["ports_assigned"], report["port_conflicts"] = self.manager.commit_planned_ports(
+                keys, report["ports_planned"]
+            )
+            report["ports_released"] = self._release_orphaned_ports(keys)
+        report["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+        return report
+
+    @staticmethod
+    def _release_orphaned_ports(keys: List[Dict]) -> List[int]:
+        """
+        Inbounds ключей вне keys удалены - порты, удержанные за недосозданными
+        ключами с истёкшей арендой, возвращаются в free_ports
+        """
+        from storage.sqlite_storage import storage
+        try:
+            return storage.release_orphaned_ports(key["uuid"] for key in keys)
+        except Exception as e:
+            print(f"Failed to release orphaned ports: {e}")
+            return []
+
+    def _rollback(
+        self, done: Dict[str, List], actual: Dict[str, Dict], live_snapshot: Optional[Dict[str, bytes]] = None
+    ) -> bool:
+        """
+        Возврат работающего Xray к прежним inbounds (в обратном порядке операций):
+        inbounds из config.json - по их JSON, только работавшие в Xray - по снимку
+        InboundHandlerConfig
+        """
+        api = self.manager.api
+        ok = True
+        for tag, email in reversed(done["users_added"]):
+            ok &= api.remove_user(tag, email)
+        for inbound, client in reversed(done["users_removed"]):
+            ok &= api.add_user(inbound, client)
+        if done["added"]:
+            ok &= all(api.remove_inbounds(done["added"]).values())
+        if done["removed"]:
+            ok &= all(api.add_inbounds([actual[tag] for tag in done["removed"]]).values())
+        for tag in done["removed_live"]:
+            snapshot = (live_snapshot or {}).get(tag)
+            ok &= snapshot is not None and api.add_inbound_config(snapshot)
+        return bool(ok)
+
+    def record_running_config(self, config: Optional[Dict] = None) -> Optional[str]:
+        """Запоминание хеша глобальных секций, с которыми запущен Xray"""
+        if config is None:
+            config = self.manager._load_config()
+        if not config:
+            return None
+        config_hash = global_config_hash(config)
+        from storage.sqlite_storage import storage
+        storage.set_metadata(
+            RUNNING_CONFIG_HASH_KEY,
+            json.dumps({"hash": config_hash, "recorded_at": datetime.now().isoformat()}),
+        )
+        return config_hash
+
+    def running_config_hash(self) -> Optional[str]:
+        from storage.sqlite_storage import storage
+        raw = storage.get_metadata(RUNNING_CONFIG_HASH_KEY)
+        if not raw:
+            return None
+        try:
+            return json.loads(raw).get("hash")
+        except ValueError:
+            return None
+
+    def hot_apply(
+        self,
+        keys: Optional[List[Dict]] = None,
+        restart: Optional[Callable[[], bool]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Применение изменений без перезапуска Xray: reconcile с откатом через
+        HandlerService. restart() вызывается, только если изменились глобальные
+        секции конфигурации относительно запущенного Xray.
+        path: noop (нечего менять), hot (HandlerService), restart, failed.
+        """
+        report = self.reconcile(keys)
+        result: Dict[str, Any] = {
+            "path": "failed",
+            "global_changed": False,
+            "reconcile": report,
+        }
+        if not report.get("applied"):
+            return result
+
+        config = self.manager._load_config()
+        running_hash = self.running_config_hash()
+        if running_hash is None:
+            # Хеш запуска неизвестен (Xray стартовал до обновления) - считаем текущий запущенным
+            self.record_running_config(config)
+        else:
+            result["global_changed"] = global_config_hash(config) != running_hash
+
+        if result["global_changed"] and restart is not None:
+            if restart():
+                self.record_running_config(config)
+                result["path"] = "restart"
+            return result
+        result["path"] = "hot" if report["changed"] else "noop"
+        return result
+
+
+xray_reconciler = XrayReconciler()
+
+
+def reconcile_xray_inbounds(keys: Optional[List[Dict]] = None, dry_run: bool = False) -> Dict[str, Any]:
+    """Сверка inbound'ов Xray с SQLite (только изменения)"""
+    return xray_reconciler.reconcile(keys, dry_run)
+
+
+def hot_apply_xray_config(keys: Optional[List[Dict]] = None, restart: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+    """Применение изменений через HandlerService; перезапуск - только при изменении глобальных секций"""
+    return xray_reconciler.hot_apply(keys, restart)
@@ -1,55 +1,41 @@
 #!/usr/bin/env python3
 """
-Модуль для чтения реальной статистики трафика из Xray Stats API
+Модуль для чтения реальной статистики трафика из Xray Stats API.
+Трафик ключа берётся из счётчиков user>>>{email}: email клиента - uuid ключа
+и в отдельном inbound (per_key), и в общем (shared), поэтому режим не важен.
 """
 
-import subprocess
-import json
 import logging
 from typing import Dict, Optional, List
 
+from xray_api_client import get_xray_api_client
+
 logger = logging.getLogger(__name__)
 
 class XrayStatsReader:
     """Чтение статистики из Xray Stats API"""
     
-    def __init__(self, stats_api_server: str = "127.0.0.1:10808"):
-        self.stats_api_server = stats_api_server
+    def __init__(self, stats_api_server: Optional[str] = None):
+        # Общий с XrayConfigManager клиент: постоянный gRPC-канал, fallback на CLI
+        self.api = get_xray_api_client(stats_api_server)
+        self.stats_api_server = self.api.server
     
     def _query_stats(self, pattern: str = "") -> Optional[Dict]:
         """Запрос статистики из Xray Stats API"""
         try:
-            cmd = ['/usr/local/bin/xray', 'api', 'statsquery', 
-                   f'--server={self.stats_api_server}']
-            
-            if pattern:
-                cmd.extend(['-pattern', pattern])
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            
-            if result.returncode != 0:
-                logger.error(f"Xray Stats API error: {result.stderr}")
-                return None
-            
-            try:
-                data = json.loads(result.stdout)
-                return data
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse Stats API response: {e}")
-                return None
-                
-        except subprocess.TimeoutExpired:
-            logger.error("Xray Stats API timeout")
-            return None
+            return self.api.query_stats(pattern)
         except Exception as e:
             logger.error(f"Error querying Stats API: {e}")
             return None
     
+    def get_sys_stats(self) -> Optional[Dict[str, int]]:
+        """Системная статистика процесса Xray (память, горутины, uptime)"""
+        try:
+            return self.api.get_sys_stats()
+        except Exception as e:
+            logger.error(f"Error querying Xray sys stats: {e}")
+            return None
+    
     def get_user_traffic(self, user_uuid: str) -> Dict[str, int]:
         """Получить трафик конкретного пользователя по UUID"""
         pattern = f"user>>>{user_uuid}"
@@ -116,7 +102,7 @@ class XrayStatsReader:
         return users_traffic
     
     def get_inbound_traffic(self, inbound_tag: str) -> Dict[str, int]:
-        """Получить трафик для конкретного inbound"""
+        """Получить трафик для конкретного inbound (в режиме shared - суммарно по всем ключам)"""
         pattern = f"inbound>>>{inbound_tag}"
         data = self._query_stats(pattern)
         